@@ -0,0 +1,68 @@
+"""
+Micro-benchmark of websocket message parsing and serialization.
+
+Compares the previous `SimpleNamespace` based parsing and `__dict__` serialization
+with the message codec. Run from the repository root:
+
+    python3 cumulus/benchmarks/bench_codec.py
+"""
+import json
+import sys
+import timeit
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "rootfs" / "opt"))
+
+from cumulus.messages import JSON_BACKEND, decode_message  # noqa: E402
+from cumulus.messages.message_client import AuthMessage  # noqa: E402
+
+INSTANCE_STATE = json.dumps({
+    "type": "instance_state",
+    "state": "ready",
+    "host": "cumulus.example.com",
+    "user": "client-0123456789",
+    "port": 22,
+    "forwarding_port": 40123,
+})
+ROUNDS = 100_000
+
+
+class _LegacyAuthMessage(json.JSONEncoder):
+    """Client message serialized the previous way."""
+
+    def __init__(self, key: str, signature: str, version: str):
+        self.id = "abcdef"
+        self.type = "client_auth"
+        self.key = key
+        self.signature = signature
+        self.client_version = version
+
+    def to_json(self) -> str:
+        return json.dumps(self, default=lambda o: o.__dict__)
+
+
+def _legacy_parse(message_json: str) -> SimpleNamespace:
+    return json.loads(message_json, object_hook=lambda j: SimpleNamespace(**j))
+
+
+def _report(name: str, seconds: float) -> None:
+    print(f"{name:<24} {ROUNDS / seconds:>12,.0f} msg/s {seconds / ROUNDS * 1e6:>8.2f} us/msg")
+
+
+def main() -> None:
+    key = "a" * 44
+    signature = "b" * 88
+    print(f"JSON backend: {JSON_BACKEND}, {ROUNDS} rounds")
+
+    _report("parse legacy", timeit.timeit(lambda: _legacy_parse(INSTANCE_STATE), number=ROUNDS))
+    _report("parse codec", timeit.timeit(lambda: decode_message(INSTANCE_STATE), number=ROUNDS))
+
+    legacy = _LegacyAuthMessage(key, signature, "0.3.0")
+    message = AuthMessage(key, signature, "0.3.0")
+    _report("serialize legacy", timeit.timeit(legacy.to_json, number=ROUNDS))
+    _report("serialize codec", timeit.timeit(message.to_json, number=ROUNDS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark of websocket message throughput on available event loop implementations.
+
+Client and server run on the same loop over localhost, the server decodes every
+message with the message codec like the add-on does. Run from the repository root:
+
+    python3 cumulus/benchmarks/bench_loop.py [--messages 20000] [--round-trips 2000]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import websockets
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "rootfs" / "opt"))
+
+from cumulus.const import EVENT_LOOP  # noqa: E402
+from cumulus.messages import decode_message  # noqa: E402
+from cumulus.utils import CumulusEventLoopPolicy  # noqa: E402
+
+MESSAGE = json.dumps({
+    "type": "instance_state",
+    "state": "ready",
+    "host": "cumulus.example.com",
+    "user": "client-0123456789",
+    "port": 22,
+    "forwarding_port": 40123,
+})
+_DONE = "done"
+
+
+async def _server(websocket) -> None:
+    async for message in websocket:
+        if message == _DONE:
+            await websocket.send(_DONE)
+        else:
+            decode_message(message)
+            if websocket.request_headers.get("X-Echo"):
+                await websocket.send(message)
+
+
+async def _measure(messages: int, round_trips: int) -> tuple[float, float]:
+    """
+    Measure one-way throughput and round trip latency.
+
+    :returns: messages per second and mean round trip in microseconds
+    """
+    async with websockets.serve(_server, "127.0.0.1", 0, compression=None) as server:
+        port = server.sockets[0].getsockname()[1]
+
+        async with websockets.connect(f"ws://127.0.0.1:{port}", compression=None) as websocket:
+            start = time.perf_counter()
+            for _ in range(messages):
+                await websocket.send(MESSAGE)
+            await websocket.send(_DONE)
+            await websocket.recv()
+            throughput = messages / (time.perf_counter() - start)
+
+        async with websockets.connect(
+                f"ws://127.0.0.1:{port}", compression=None, extra_headers={"X-Echo": "1"}) as websocket:
+            start = time.perf_counter()
+            for _ in range(round_trips):
+                await websocket.send(MESSAGE)
+                await websocket.recv()
+            round_trip = (time.perf_counter() - start) / round_trips * 1e6
+
+    return throughput, round_trip
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20_000, help="Messages sent for throughput")
+    parser.add_argument("--round-trips", type=int, default=2_000, help="Messages sent for latency")
+    args = parser.parse_args()
+
+    for event_loop in vars(EVENT_LOOP).values():
+        policy = CumulusEventLoopPolicy("info", event_loop)
+        with asyncio.Runner(loop_factory=policy.new_event_loop) as runner:
+            loop_name = type(runner.get_loop()).__module__
+            if event_loop != EVENT_LOOP.ASYNCIO and loop_name.startswith("asyncio"):
+                print(f"{event_loop:<10} not installed")
+                continue
+            throughput, round_trip = runner.run(_measure(args.messages, args.round_trips))
+        print(f"{event_loop:<10} {throughput:>10,.0f} msg/s {round_trip:>8.1f} us/round trip")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Benchmarks of add-on processes against the local stand-in server.
+
+Every client is a separate add-on process with its own data directory, connected
+to `fake_server.FakeCumulusServer`. Measured are:
+
+- time to ready: from process start to established remote forward, with new
+  ssh keys (cold) and after restart with existing keys (warm)
+- reconnect latency: from dropped websocket connection to new authentication
+- message throughput: `instance_state` -> `set_ssh_key` round trips per second
+- memory: resident set size of each add-on process
+
+Run from the repository root:
+
+    python3 cumulus/benchmarks/bench_server.py [--clients 4] [--tunnel-mode inprocess] [--latency 0.02]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fake_server import Faults, FakeCumulusServer, generate_identity
+
+ROOTFS_OPT = Path(__file__).resolve().parents[1] / "rootfs" / "opt"
+READY_TIMEOUT = 30
+
+
+class AddonProcess:
+    """Add-on process of one client."""
+
+    def __init__(self, data_dir: Path, server: FakeCumulusServer, options: dict) -> None:
+        self.data_dir = data_dir
+        self.client_id, client_secret = generate_identity()
+        self.client = server.add_client(self.client_id, client_secret)
+        self._process: asyncio.subprocess.Process | None = None
+        data_dir.mkdir()
+        with open(data_dir / "options.json", "w", encoding="utf-8") as options_file:
+            json.dump({
+                "server_url": server.url,
+                "client_id": self.client_id,
+                "client_secret": client_secret,
+                "log_level": "warning",
+                **options,
+            }, options_file)
+
+    async def start(self) -> float:
+        """
+        Start the add-on.
+
+        :returns: start time
+        """
+        env = {**os.environ, "ENV_HA_IP_ADDRESS": "127.0.0.1", "ENV_HA_PORT": "8123", "ENV_BUILD_VERSION": "bench"}
+        started = time.monotonic()
+        self._process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "cumulus", "-c", str(self.data_dir),
+            cwd=ROOTFS_OPT, env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        return started
+
+    async def stop(self) -> None:
+        if self._process is not None and self._process.returncode is None:
+            self._process.terminate()
+            await self._process.wait()
+
+    def rss(self) -> int:
+        """
+        Get resident set size of the process in bytes.
+        """
+        with open(f"/proc/{self._process.pid}/status", encoding="ascii") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+
+async def _wait_for(client, condition) -> None:
+    """
+    Wait until condition on the server side record of client is true.
+    """
+    async with asyncio.timeout(READY_TIMEOUT):
+        while not condition():
+            client.changed.clear()
+            await client.changed.wait()
+
+
+async def _time_to_ready(addon: AddonProcess) -> float:
+    forwards = len(addon.client.forward_times)
+    started = await addon.start()
+    await _wait_for(addon.client, lambda: len(addon.client.forward_times) > forwards)
+    return addon.client.forward_times[-1] - started
+
+
+async def _reconnect_latency(server: FakeCumulusServer, addon: AddonProcess) -> float:
+    auths = len(addon.client.auth_times)
+    dropped = time.monotonic()
+    server.drop(addon.client_id)
+    await _wait_for(addon.client, lambda: len(addon.client.auth_times) > auths)
+    return addon.client.auth_times[-1] - dropped
+
+
+async def _round_trips(server: FakeCumulusServer, addon: AddonProcess, duration: float) -> int:
+    rounds = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        reply = server.expect(addon.client_id, "set_ssh_key")
+        await server.send(addon.client_id, {"type": "instance_state", "state": "wait_for_key"})
+        await asyncio.wait_for(reply, READY_TIMEOUT)
+        rounds += 1
+    return rounds
+
+
+def _report(name: str, values: list[float], unit: str, scale: float = 1) -> None:
+    values = [value * scale for value in values]
+    print(f"{name:<24} median={statistics.median(values):>9.1f}{unit} "
+          f"min={min(values):>9.1f}{unit} max={max(values):>9.1f}{unit}")
+
+
+async def _run(args: argparse.Namespace) -> None:
+    server = FakeCumulusServer(faults=Faults(args.latency, args.jitter))
+    await server.start()
+    options = {"tunnel_mode": args.tunnel_mode, "event_loop": args.event_loop}
+
+    with tempfile.TemporaryDirectory(prefix="cumulus-bench-") as tmp_dir:
+        addons = [AddonProcess(Path(tmp_dir) / f"client{index}", server, options) for index in range(args.clients)]
+        try:
+            cold = await asyncio.gather(*(_time_to_ready(addon) for addon in addons))
+            await asyncio.gather(*(addon.stop() for addon in addons))
+            warm = await asyncio.gather(*(_time_to_ready(addon) for addon in addons))
+
+            await asyncio.sleep(1)
+            memory = [addon.rss() for addon in addons]
+            reconnects = await asyncio.gather(*(_reconnect_latency(server, addon) for addon in addons))
+            rounds = await asyncio.gather(*(_round_trips(server, addon, args.duration) for addon in addons))
+        finally:
+            await asyncio.gather(*(addon.stop() for addon in addons))
+            await server.stop()
+
+    print(f"{args.clients} clients, tunnel_mode={args.tunnel_mode}, event_loop={args.event_loop}, "
+          f"latency={args.latency * 1000:.0f}ms")
+    _report("time to ready (cold)", cold, "ms", 1000)
+    _report("time to ready (warm)", warm, "ms", 1000)
+    _report("reconnect latency", reconnects, "ms", 1000)
+    _report("round trips per client", [count / args.duration for count in rounds], "/s")
+    print(f"{'round trips total':<24} {sum(rounds) / args.duration:>16.1f}/s")
+    _report("memory per client", memory, "MiB", 1 / 2 ** 20)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=4, help="Number of add-on processes")
+    parser.add_argument("--tunnel-mode", default="inprocess", help="Tunnel mode of the add-on")
+    parser.add_argument("--event-loop", default="asyncio", help="Event loop of the add-on")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay of server messages in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra delay of server messages")
+    parser.add_argument("--duration", type=float, default=5.0, help="Duration of throughput measurement")
+    args = parser.parse_args()
+    asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""
+Local stand-in of the Cumulus cloud server.
+
+Speaks the client websocket protocol, verifies signatures of `client_auth`
+messages, registers ssh keys sent by clients and accepts their remote forwards
+on an embedded ssh server. Instance states can be scripted, latency and dropped
+connections can be injected. Run from the repository root:
+
+    python3 cumulus/benchmarks/fake_server.py [--client <client_id>:<client_secret>] [--latency 0.05]
+
+Without `--client` a new client identity is generated and printed.
+"""
+import argparse
+import asyncio
+import base64
+import dataclasses
+import json
+import logging
+import random
+import socket
+import time
+
+import asyncssh
+import websockets
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+
+_LOGGER = logging.getLogger("fake_server")
+
+_CLOSE_POLICY_VIOLATION = 1008
+_STATE_READY = "ready"
+_STATE_WAIT_FOR_KEY = "wait_for_key"
+
+
+@dataclasses.dataclass
+class Faults:
+    """Faults injected into websocket connections."""
+
+    # Delay of every message sent by server in seconds
+    latency: float = 0.0
+    # Random extra delay up to this value
+    jitter: float = 0.0
+    # Probability of aborting connection after received message
+    drop_rate: float = 0.0
+
+
+@dataclasses.dataclass
+class FakeClient:
+    """Client registered on the server."""
+
+    client_id: str
+    public_key: Ed25519PublicKey
+    user: str
+    forwarding_port: int
+    # State sent to client, `None` means the state follows registration of ssh key
+    state: str | None = None
+    ssh_key: str | None = None
+    websocket: websockets.WebSocketServerProtocol | None = None
+    # Monotonic times of successful authentications and established remote forwards
+    auth_times: list[float] = dataclasses.field(default_factory=list)
+    forward_times: list[float] = dataclasses.field(default_factory=list)
+    # Futures resolved by next message of the type instead of default handling
+    waiters: dict[str, asyncio.Future] = dataclasses.field(default_factory=dict)
+    changed: asyncio.Event = dataclasses.field(default_factory=asyncio.Event)
+
+    @property
+    def current_state(self) -> str:
+        if self.state is not None and (self.state != _STATE_READY or self.ssh_key is not None):
+            return self.state
+        return _STATE_READY if self.ssh_key is not None else _STATE_WAIT_FOR_KEY
+
+
+def generate_identity() -> tuple[str, str]:
+    """
+    Generate client identity.
+
+    :returns: client id and base64 encoded client secret for `options.json`
+    """
+    key = Ed25519PrivateKey.generate()
+    secret = key.private_bytes_raw()
+    return f"client-{secret[:4].hex()}", base64.b64encode(secret).decode("ascii")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeCumulusServer:
+    """Websocket and ssh server of the client protocol."""
+
+    def __init__(self, host: str = "127.0.0.1", faults: Faults | None = None) -> None:
+        self.host = host
+        self.faults = faults or Faults()
+        # Instance states applied after first authentication of client, pairs of delay and state
+        self.script: list[tuple[float, str]] = []
+        self.port = 0
+        self.ssh_port = 0
+        self._clients: dict[str, FakeClient] = {}
+        self._users: dict[str, FakeClient] = {}
+        self._ws_server: websockets.WebSocketServer | None = None
+        self._ssh_server: asyncssh.SSHAcceptor | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    def add_client(self, client_id: str, client_secret: str) -> FakeClient:
+        """
+        Register client with secret from its `options.json`.
+        """
+        private_key = Ed25519PrivateKey.from_private_bytes(base64.b64decode(client_secret))
+        client = FakeClient(client_id, private_key.public_key(), f"u{len(self._clients)}", _free_port())
+        self._clients[client_id] = client
+        self._users[client.user] = client
+        return client
+
+    def client(self, client_id: str) -> FakeClient:
+        return self._clients[client_id]
+
+    async def start(self, port: int = 0, ssh_port: int = 0) -> None:
+        """
+        Start websocket and ssh servers, zero port selects free one.
+        """
+        self._ssh_server = await asyncssh.create_server(
+            lambda: _SSHServer(self), self.host, ssh_port,
+            server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")])
+        self.ssh_port = self._ssh_server.sockets[0].getsockname()[1]
+        self._ws_server = await websockets.serve(self._handle, self.host, port, ping_interval=None)
+        self.port = self._ws_server.sockets[0].getsockname()[1]
+        _LOGGER.info("Listening on %s, ssh port %d", self.url, self.ssh_port)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        if self._ws_server is not None:
+            self._ws_server.close()
+            await self._ws_server.wait_closed()
+        if self._ssh_server is not None:
+            self._ssh_server.close()
+            await self._ssh_server.wait_closed()
+
+    async def set_state(self, client_id: str, state: str | None) -> None:
+        """
+        Change instance state of client and send it when connected.
+        """
+        client = self._clients[client_id]
+        client.state = state
+        if client.websocket is not None:
+            await self._send_state(client)
+
+    def drop(self, client_id: str) -> None:
+        """
+        Abort websocket connection of client without close handshake.
+        """
+        client = self._clients[client_id]
+        if client.websocket is not None:
+            client.websocket.transport.abort()
+
+    def expect(self, client_id: str, msg_type: str) -> asyncio.Future:
+        """
+        Get future resolved by next message of the type, default handling of the message is skipped.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._clients[client_id].waiters[msg_type] = future
+        return future
+
+    async def send(self, client_id: str, message: dict) -> None:
+        await self._send(self._clients[client_id].websocket, message)
+
+    async def _handle(self, websocket: websockets.WebSocketServerProtocol) -> None:
+        client: FakeClient | None = None
+        try:
+            async for raw in websocket:
+                message = json.loads(raw)
+                msg_type = message.get("type")
+
+                if client is None:
+                    client = await self._authenticate(websocket, message)
+                    if client is None:
+                        return
+                elif (waiter := client.waiters.pop(msg_type, None)) is not None:
+                    waiter.set_result(message)
+                else:
+                    await self._on_message(client, message)
+
+                if self.faults.drop_rate and random.random() < self.faults.drop_rate:
+                    _LOGGER.info("Inject dropped connection of %s", client.client_id)
+                    websocket.transport.abort()
+                    await websocket.wait_closed()
+                    return
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if client is not None and client.websocket is websocket:
+                client.websocket = None
+
+    async def _authenticate(self, websocket, message: dict) -> FakeClient | None:
+        """
+        Verify `client_auth` message.
+
+        :returns: `None` when the client was refused
+        """
+        client = self._clients.get(message.get("key"))
+        if message.get("type") != "client_auth" or client is None:
+            await self._refuse(websocket, message, "unknown client")
+            return None
+
+        try:
+            client.public_key.verify(base64.b64decode(message["signature"]), client.client_id.encode("ascii"))
+        except (InvalidSignature, ValueError, KeyError):
+            await self._refuse(websocket, message, "invalid signature")
+            return None
+
+        _LOGGER.info("Client %s authenticated, version %s", client.client_id, message.get("client_version"))
+        if client.websocket is not None:
+            await client.websocket.close(_CLOSE_POLICY_VIOLATION, "replaced by new connection")
+        client.websocket = websocket
+        client.auth_times.append(time.monotonic())
+        client.changed.set()
+        if len(client.auth_times) == 1 and self.script:
+            self._spawn(self._run_script(client))
+        await self._send_state(client)
+        return client
+
+    async def _refuse(self, websocket, message: dict, error: str) -> None:
+        _LOGGER.warning("Refuse client: %s", error)
+        await self._send_error(websocket, message, error)
+        await websocket.close(_CLOSE_POLICY_VIOLATION, error)
+
+    async def _send_error(self, websocket, message: dict, error: str) -> None:
+        await self._send(websocket, {"type": "error", "id": message.get("id"), "error": error})
+
+    async def _on_message(self, client: FakeClient, message: dict) -> None:
+        match message.get("type"):
+            case "set_ssh_key":
+                try:
+                    asyncssh.import_public_key(message["key"])
+                except (KeyError, asyncssh.KeyImportError):
+                    await self._send_error(client.websocket, message, "invalid key")
+                    return
+                client.ssh_key = message["key"]
+                await self._send_state(client)
+            case "refresh_status":
+                await self._send_state(client)
+            case msg_type:
+                await self._send_error(client.websocket, message, f"unknown type {msg_type}")
+
+    async def _send_state(self, client: FakeClient) -> None:
+        message = {"type": "instance_state", "state": client.current_state}
+        if message["state"] == _STATE_READY:
+            message.update(
+                host=self.host, user=client.user, port=self.ssh_port, forwarding_port=client.forwarding_port)
+        await self._send(client.websocket, message)
+
+    async def _send(self, websocket, message: dict) -> None:
+        if websocket is None:
+            return
+        if self.faults.latency or self.faults.jitter:
+            await asyncio.sleep(self.faults.latency + random.uniform(0, self.faults.jitter))
+        try:
+            await websocket.send(json.dumps(message))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _run_script(self, client: FakeClient) -> None:
+        for delay, state in self.script:
+            await asyncio.sleep(delay)
+            _LOGGER.info("Script changes state of %s to %s", client.client_id, state)
+            await self.set_state(client.client_id, state)
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _forward_requested(self, client: FakeClient, listen_port: int) -> bool:
+        if listen_port != client.forwarding_port:
+            _LOGGER.warning("Client %s requested forward of unexpected port %d", client.client_id, listen_port)
+            return False
+        client.forward_times.append(time.monotonic())
+        client.changed.set()
+        return True
+
+
+class _SSHServer(asyncssh.SSHServer):
+    """SSH server accepting only keys registered by clients."""
+
+    def __init__(self, server: FakeCumulusServer) -> None:
+        self._server = server
+        self._client: FakeClient | None = None
+
+    def begin_auth(self, username: str) -> bool:
+        # pylint: disable=protected-access
+        self._client = self._server._users.get(username)
+        return True
+
+    def public_key_auth_supported(self) -> bool:
+        return True
+
+    def validate_public_key(self, username: str, key: asyncssh.SSHKey) -> bool:
+        if self._client is None or self._client.ssh_key is None:
+            return False
+        return asyncssh.import_public_key(self._client.ssh_key).public_data == key.public_data
+
+    def server_requested(self, listen_host: str, listen_port: int) -> bool:
+        # pylint: disable=protected-access
+        return self._client is not None and self._server._forward_requested(self._client, listen_port)
+
+
+def _parse_script(value: str) -> list[tuple[float, str]]:
+    """
+    Parse script `state@delay,...`, delays are relative to the previous step.
+    """
+    steps = []
+    for step in filter(None, value.split(",")):
+        state, _, delay = step.partition("@")
+        steps.append((float(delay or 0), state))
+    return steps
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    server = FakeCumulusServer(args.host, Faults(args.latency, args.jitter, args.drop_rate))
+    server.script = _parse_script(args.script)
+    for identity in args.client or [":".join(generate_identity())]:
+        client_id, client_secret = identity.split(":", 1)
+        server.add_client(client_id, client_secret)
+        print(f"client_id: {client_id}\nclient_secret: {client_secret}")
+
+    await server.start(args.port, args.ssh_port)
+    print(f"server_url: {server.url}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="Websocket port")
+    parser.add_argument("--ssh-port", type=int, default=0, help="SSH port, free one by default")
+    parser.add_argument("--client", action="append", help="Client identity <client_id>:<client_secret>")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay of server messages in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra delay of server messages")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Probability of dropped connection per message")
+    parser.add_argument("--script", default="", help="States after first auth, e.g. registered@0,ready@5")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logging.getLogger("asyncssh").setLevel(logging.WARNING)
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
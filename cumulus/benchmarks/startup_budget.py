@@ -0,0 +1,77 @@
+"""
+Check import time of the add-on entry point against a budget.
+
+Modules needed only on some code paths must not be imported at start. The check
+runs in the Startup budget workflow on every pull request. Run from the repository
+root, exit code is non-zero when the check fails:
+
+    python3 cumulus/benchmarks/startup_budget.py --budget-ms 250
+
+For timeline of the whole start run the add-on with `--profile-startup`.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOTFS_OPT = Path(__file__).resolve().parents[1] / "rootfs" / "opt"
+
+# Modules imported lazily on the code path which needs them
+LAZY_MODULES = (
+    "asyncssh",
+    "cryptography",
+    "ctypes",
+    "cumulus.proxy.cache",
+    "cumulus.proxy.pool",
+    "cumulus.ssh.tunnel_inprocess",
+)
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import cumulus.config, cumulus.core
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+def measure() -> tuple[float, set[str]]:
+    """
+    Import entry point modules in fresh interpreter.
+
+    :returns: import time in seconds and names of imported modules
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", _PROBE], cwd=ROOTFS_OPT, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output)
+    return result["elapsed"], set(result["modules"])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=250, help="Maximal median import time")
+    parser.add_argument("--rounds", type=int, default=7, help="Number of measured interpreter starts")
+    args = parser.parse_args()
+
+    times = []
+    modules: set[str] = set()
+    for _ in range(args.rounds):
+        elapsed, modules = measure()
+        times.append(elapsed * 1000)
+
+    median = statistics.median(times)
+    print(f"Import time median={median:.1f}ms min={min(times):.1f}ms max={max(times):.1f}ms "
+          f"budget={args.budget_ms:.0f}ms")
+
+    eager = [name for name in LAZY_MODULES if name in modules]
+    if eager:
+        print(f"FAIL: modules imported at start: {', '.join(eager)}")
+    if median > args.budget_ms:
+        print("FAIL: import time is over budget")
+    return 1 if eager or median > args.budget_ms else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
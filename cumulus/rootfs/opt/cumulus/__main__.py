@@ -3,9 +3,9 @@ import argparse
 import logging
 import sys
 
-from cumulus.config import CumulusConfig
 from .const import REQUIRED_PYTHON_VER
-from .core import run
+from .log import setup_logging
+from .startup import StartupProfile
 
 
 def validate_python() -> None:
@@ -13,21 +13,10 @@ def validate_python() -> None:
     Validate that the right Python version is running.
     """
     if sys.version_info[:3] < REQUIRED_PYTHON_VER:
-        logging.error(
-            "Home Assistant requires at least Python "
-            f"{REQUIRED_PYTHON_VER[0]}.{REQUIRED_PYTHON_VER[1]}.{REQUIRED_PYTHON_VER[2]}"
-        )
+        logging.error("Home Assistant requires at least Python %d.%d.%d", *REQUIRED_PYTHON_VER)
         sys.exit(1)
 
 
-def setup_logging(level: str) -> None:
-    logging.basicConfig(
-        stream=sys.stdout,
-        level=level.upper(),
-        format="%(asctime)s %(levelname)5s %(name)s:%(lineno)s %(message)s"
-    )
-
-
 def get_arguments() -> argparse.Namespace:
     """
     Get parsed passed in arguments.
@@ -42,6 +31,11 @@ def get_arguments() -> argparse.Namespace:
         default="/data",
         help="Directory that contains the Cumulus configuration"
     )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Print timeline of start phases and exit when the tunnel is up"
+    )
     return parser.parse_args()
 
 
@@ -50,13 +44,23 @@ def main() -> int:
     Start Cumulus.
     """
     args = get_arguments()
+    profile = StartupProfile() if args.profile_startup else None
+
+    # Imported here, so the import time is included in the profile
+    from .config import CumulusConfig
+    from .core import run
+    if profile is not None:
+        profile.mark("imports")
+
     config = CumulusConfig(args.config)
+    if profile is not None:
+        profile.mark("config load")
 
     setup_logging(config.log_level)
     validate_python()
 
-    logging.debug(f"Loaded config={config}")
-    return run(config)
+    logging.debug("Loaded config=%s", config)
+    return run(config, profile)
 
 
 if __name__ == "__main__":
@@ -1,22 +1,56 @@
 import base64
+import copy
 import json
 import os
+import re
 from pathlib import Path
 
-from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cumulus.const import EVENT_LOOP, RECONNECT_STRATEGY, SSH_CIPHER_AUTO, SSH_COMPRESSION, TUNNEL_MODE
+
+# Client id of instance is used as name of its data directory
+_CLIENT_ID_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*")
 
 
 class CumulusConfig:
     """App configuration"""
 
     config_dir: Path
+    # Name of client instance in fleet mode, `None` when the process runs single instance
+    name: str | None
     log_level: str
     server_url: str
+    # All endpoints of server, the first one is `server_url`
+    server_urls: list[str]
     client_id: str
-    client_secret: Ed25519PrivateKey
     ha_ip_address: str
     ha_port: str
     version: str
+    supervisor_token: str | None
+    tunnel_mode: str
+    http_proxy: bool
+    ha_pool_size: int
+    ha_pool_idle_timeout: float
+    ha_pool_max_requests: int
+    ha_pool_max_connections: int
+    static_cache_size: int
+    static_cache_disk_size: int
+    proxy_compression: bool
+    websocket_fanout: bool
+    websocket_coalesce_window: float
+    reconnect_strategy: str
+    reconnect_max_delay: int
+    ping_interval: int
+    ping_max_missed: int
+    metrics: bool
+    metrics_address: str
+    tunnel_failure_budget: int
+    warm_start: bool
+    event_loop: str
+    loop_lag_threshold: float
+    tunnel_drain_timeout: int
+    tunnel_probe_interval: int
+    ssh_cipher: str
+    ssh_compression: str
 
     def __init__(self, config_dir: str):
         """
@@ -29,12 +63,89 @@ class CumulusConfig:
             config = json.load(config_file)
             self.log_level = config.get("log_level", "info")
             self.server_url = config["server_url"]
+            self.server_urls = [self.server_url, *config.get("server_urls", [])]
             self.client_id = config["client_id"]
-            self.client_secret = Ed25519PrivateKey.from_private_bytes(base64.b64decode(config["client_secret"]))
+            self._client_secret_bytes = base64.b64decode(config["client_secret"])
+            self._instances: list[dict] = config.get("instances", [])
+            self.tunnel_mode = config.get("tunnel_mode", TUNNEL_MODE.AUTOSSH)
+            self.http_proxy = config.get("http_proxy", False)
+            self.ha_pool_size = config.get("ha_pool_size", 8)
+            self.ha_pool_idle_timeout = config.get("ha_pool_idle_timeout", 60)
+            self.ha_pool_max_requests = config.get("ha_pool_max_requests", 1000)
+            self.ha_pool_max_connections = config.get("ha_pool_max_connections", 32)
+            self.static_cache_size = config.get("static_cache_size", 16)
+            self.static_cache_disk_size = config.get("static_cache_disk_size", 0)
+            self.proxy_compression = config.get("proxy_compression", False)
+            self.websocket_fanout = config.get("websocket_fanout", False)
+            self.websocket_coalesce_window = config.get("websocket_coalesce_window", 0.5)
+            self.reconnect_strategy = config.get("reconnect_strategy", RECONNECT_STRATEGY.BACKOFF)
+            self.reconnect_max_delay = config.get("reconnect_max_delay", 300)
+            self.ping_interval = config.get("ping_interval", 20)
+            self.ping_max_missed = config.get("ping_max_missed", 3)
+            self.metrics = config.get("metrics", False)
+            self.metrics_address = config.get("metrics_address", "127.0.0.1")
+            self.tunnel_failure_budget = config.get("tunnel_failure_budget", 5)
+            self.warm_start = config.get("warm_start", True)
+            self.event_loop = config.get("event_loop", EVENT_LOOP.ASYNCIO)
+            self.loop_lag_threshold = config.get("loop_lag_threshold", 0.5)
+            self.tunnel_drain_timeout = config.get("tunnel_drain_timeout", 5)
+            self.tunnel_probe_interval = config.get("tunnel_probe_interval", 15)
+            self.ssh_cipher = config.get("ssh_cipher", SSH_CIPHER_AUTO)
+            self.ssh_compression = config.get("ssh_compression", SSH_COMPRESSION.AUTO)
 
         self.ha_ip_address = os.environ["ENV_HA_IP_ADDRESS"]
         self.ha_port = os.environ["ENV_HA_PORT"]
         self.version = os.environ["ENV_BUILD_VERSION"]
+        self.supervisor_token = os.environ.get("SUPERVISOR_TOKEN")
+        self.name = None
+        self._client_secret: 'Ed25519PrivateKey | None' = None
+
+    def instances(self) -> list['CumulusConfig']:
+        """
+        Get configuration of every client instance run by the process.
+
+        Instances from `instances` option share all other options with the main instance,
+        each of them keeps its keys and state in own data directory.
+
+        :raises ValueError: when client id of instance is not valid or it's used twice
+        """
+        if not self._instances:
+            return [self]
+
+        main = copy.copy(self)
+        main.name = self.client_id
+        configs = [main]
+        for options in self._instances:
+            config = copy.copy(self)
+            config.server_url = options["server_url"]
+            config.server_urls = [config.server_url, *options.get("server_urls", [])]
+            config.client_id = options["client_id"]
+            config.name = options.get("name") or config.client_id
+            config.ha_ip_address = options.get("ha_ip_address", self.ha_ip_address)
+            config.ha_port = str(options.get("ha_port", self.ha_port))
+            config.config_dir = self.config_dir / "instances" / config.client_id
+            config._client_secret_bytes = base64.b64decode(options["client_secret"])
+            config._client_secret = None
+            config._instances = []
+            if not _CLIENT_ID_PATTERN.fullmatch(config.client_id):
+                raise ValueError(f"Invalid client_id {config.client_id!r} of instance {config.name}")
+            configs.append(config)
+
+        names = [config.name for config in configs]
+        client_ids = [config.client_id for config in configs]
+        if len(set(names)) != len(names) or len(set(client_ids)) != len(client_ids):
+            raise ValueError("Names and client ids of instances must be unique")
+        return configs
+
+    @property
+    def client_secret(self) -> 'Ed25519PrivateKey':
+        """
+        Client private key, decoded on first use.
+        """
+        if self._client_secret is None:
+            from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+            self._client_secret = Ed25519PrivateKey.from_private_bytes(self._client_secret_bytes)
+        return self._client_secret
 
     def sign_data(self, data: str) -> str:
         ascii_data = data.encode("ascii")
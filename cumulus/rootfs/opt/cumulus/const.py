@@ -6,10 +6,58 @@ from typing import Final
 REQUIRED_PYTHON_VER: Final[tuple[int, int, int]] = (3, 10, 0)
 
 REFRESH_KEYS_AFTER_DAYS = 30
+# Next key is registered ahead of the refresh, so the tunnel is switched to it without outage
+ROTATE_KEYS_BEFORE_DAYS = 2
+
+METRICS_PORT = 9100
 
 MSG_TYPE = SimpleNamespace()
 MSG_TYPE.ERROR = "error"
 MSG_TYPE.CLIENT_AUTH = "client_auth"
 MSG_TYPE.INSTANCE_STATE = "instance_state"
 MSG_TYPE.SET_SSH_KEY = "set_ssh_key"
-MSG_TYPE.REFRESH_STATUS = "refresh_status"
\ No newline at end of file
+MSG_TYPE.REFRESH_STATUS = "refresh_status"
+
+TUNNEL_MODE = SimpleNamespace()
+TUNNEL_MODE.AUTOSSH = "autossh"
+TUNNEL_MODE.INPROCESS = "inprocess"
+
+EVENT_LOOP = SimpleNamespace()
+EVENT_LOOP.ASYNCIO = "asyncio"
+EVENT_LOOP.UVLOOP = "uvloop"
+
+SSH_CIPHER_AUTO = "auto"
+
+SSH_COMPRESSION = SimpleNamespace()
+SSH_COMPRESSION.AUTO = "auto"
+SSH_COMPRESSION.YES = "yes"
+SSH_COMPRESSION.NO = "no"
+
+RECONNECT_STRATEGY = SimpleNamespace()
+RECONNECT_STRATEGY.BACKOFF = "backoff"
+RECONNECT_STRATEGY.FIXED = "fixed"
+
+TUNNEL_STATE = SimpleNamespace()
+TUNNEL_STATE.STOPPED = "stopped"
+TUNNEL_STATE.STARTING = "starting"
+TUNNEL_STATE.ESTABLISHED = "established"
+TUNNEL_STATE.BACKOFF = "backoff"
+TUNNEL_STATE.FAILED = "failed"
+
+TUNNEL_EXIT = SimpleNamespace()
+TUNNEL_EXIT.CLOSED = "closed"
+TUNNEL_EXIT.AUTH = "auth"
+TUNNEL_EXIT.NETWORK = "network"
+TUNNEL_EXIT.FORWARD_CONFLICT = "forward_conflict"
+TUNNEL_EXIT.PROBE = "probe"
+TUNNEL_EXIT.UNKNOWN = "unknown"
+
+SSH_EVENT = SimpleNamespace()
+SSH_EVENT.AUTH_SUCCESS = "auth_success"
+SSH_EVENT.AUTH_FAILURE = "auth_failure"
+SSH_EVENT.FORWARD_ESTABLISHED = "established"
+SSH_EVENT.FORWARD_FAILED = "failed"
+SSH_EVENT.CHANNEL_OPEN = "open"
+SSH_EVENT.CHANNEL_CLOSE = "close"
+SSH_EVENT.KEEPALIVE_TIMEOUT = "keepalive_timeout"
+SSH_EVENT.CONNECTION_ERROR = "connection_error"
@@ -1,46 +1,78 @@
 """Run Cumulus."""
 import asyncio
-import concurrent
+import contextlib
+import contextvars
 import logging
-import os
 import signal
-import subprocess
-import traceback
 import inspect
+import time
 from typing import Any, Coroutine, TypeVar, Callable
 
 from .config import CumulusConfig
+from .endpoints import EndpointSelector
+from .log import INSTANCE
 from .messaging import MessagingService
+from .metrics import MetricsRegistry, MetricsService
+from .proxy import ProxyService
+from .startup import STARTUP_FINISHED, StartupProfile
 from .tunnel import TunnelService
-from .utils import InterruptibleThreadPoolExecutor, CumulusEventLoopPolicy, enable_posix_spawn
+from .utils import CumulusEventLoopPolicy, enable_posix_spawn, executor_queue_depth
+from .watchdog import LoopWatchdog, SamplingProfiler
+from .const import METRICS_PORT
 
 _R = TypeVar("_R")
 _LOGGER = logging.getLogger(__name__)
+# Time for shutdown handlers on top of the tunnel drain timeout
+_SHUTDOWN_TIMEOUT = 3
+# Minimal time for cancelled tasks to finish
+_CANCEL_TIMEOUT = 0.5
+# Seconds before failed instance is started again in fleet mode
+_RESTART_DELAY = 30
+
 
 class Cumulus:
-    """Root object of the Cumulus Add-on."""
+    """Client instance connected to one cloud server, instances of fleet share the process."""
 
-    def __init__(self, config: CumulusConfig, loop: asyncio.AbstractEventLoop, shutdown_future: asyncio.Future):
+    def __init__(
+        self,
+        config: CumulusConfig,
+        loop: asyncio.AbstractEventLoop,
+        metrics: MetricsRegistry,
+        startup: StartupProfile | None = None,
+    ):
         """
         Create instance of main handler.
 
         :param config: The configuration
+        :param metrics: registry of instance metrics
+        :param startup: profile of start phases, `None` when profiling is disabled
         """
         self._tasks: set[asyncio.Future[Any]] = set()
         self._shutdown_callbacks: set[Callable[[], None]] = set()
-        self._shutdown_future = shutdown_future
+        self._stopping = False
         self._loop = loop
+        # Tasks of the instance run in its context, so their log records carry its name
+        self._context = contextvars.copy_context()
+        self._context.run(INSTANCE.set, config.name)
+        self.startup = startup
+        # Result is exit code of the instance
+        self.finished: asyncio.Future[int] = loop.create_future()
 
         self.config = config
+        self.metrics = metrics
+
+        self.endpoints = EndpointSelector(self)
         self.msg = MessagingService(self)
         self.tunnel = TunnelService(self)
+        self.proxy = ProxyService(self)
 
     def bootstrap(self) -> None:
         """
         Bootstrap services.
         """
-        self._add_signal_handlers()
         self.create_task(self.msg.run(), "msg-service")
+        self.create_task(self.tunnel.prepare(), "tunnel-prepare")
+        self.create_task(self.tunnel.rotate_keys(), "tunnel-key-rotation")
 
     def create_task(self, target: Coroutine[Any, Any, Any], name: str = None) -> None:
         """
@@ -48,9 +80,30 @@ class Cumulus:
         """
         self._loop.call_soon_threadsafe(self._async_create_task, target, name)
 
+    def mark_startup(self, phase: str, started: float | None = None) -> None:
+        """
+        Record end of start phase when startup profiling is enabled.
+
+        :param started: `time.perf_counter()` at start of phase running concurrently with the others
+        """
+        if self.startup is None:
+            return
+
+        self.startup.mark(phase, started)
+        if phase == STARTUP_FINISHED:
+            print(self.startup.report(), flush=True)
+            self.startup = None
+            self.create_task(self.stop(), "startup-profile-stop")
+
+    async def run_in_executor(self, target: Callable[..., _R], *args: Any) -> _R:
+        """
+        Run blocking function in the executor, so it does not block the event loop.
+        """
+        return await self._loop.run_in_executor(None, target, *args)
+
     def register_shutdown_handler(self, callback: Callable[[], None]) -> None:
         """
-        Register callback to run before shutdown.
+        Register callback to run before shutdown. Callbacks run concurrently.
         """
         self._shutdown_callbacks.add(callback)
 
@@ -58,26 +111,184 @@ class Cumulus:
         """
         Create a task from within the event loop.
         """
-        task = self._loop.create_task(target, name=name)
+        task = self._context.run(self._loop.create_task, target, name=name)
         self._tasks.add(task)
-        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(self._task_done)
         return task
 
+    def _task_done(self, task: asyncio.Task[Any]) -> None:
+        """
+        Stop the instance when its task failed, other instances of the fleet keep running.
+        """
+        self._tasks.discard(task)
+        if task.cancelled() or (err := task.exception()) is None:
+            return
+
+        _LOGGER.error("Task %s failed", task.get_name(), exc_info=(type(err), err, err.__traceback__))
+        if not self._stopping:
+            self._async_create_task(self.stop(1), "failed-task-stop")
+
     async def stop(self, exit_code: int = 0) -> None:
         """
-        Stop client and shutdown all tasks.
+        Stop client instance and shutdown all its tasks.
+
+        Shutdown handlers run concurrently, handlers which do not finish before
+        the shutdown deadline are cancelled together with the remaining tasks.
         """
-        for callback in self._shutdown_callbacks:
-            future = callback()
-            if inspect.isawaitable(future):
-                await future
+        if self._stopping:
+            return
+        self._stopping = True
+        # Stop is called also from tasks of the fleet
+        INSTANCE.set(self.config.name)
+        start = self._loop.time()
+        deadline = start + self.config.tunnel_drain_timeout + _SHUTDOWN_TIMEOUT
+
+        durations: dict[str, float] = {}
+        handlers = [
+            asyncio.ensure_future(self._run_shutdown_handler(callback, durations))
+            for callback in self._shutdown_callbacks
+        ]
+        if handlers:
+            _, pending = await asyncio.wait(handlers, timeout=deadline - self._loop.time())
+            for handler in pending:
+                handler.cancel()
+
+        current = asyncio.current_task()
+        tasks = [task for task in self._tasks if task is not current]
+        for task in tasks:
+            _LOGGER.debug("Cancel task %s", task.get_name())
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=max(deadline - self._loop.time(), _CANCEL_TIMEOUT))
+
+        _LOGGER.info(
+            "Shutdown finished in %.2fs (%s)", self._loop.time() - start,
+            ", ".join(f"{name}={duration:.2f}s" for name, duration in sorted(durations.items())))
+        self.finished.set_result(exit_code)
+
+    async def _run_shutdown_handler(self, callback: Callable[[], Any], durations: dict[str, float]) -> None:
+        """
+        Run shutdown handler and record its duration.
+        """
+        name = getattr(callback, "__qualname__", repr(callback))
+        start = self._loop.time()
+        try:
+            result = callback()
+            if inspect.isawaitable(result):
+                await result
+        except asyncio.CancelledError:
+            _LOGGER.warning("Shutdown handler %s did not finish in time", name)
+            raise
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Shutdown handler %s failed", name)
+        finally:
+            durations[name] = self._loop.time() - start
+
+
+class Fleet:
+    """
+    Process running client instances, one for every configured client.
+
+    Instances share the event loop, the executor and the metrics endpoint. Failed instance
+    is started again after a delay, so one failing client does not stop the others.
+    """
 
-        await asyncio.sleep(1)
+    def __init__(self, config: CumulusConfig, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Init fleet.
+
+        :param config: configuration of the process, it contains configuration of all instances
+        """
+        self._loop = loop
+        self._configs = config.instances()
+        self._instances: dict[str, Cumulus] = {}
+        self._tasks: set[asyncio.Task[Any]] = set()
+        self._shutdown_callbacks: set[Callable[[], None]] = set()
+        self._stopped = asyncio.Event()
+        self._start_time = time.monotonic()
+
+        self.config = config
+        self.metrics = MetricsRegistry()
+        self.metrics.gauge(
+            "cumulus_uptime_seconds", "Time since add-on start",
+            callback=lambda: time.monotonic() - self._start_time)
+        self.metrics.gauge(
+            "cumulus_executor_queue_depth", "Jobs waiting for executor thread",
+            callback=lambda: executor_queue_depth(self._loop))
+        self._restarts = self.metrics.counter(
+            "cumulus_instance_restarts_total", "Restarts of failed client instances", ["instance"])
+        self.metrics_service = MetricsService(self, config.metrics_address, METRICS_PORT) if config.metrics else None
+        self.watchdog = LoopWatchdog(self, config.loop_lag_threshold) if config.loop_lag_threshold > 0 else None
+        self.profiler = SamplingProfiler(config.config_dir)
+
+    def register_shutdown_handler(self, callback: Callable[[], None]) -> None:
+        """
+        Register callback to run after all instances are stopped.
+        """
+        self._shutdown_callbacks.add(callback)
+
+    async def run(self, startup: StartupProfile | None = None) -> int:
+        """
+        Run all instances until they are stopped.
+
+        :param startup: profile of start phases, it's recorded by the first instance
+        :returns: the highest exit code of instances
+        """
+        self._add_signal_handlers()
+        if self.metrics_service is not None:
+            self._create_task(self.metrics_service.run(), "metrics-service")
+        if self.watchdog is not None:
+            self._create_task(self.watchdog.run(), "loop-watchdog")
+
+        exit_codes = await asyncio.gather(*(
+            self._run_instance(config, startup if index == 0 else None)
+            for index, config in enumerate(self._configs)
+        ))
+
+        for callback in self._shutdown_callbacks:
+            if inspect.isawaitable(result := callback()):
+                await result
         for task in self._tasks:
-            _LOGGER.warning("Cancel task %s", task.get_name())
             task.cancel()
+        return max(exit_codes)
+
+    async def stop(self) -> None:
+        """
+        Stop all instances.
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        await asyncio.gather(*(cumulus.stop() for cumulus in self._instances.values()))
+
+    async def _run_instance(self, config: CumulusConfig, startup: StartupProfile | None) -> int:
+        """
+        Run client instance, failed instance is started again while other instances run.
+        """
+        labels = {"instance": config.name} if config.name is not None else {}
+        config.config_dir.mkdir(parents=True, exist_ok=True)
+
+        exit_code = 0
+        while not self._stopped.is_set():
+            metrics = self.metrics.child(config.client_id, **labels)
+            cumulus = self._instances[config.client_id] = Cumulus(config, self._loop, metrics, startup)
+            cumulus.mark_startup("services init")
+            cumulus.bootstrap()
+            exit_code = await cumulus.finished
+            if exit_code == 0 or len(self._configs) == 1:
+                break
 
-        self._shutdown_future.set_result(exit_code)
+            _LOGGER.error("Instance %s failed, start it again in %ds", config.name, _RESTART_DELAY)
+            self._restarts.inc(instance=config.name)
+            startup = None
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._stopped.wait(), _RESTART_DELAY)
+        return exit_code
+
+    def _create_task(self, target: Coroutine[Any, Any, Any], name: str) -> None:
+        task = self._loop.create_task(target, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
     def _add_signal_handlers(self) -> None:
         """
@@ -93,24 +304,27 @@ class Cumulus:
 
         signal.signal(signal.SIGTERM, _handle_signal)
         signal.signal(signal.SIGINT, _handle_signal)
+        # Handled in the main thread even when the loop is blocked by Python code
+        signal.signal(signal.SIGUSR1, lambda *_: self.profiler.start())
 
 
-def run(config: CumulusConfig) -> int:
+def run(config: CumulusConfig, startup: StartupProfile | None = None) -> int:
     """
     Run Cumulus client.
+
+    :param startup: profile of start phases, `None` when profiling is disabled
     """
     enable_posix_spawn()
-    asyncio.set_event_loop_policy(CumulusEventLoopPolicy(config.log_level))
+    asyncio.set_event_loop_policy(CumulusEventLoopPolicy(config.log_level, config.event_loop))
     loop = asyncio.new_event_loop()
+    if startup is not None:
+        startup.mark("loop creation")
 
     try:
         asyncio.set_event_loop(loop)
 
-        shutdown_future = loop.create_future()
-        cumulus = Cumulus(config, loop, shutdown_future)
-        cumulus.bootstrap()
-
-        return loop.run_until_complete(shutdown_future)
+        fleet = Fleet(config, loop)
+        return loop.run_until_complete(fleet.run(startup))
     finally:
         try:
             loop.run_until_complete(loop.shutdown_asyncgens())
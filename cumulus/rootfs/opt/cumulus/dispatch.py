@@ -0,0 +1,106 @@
+"""Process messages received from server."""
+import asyncio
+import collections
+import logging
+import time
+
+from cumulus.messages import Message
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class MessageDispatcher:
+    """
+    Process received messages by pool of workers.
+
+    Messages with the same `ordering_key` are processed one by one in order of
+    arrival, messages with different keys are processed concurrently. Submitting
+    never waits, messages over the queue limit are dropped.
+    """
+
+    def __init__(self, cumulus: 'Cumulus', workers: int, max_queued: int) -> None:
+        """
+        Init dispatcher and start its workers.
+
+        :param workers: number of messages processed concurrently
+        :param max_queued: maximal number of messages waiting for processing
+        """
+        self._cumulus = cumulus
+        self._workers = workers
+        self._max_queued = max_queued
+        # Messages waiting for processing by ordering key
+        self._lanes: dict[str, collections.deque[tuple[Message, float]]] = {}
+        # Keys with waiting messages which are not processed right now, `None` stops worker
+        self._ready: asyncio.Queue[str | None] = asyncio.Queue()
+        self._queued = 0
+
+        self._setup_metrics(cumulus.metrics)
+        for worker in range(workers):
+            cumulus.create_task(self._work(), f"msg-worker-{worker}")
+        cumulus.register_shutdown_handler(self._shutdown)
+
+    @property
+    def queued(self) -> int:
+        """
+        Number of messages waiting for processing.
+        """
+        return self._queued
+
+    def submit(self, message: Message) -> bool:
+        """
+        Queue message for processing.
+
+        :returns: `False` when message was dropped because the queue is full
+        """
+        if self._queued >= self._max_queued:
+            _LOGGER.warning("Drop message type=%s, %d messages are waiting", message.type, self._queued)
+            self._dropped.inc(type=message.type)
+            return False
+
+        self._queued += 1
+        key = message.ordering_key
+        if (lane := self._lanes.get(key)) is not None:
+            # Key is already processed or waiting for worker
+            lane.append((message, time.monotonic()))
+        else:
+            self._lanes[key] = collections.deque([(message, time.monotonic())])
+            self._ready.put_nowait(key)
+        return True
+
+    async def _work(self) -> None:
+        """
+        Process messages of ready keys until shutdown.
+        """
+        while (key := await self._ready.get()) is not None:
+            lane = self._lanes[key]
+            message, queued_at = lane.popleft()
+            self._queued -= 1
+            self._queue_time.observe(time.monotonic() - queued_at, type=message.type)
+
+            try:
+                with self._processing_time.time(type=message.type):
+                    await message.process(self._cumulus)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Processing of message type=%s failed", message.type)
+            finally:
+                if lane:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._lanes[key]
+
+    def _setup_metrics(self, metrics: 'MetricsRegistry') -> None:
+        """
+        Register metrics of the dispatcher.
+        """
+        self._processing_time = metrics.histogram(
+            "cumulus_message_processing_seconds", "Time spent processing received message", ["type"])
+        self._queue_time = metrics.histogram(
+            "cumulus_message_queue_seconds", "Time received message waited for processing", ["type"])
+        self._dropped = metrics.counter(
+            "cumulus_messages_dropped_total", "Received messages dropped because of full queue", ["type"])
+        metrics.gauge("cumulus_message_queue_depth", "Received messages waiting for processing",
+                      callback=lambda: self._queued)
+
+    def _shutdown(self) -> None:
+        for _ in range(self._workers):
+            self._ready.put_nowait(None)
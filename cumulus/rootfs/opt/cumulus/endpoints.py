@@ -0,0 +1,259 @@
+"""Connection to the fastest of server endpoints, attempts race like happy eyeballs (RFC 8305)."""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Sequence, TypeVar
+
+import websockets
+from websockets import WebSocketClientProtocol
+from websockets.uri import parse_uri
+
+_LOGGER = logging.getLogger(__name__)
+_T = TypeVar("_T")
+# Delay before the next attempt starts when the cached winner does not connect (RFC 8305)
+_ATTEMPT_DELAY = 0.25
+# Seconds for which the winner is tried first, the race of all endpoints is repeated after it
+_CACHE_TTL = 3600
+# Seconds to wait for TCP connection of ssh tunnel
+_CONNECT_TIMEOUT = 10
+_CONNECT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class EndpointCache:
+    """
+    Winners of connection races with time of expiration.
+
+    Methods do file I/O, run them in executor.
+    """
+
+    def __init__(self, path: Path, ttl: float) -> None:
+        """
+        Init cache.
+
+        :param path: state file
+        :param ttl: seconds for which the winner is valid
+        """
+        self._path = path
+        self._ttl = ttl
+
+    def load(self, key: str) -> str | None:
+        """
+        Get winner of race `key` or `None` when there is none or it expired.
+        """
+        entry = self._read().get(key)
+        if not isinstance(entry, dict) or entry.get("expires", 0) < time.time():
+            return None
+        return entry.get("endpoint")
+
+    def save(self, key: str, endpoint: str) -> None:
+        """
+        Store winner of race `key`.
+        """
+        state = self._read()
+        state[key] = {"endpoint": endpoint, "expires": time.time() + self._ttl}
+        tmp_path = self._path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as state_file:
+                json.dump(state, state_file)
+            os.replace(tmp_path, self._path)
+        except OSError as err:
+            _LOGGER.warning("Unable to store endpoint file %s: %s", self._path, err)
+
+    def _read(self) -> dict[str, Any]:
+        try:
+            with open(self._path, "r", encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            _LOGGER.warning("Ignore invalid endpoint file %s: %s", self._path, err)
+            return {}
+        return state if isinstance(state, dict) else {}
+
+
+class EndpointSelector:
+    """
+    Connect to server endpoints by racing connections to all their addresses.
+
+    Without cached winner all attempts start at once, so the endpoint with the lowest
+    round trip time wins. The cached winner is tried first and the other attempts start
+    only when it does not connect within attempt delay.
+    """
+
+    def __init__(self, cumulus: 'Cumulus') -> None:
+        """
+        Init selector.
+        """
+        self._cumulus = cumulus
+        self._cache = EndpointCache(cumulus.config.config_dir / "endpoints.json", _CACHE_TTL)
+        self._connect_time = cumulus.metrics.histogram(
+            "cumulus_endpoint_connect_seconds", "Connection time of the winner of endpoint race",
+            ["target", "family"], buckets=_CONNECT_BUCKETS)
+
+    async def connect_websocket(self, urls: Sequence[str], **kwargs: Any) -> WebSocketClientProtocol:
+        """
+        Open websocket to the fastest address of `urls`.
+
+        :param kwargs: arguments of `websockets.connect`
+        :raises OSError: when no address is resolved
+        :raises websockets.InvalidHandshake: when the last attempt failed on handshake
+        """
+        candidates: list[tuple[str, Callable[[], Awaitable[WebSocketClientProtocol]]]] = []
+        for url, addresses in zip(urls, await asyncio.gather(*(_resolve_url(url) for url in urls))):
+            uri = parse_uri(url)
+            options = {**kwargs, "port": uri.port}
+            if uri.secure:
+                # Certificate is verified for the host name, connection is opened to its address
+                options["server_hostname"] = uri.host
+            candidates.extend(
+                (f"{url} {address}", lambda url=url, address=address, options=options: websockets.connect(
+                    url, host=address, **options))
+                for address in addresses
+            )
+
+        def discard(websocket: WebSocketClientProtocol) -> None:
+            asyncio.ensure_future(websocket.close())
+
+        return await self._race("server", candidates, discard)
+
+    async def connect_socket(self, host: str, port: int) -> socket.socket:
+        """
+        Open TCP connection to the fastest address of `host`, IPv4 and IPv6 addresses race.
+
+        :raises OSError: when connection to all addresses failed
+        """
+        candidates = [
+            (address, lambda address=address: _open_socket(address, port))
+            for address in await _resolve(host, port)
+        ]
+        return await self._race(f"ssh {host}:{port}", candidates, socket.socket.close)
+
+    async def select_family(self, host: str, port: int) -> socket.AddressFamily | None:
+        """
+        Get address family of the fastest address of `host`.
+
+        The family of the cached winner is returned without connecting, the race of
+        `connect_socket` runs only when the winner is not known or it expired.
+
+        :returns: `None` when the host has addresses of one family only
+        :raises OSError: when the host is not resolved or connection to all addresses failed
+        """
+        addresses = await _resolve(host, port)
+        if len({":" in address for address in addresses}) < 2:
+            return None
+        address = await self._cumulus.run_in_executor(self._cache.load, f"ssh {host}:{port}")
+        if address not in addresses:
+            sock = await self.connect_socket(host, port)
+            address = sock.getpeername()[0]
+            sock.close()
+        return socket.AF_INET6 if ":" in address else socket.AF_INET
+
+    async def _race(
+        self,
+        key: str,
+        candidates: list[tuple[str, Callable[[], Awaitable[_T]]]],
+        discard: Callable[[_T], None],
+    ) -> _T:
+        if not candidates:
+            raise OSError(f"No address of {key}")
+
+        cached = await self._cumulus.run_in_executor(self._cache.load, key) if len(candidates) > 1 else None
+        names = [name for name, _ in candidates]
+        delay = 0.0
+        if cached in names:
+            index = names.index(cached)
+            candidates.insert(0, candidates.pop(index))
+            delay = _ATTEMPT_DELAY
+
+        start = time.monotonic()
+        index, result = await race([attempt for _, attempt in candidates], delay, discard)
+        connect_time = time.monotonic() - start
+        name = candidates[index][0]
+        family = "ipv6" if ":" in name.rsplit(" ", 1)[-1] else "ipv4"
+        self._connect_time.observe(connect_time, target=key.split(" ", 1)[0], family=family)
+        _LOGGER.debug("Connected to %s in %.1fms (%d candidates)", name, connect_time * 1000, len(candidates))
+        if len(candidates) > 1 and name != cached:
+            await self._cumulus.run_in_executor(self._cache.save, key, name)
+        return result
+
+
+async def race(
+    attempts: Sequence[Callable[[], Awaitable[_T]]],
+    delay: float,
+    discard: Callable[[_T], None],
+) -> tuple[int, _T]:
+    """
+    Run attempts, the next one starts after `delay` or right when the previous one failed.
+
+    :param discard: closes result of attempt which succeeded after the winner
+    :returns: index and result of the first successful attempt
+    :raises Exception: error of the last failed attempt when all of them failed
+    """
+    tasks: dict[asyncio.Future[_T], int] = {}
+    error: BaseException | None = None
+    started = 0
+    try:
+        while tasks or started < len(attempts):
+            if started < len(attempts):
+                tasks[asyncio.ensure_future(attempts[started]())] = started
+                started += 1
+            timeout = delay if started < len(attempts) else None
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            winner: tuple[int, _T] | None = None
+            for task in done:
+                index = tasks.pop(task)
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = index, task.result()
+                else:
+                    discard(task.result())
+            if winner is not None:
+                return winner
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+            task.add_done_callback(
+                lambda task: discard(task.result()) if not task.cancelled() and task.exception() is None else None)
+
+
+async def _resolve(host: str, port: int) -> list[str]:
+    """
+    Get addresses of host, IPv6 and IPv4 addresses alternate starting with the family preferred by resolver.
+    """
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    by_family: dict[int, list[str]] = {}
+    for family, _, _, _, sockaddr in infos:
+        addresses = by_family.setdefault(family, [])
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return [address for address in itertools.chain(*itertools.zip_longest(*by_family.values())) if address]
+
+
+async def _resolve_url(url: str) -> list[str]:
+    uri = parse_uri(url)
+    try:
+        return await _resolve(uri.host, uri.port)
+    except OSError as err:
+        _LOGGER.warning("Unable to resolve server %s: %s", uri.host, err)
+        return []
+
+
+async def _open_socket(address: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in address else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, (address, port)), _CONNECT_TIMEOUT)
+    except asyncio.TimeoutError as err:
+        sock.close()
+        raise OSError(f"Connection to {address} timed out") from err
+    except BaseException:
+        sock.close()
+        raise
+    return sock
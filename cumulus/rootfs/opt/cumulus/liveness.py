@@ -0,0 +1,68 @@
+"""Liveness probing of server connection."""
+import asyncio
+import logging
+import time
+
+import websockets
+from websockets import WebSocketClientProtocol
+
+from cumulus.stats import RollingHistogram
+
+_LOGGER = logging.getLogger(__name__)
+# Close code used by websockets library for keepalive timeout
+_CLOSE_INTERNAL_ERROR = 1011
+
+
+class LivenessMonitor:
+    """
+    Send pings over websocket, record round trip time and fail dead connection.
+
+    Pong which doesn't arrive until next ping counts as missed. The connection is
+    failed after `max_missed` pings in row, which makes the messaging service reconnect.
+    """
+
+    def __init__(self, interval: float, max_missed: int) -> None:
+        """
+        Init monitor.
+
+        :param interval: seconds between pings
+        :param max_missed: number of missed pongs after which the connection is dead
+        """
+        self._interval = interval
+        self._max_missed = max_missed
+        self.rtt = RollingHistogram()
+        self.missed = 0
+        self.dead_connections = 0
+
+    async def run(self, websocket: WebSocketClientProtocol) -> None:
+        """
+        Probe the connection until it's closed.
+        """
+        missed = 0
+        while websocket.open:
+            await asyncio.sleep(self._interval)
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(LivenessMonitor._ping(websocket), self._interval)
+            except websockets.ConnectionClosed:
+                return
+            except asyncio.TimeoutError:
+                missed += 1
+                self.missed += 1
+                _LOGGER.warning("Server did not answer ping (%d/%d)", missed, self._max_missed)
+                if missed >= self._max_missed:
+                    _LOGGER.error("Server connection is dead")
+                    self.dead_connections += 1
+                    websocket.fail_connection(_CLOSE_INTERNAL_ERROR, "keepalive ping timeout")
+                    return
+                continue
+
+            missed = 0
+            rtt = time.monotonic() - start
+            self.rtt.add(rtt)
+            _LOGGER.debug("Server ping rtt=%.1fms", rtt * 1000)
+
+    @staticmethod
+    async def _ping(websocket: WebSocketClientProtocol) -> None:
+        pong_waiter = await websocket.ping()
+        await pong_waiter
@@ -0,0 +1,120 @@
+"""Logging of Cumulus, records are formatted and written by background thread."""
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+from cumulus.utils import RateLimiter
+
+_LOGGER = logging.getLogger(__name__)
+_FORMAT = "%(asctime)s %(levelname)5s %(name)s:%(lineno)s %(instance)s%(message)s"
+# Name of client instance in fleet mode, set in context of all tasks of the instance
+INSTANCE: contextvars.ContextVar[str | None] = contextvars.ContextVar("instance", default=None)
+# Logger name prefix to rate (records per second) and burst of debug and info records
+_RATE_LIMITS: dict[str, tuple[float, int]] = {
+    # Every forwarded connection and channel in the in-process tunnel
+    "asyncssh": (20, 200),
+    # Every frame of control channel and websocket clients
+    "websockets": (20, 200),
+}
+# Seconds between reports of dropped records of one logger
+_REPORT_INTERVAL = 10
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queue handler passing records unformatted, so formatting is done by the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Message is formatted later by the listener thread, so arguments must not be changed after logging
+        return record
+
+
+class _InstanceFilter(logging.Filter):
+    """Add name of client instance which logged the record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        instance = INSTANCE.get()
+        record.instance = f"[{instance}] " if instance is not None else ""
+        return True
+
+
+class _RateLimitFilter(logging.Filter):
+    """
+    Drop debug and info records of noisy loggers exceeding their rate.
+
+    Warnings and errors are never dropped. Number of dropped records is logged
+    when the logger is allowed to log again, at most once per report interval.
+    """
+
+    def __init__(self, limits: dict[str, tuple[float, int]]) -> None:
+        super().__init__()
+        self._limiters = {prefix: RateLimiter(rate, burst) for prefix, (rate, burst) in limits.items()}
+        # Logger name to its prefix, `None` for loggers without limit
+        self._prefixes: dict[str, str | None] = {}
+        self._reported: dict[str, float] = {}
+
+    def add(self, prefix: str, rate: float, burst: int) -> None:
+        self._limiters[prefix] = RateLimiter(rate, burst)
+        self._prefixes.clear()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        if (prefix := self._prefix(record.name)) is None:
+            return True
+
+        limiter = self._limiters[prefix]
+        if not limiter.allow():
+            return False
+        if limiter.suppressed and (now := time.monotonic()) - self._reported.get(prefix, 0) >= _REPORT_INTERVAL:
+            self._reported[prefix] = now
+            _LOGGER.warning("Suppressed %d log records of %s", limiter.take_suppressed(), prefix)
+        return True
+
+    def _prefix(self, name: str) -> str | None:
+        try:
+            return self._prefixes[name]
+        except KeyError:
+            pass
+
+        # The most specific prefix wins
+        matching = [prefix for prefix in self._limiters if name == prefix or name.startswith(f"{prefix}.")]
+        prefix = self._prefixes[name] = max(matching, key=len, default=None)
+        return prefix
+
+
+_RATE_LIMIT_FILTER = _RateLimitFilter(_RATE_LIMITS)
+
+
+def rate_limit(name: str, rate: float, burst: int) -> None:
+    """
+    Limit debug and info records of logger `name` and its children.
+
+    :param rate: allowed records per second
+    :param burst: allowed records at once
+    """
+    _RATE_LIMIT_FILTER.add(name, rate, burst)
+
+
+def setup_logging(level: str) -> None:
+    """
+    Log to stdout by background thread, so logging does not block the event loop.
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(_FORMAT))
+    records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, stream_handler)
+
+    handler = _QueueHandler(records)
+    handler.addFilter(_RATE_LIMIT_FILTER)
+    handler.addFilter(_InstanceFilter())
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    root.addHandler(handler)
+
+    listener.start()
+    # Queued records are written before exit
+    atexit.register(listener.stop)
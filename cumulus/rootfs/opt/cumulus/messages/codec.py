@@ -0,0 +1,112 @@
+"""Encoding and decoding of websocket messages."""
+import json
+import logging
+from types import NoneType
+from typing import Any, Callable, TypeVar
+
+from .message import Message, NoOperationMessage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_LOGGER = logging.getLogger(__name__)
+_M = TypeVar("_M", bound=type[Message])
+
+# Server message type to message class and its fields (name, accepted types, required)
+_REGISTRY: dict[str, tuple[type[Message], tuple[tuple[str, tuple[type, ...], bool], ...]]] = {}
+
+json_loads: Callable[[str | bytes], Any]
+json_dumps: Callable[[Any], str]
+
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+    json_loads = orjson.loads
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+else:
+    JSON_BACKEND = "json"
+    json_loads = json.loads
+    json_dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+class MessageError(ValueError):
+    """Received message is not valid."""
+
+
+def register_message(cls: _M) -> _M:
+    """
+    Register server message class for its `type`. Used as class decorator.
+    """
+    if cls.type in _REGISTRY:
+        raise ValueError(f"Message type {cls.type} is already registered by {_REGISTRY[cls.type][0].__name__}")
+    fields = tuple((name, types, NoneType not in types) for name, types in cls.schema.items())
+    _REGISTRY[cls.type] = (cls, fields)
+    return cls
+
+
+def decode_message(data: str | bytes) -> Message:
+    """
+    Parse and validate message received from server.
+
+    Unknown message types are decoded to `NoOperationMessage`.
+
+    :raises MessageError: when message is not valid JSON or does not match schema of its type
+    """
+    try:
+        fields = json_loads(data)
+    except ValueError as err:
+        raise MessageError(f"Invalid JSON: {err}") from err
+
+    if not isinstance(fields, dict):
+        raise MessageError("Message is not JSON object")
+
+    msg_type = fields.get("type")
+    if not isinstance(msg_type, str):
+        raise MessageError("Message has no type")
+
+    if (registered := _REGISTRY.get(msg_type)) is None:
+        _LOGGER.warning("Ignore unknown message=%s", data)
+        return NoOperationMessage(msg_type)
+
+    cls, schema = registered
+    message = cls.__new__(cls)
+    for name, types, required in schema:
+        value = fields.get(name)
+        if value is None:
+            if required:
+                raise MessageError(f"Message {msg_type} is missing field '{name}'")
+        elif not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            value = _coerce(msg_type, name, value, types)
+        setattr(message, name, value)
+
+    message.validate()
+    return message
+
+
+def _coerce(msg_type: str, name: str, value: Any, types: tuple[type, ...]) -> Any:
+    """
+    Convert scalar value to type of the field, e.g. port sent as string.
+
+    Booleans are never converted, they are not numbers in messages.
+
+    :raises MessageError: when value can't be converted
+    """
+    if not isinstance(value, bool):
+        if int in types:
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+            if isinstance(value, str) and value.strip().isdigit():
+                return int(value)
+        if str in types and isinstance(value, (int, float)):
+            return str(value)
+    raise MessageError(f"Field '{name}' of message {msg_type} has invalid type {type(value).__name__}")
+
+
+def encode_message(message: Message) -> str:
+    """
+    Serialize message to JSON.
+    """
+    return json_dumps(message.to_dict())
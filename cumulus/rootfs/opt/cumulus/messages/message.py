@@ -1,14 +1,60 @@
 """Common messages implementations."""
 from abc import ABC, abstractmethod
+from typing import Any, ClassVar
+
 
 class Message(ABC):
+    """
+    Base of all messages.
+
+    Messages received from server declare their fields in `schema`, messages sent
+    to server serialize all fields from `__slots__`.
+    """
+
+    __slots__ = ()
+    type: str
+    # Field name to accepted types of server message, `NoneType` marks optional field
+    schema: ClassVar[dict[str, tuple[type, ...]]] = {}
+    # All slots of the class hierarchy, filled for every subclass
+    fields: ClassVar[tuple[str, ...]] = ()
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls.fields = cls.fields + tuple(name for name in cls.__dict__.get("__slots__", ()) if name != "type")
+
+    @property
+    def ordering_key(self) -> str:
+        """
+        Messages with the same key are processed in order of arrival.
+        """
+        return self.type
+
     @abstractmethod
     async def process(self, cumulus: 'Cumulus') -> None:
         pass
 
+    def validate(self) -> None:
+        """
+        Check values of decoded fields, which are not covered by `schema`.
+
+        :raises MessageError: when message is not valid
+        """
+        pass
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Get fields of message for serialization.
+        """
+        return {"type": self.type, **{name: getattr(self, name) for name in self.fields}}
+
 
 class NoOperationMessage(Message):
     """Just do nothing."""
 
+    __slots__ = ("type",)
+
+    def __init__(self, msg_type: str) -> None:
+        self.type = msg_type
+
     async def process(self, cumulus: 'Cumulus') -> None:
         pass
@@ -1,20 +1,18 @@
 """Client messages."""
-import dataclasses
-import json
 import uuid
-from json import JSONEncoder
 
 from cumulus.const import MSG_TYPE
+from .codec import encode_message
 from .message import Message
 
 
-class ClientMessage(Message, JSONEncoder):
-    id: str
-    type: str
+class ClientMessage(Message):
+    """Message sent to server."""
 
-    def __init__(self, msg_type: str):
+    __slots__ = ("id",)
+
+    def __init__(self):
         self.id = uuid.uuid4().hex[0:6]
-        self.type = msg_type
 
     async def process(self, cumulus: 'Cumulus') -> None:
         """
@@ -23,14 +21,17 @@ class ClientMessage(Message, JSONEncoder):
         pass
 
     def to_json(self) -> str:
-        return json.dumps(self, default=lambda o: o.__dict__)
+        return encode_message(self)
 
 
 class AuthMessage(ClientMessage):
     """Authorization client message."""
 
+    __slots__ = ("key", "signature", "client_version")
+    type = MSG_TYPE.CLIENT_AUTH
+
     def __init__(self, key: str, signature: str, version: str):
-        super().__init__(MSG_TYPE.CLIENT_AUTH)
+        super().__init__()
         self.key = key
         self.signature = signature
         self.client_version = version
@@ -39,13 +40,16 @@ class AuthMessage(ClientMessage):
 class SetSSHKey(ClientMessage):
     """Set ssh client public key."""
 
+    __slots__ = ("key",)
+    type = MSG_TYPE.SET_SSH_KEY
+
     def __init__(self, key: str):
-        super().__init__(MSG_TYPE.SET_SSH_KEY)
+        super().__init__()
         self.key = key
 
 
 class RefreshStatus(ClientMessage):
     """Invoke refresh instance status."""
 
-    def __init__(self):
-        super().__init__(MSG_TYPE.REFRESH_STATUS)
\ No newline at end of file
+    __slots__ = ()
+    type = MSG_TYPE.REFRESH_STATUS
@@ -0,0 +1,24 @@
+"""Handle error responses."""
+import logging
+from types import NoneType
+
+from cumulus.const import MSG_TYPE
+from .codec import register_message
+from .message import Message
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@register_message
+class ErrorMessage(Message):
+    """Server response to a client message which failed."""
+
+    __slots__ = ("id", "error")
+    type = MSG_TYPE.ERROR
+    schema = {
+        "id": (str, NoneType),
+        "error": (str, dict, list, NoneType),
+    }
+
+    async def process(self, cumulus: 'Cumulus') -> None:
+        _LOGGER.warning("Response msg_id=%s error=%s", self.id, self.error)
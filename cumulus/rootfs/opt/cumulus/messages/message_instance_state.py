@@ -1,39 +1,49 @@
 """Handle client states."""
 import logging
-from types import SimpleNamespace
+from types import NoneType
 
+from cumulus.const import MSG_TYPE
+from .codec import MessageError, register_message
 from .message import Message
 from .message_client import SetSSHKey
 
 _LOGGER = logging.getLogger(__name__)
 
+
+@register_message
 class InstanceStateMessage(Message):
     """Message with client instance state registered on server."""
-    
-    _state: str
-    _parameters: SimpleNamespace
-    
-    def __init__(self, msg: SimpleNamespace) -> None:
-        """
-        Create message with `parameters`.
-        """
-        self._state = msg.state
-        self._parameters = msg
+
+    __slots__ = ("state", "host", "user", "port", "forwarding_port")
+    type = MSG_TYPE.INSTANCE_STATE
+    schema = {
+        "state": (str,),
+        "host": (str, NoneType),
+        "user": (str, NoneType),
+        "port": (int, NoneType),
+        "forwarding_port": (int, NoneType),
+    }
+
+    def validate(self) -> None:
+        if self.state == "ready":
+            missing = [name for name in ("host", "user", "port", "forwarding_port") if getattr(self, name) is None]
+            if missing:
+                raise MessageError(f"Message {self.type} in state ready is missing fields {missing}")
 
     async def process(self, cumulus: 'Cumulus') -> None:
-        _LOGGER.debug(f"Process instance_state message with params={self._parameters}")
-        
-        match self._state:
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Process instance_state message with params=%s", self.to_dict())
+
+        if self.state not in ("ready", "wait_for_key"):
+            await cumulus.tunnel.close_speculative()
+
+        match self.state:
             case "registered":
-                _LOGGER.debug("Instance state is %s", self._state)
+                _LOGGER.debug("Instance state is %s", self.state)
             case "wait_for_key":
-                public_key = cumulus.tunnel.init_ssh_keys()
+                public_key = await cumulus.run_in_executor(cumulus.tunnel.init_ssh_keys)
                 await cumulus.msg.send(SetSSHKey(public_key))
             case "ready":
-                user = self._parameters.user
-                port = self._parameters.port
-                host = self._parameters.host
-                forwarding_port = self._parameters.forwarding_port
-                cumulus.tunnel.open(host, user, port, forwarding_port)
+                cumulus.tunnel.open(self.host, self.user, self.port, self.forwarding_port)
             case _:
-                _LOGGER.error("I don't know how to handle state=", self._state)
\ No newline at end of file
+                _LOGGER.error("I don't know how to handle state=%s", self.state)
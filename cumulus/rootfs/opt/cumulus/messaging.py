@@ -1,16 +1,21 @@
 """Handle server communication."""
 import asyncio
 import logging
+import time
 
 import websockets
 
 from urllib.parse import urljoin
 from websockets import WebSocketClientProtocol
-from cumulus.messages import parse_message
+from cumulus.dispatch import MessageDispatcher
+from cumulus.messages import MessageError, decode_message
 from cumulus.messages.message_client import AuthMessage, ClientMessage, RefreshStatus
+from cumulus.liveness import LivenessMonitor
+from cumulus.reconnect import create_reconnect_scheduler
 
 _LOGGER = logging.getLogger(__name__)
-_RECONNECT_DELAY = 30*60 # 30 min
+_MESSAGE_WORKERS = 4
+_MAX_QUEUED_MESSAGES = 64
 
 
 class MessagingService:
@@ -22,68 +27,156 @@ class MessagingService:
         """
         self._cumulus = cumulus
         self._websocket: WebSocketClientProtocol | None = None
+        self._closing = False
+        self._auth_signature: str | None = None
+        # Set until the answer to authentication is received, marks end of start phase
+        self._auth_sent = False
+        self.reconnect = create_reconnect_scheduler(cumulus.config)
+        self.liveness: LivenessMonitor | None = None
+        if cumulus.config.ping_interval > 0:
+            self.liveness = LivenessMonitor(cumulus.config.ping_interval, cumulus.config.ping_max_missed)
+        self.dispatcher = MessageDispatcher(cumulus, _MESSAGE_WORKERS, _MAX_QUEUED_MESSAGES)
+        self._setup_metrics(cumulus.metrics)
         cumulus.register_shutdown_handler(self._shutdown)
 
     async def run(self) -> None:
         """
         Connect to server websocket and handle communication.
         """
-        url = urljoin(self._cumulus.config.server_url, "/tun")
-
-        async with websockets.connect(url, logger=_LOGGER, ping_interval=None) as websocket:
-            try:
-                self._websocket = websocket
-                await self._send_auth_msg()
-
-                async for message in self._websocket:
-                    await self._on_message(message)
-
-            except websockets.ConnectionClosed as err:
-                _LOGGER.info("Connection closed code=%d reason=%s", err.code, err.reason)
-                self._cumulus.create_task(self._reconnect_later())
-            except asyncio.CancelledError:
-                await websocket.close()
-            finally:
-                self._websocket = None
-                _LOGGER.info("Connection finished")
+        urls = [urljoin(server_url, "/tun") for server_url in self._cumulus.config.server_urls]
+        # Sign in executor while connecting
+        signature = asyncio.ensure_future(self._sign_auth())
+
+        try:
+            websocket = await self._cumulus.endpoints.connect_websocket(urls, logger=_LOGGER, ping_interval=None)
+        except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake) as err:
+            _LOGGER.warning("Unable to connect to server: %s", err)
+            self._reconnect_later(self.reconnect.disconnected(None))
+            await signature
+            return
+
+        try:
+            self._cumulus.mark_startup("websocket connect")
+            self._websocket = websocket
+            self.reconnect.connected()
+            if self.liveness is not None:
+                self._cumulus.create_task(self.liveness.run(websocket), "msg-liveness")
+            await self._send_auth_msg(await signature)
+
+            async for message in self._websocket:
+                self._on_message(message)
+
+            if not self._closing:
+                # Server closed connection normally
+                _LOGGER.info("Connection closed code=%d reason=%s", websocket.close_code, websocket.close_reason)
+                self._reconnect_later(self.reconnect.disconnected(websocket.close_code, websocket.close_reason))
+        except websockets.ConnectionClosed as err:
+            _LOGGER.info("Connection closed code=%d reason=%s", err.code, err.reason)
+            self._reconnect_later(self.reconnect.disconnected(err.code, err.reason))
+        except asyncio.CancelledError:
+            await websocket.close()
+        finally:
+            self._websocket = None
+            await websocket.close()
+            _LOGGER.info("Connection finished")
 
     async def send(self, message: ClientMessage) -> None:
         """
         Send message to server.
         """
+        if self._websocket is None:
+            _LOGGER.warning("Drop message type=%s msg_id=%s, server is not connected", message.type, message.id)
+            return
+
         _LOGGER.info("Send message type=%s msg_id=%s", message.type, message.id)
         await self._websocket.send(message.to_json())
+        self._messages_sent.inc(type=message.type)
 
     async def _shutdown(self) -> None:
         """
         hutdown ws connection.
         """
+        self._closing = True
         if self._websocket:
             _LOGGER.debug("Close web-socket connecton")
             await self._websocket.close()
 
-    async def _on_message(self, message: str) -> None:
+    def _on_message(self, message: str) -> None:
         """
-        Parse incoming message and call process on it.
+        Parse incoming message and pass it for processing.
         """
-        _LOGGER.debug(f"WS text={message}")
-        msg = parse_message(message)
-        await msg.process(self._cumulus)
-
-    async def _send_auth_msg(self) -> None:
+        _LOGGER.debug("WS text=%s", message)
+        if self._auth_sent:
+            # The first message after authentication is its answer
+            self._auth_sent = False
+            self._cumulus.mark_startup("auth round trip")
+        try:
+            msg = decode_message(message)
+        except MessageError as err:
+            _LOGGER.warning("Ignore invalid message: %s", err)
+            self._messages_received.inc(type="invalid")
+            return
+
+        self._messages_received.inc(type=msg.type)
+        self.dispatcher.submit(msg)
+
+    def _setup_metrics(self, metrics: 'MetricsRegistry') -> None:
+        """
+        Register metrics of the service.
+        """
+        self._messages_sent = metrics.counter(
+            "cumulus_messages_sent_total", "Messages sent to server", ["type"])
+        self._messages_received = metrics.counter(
+            "cumulus_messages_received_total", "Messages received from server", ["type"])
+        metrics.gauge(
+            "cumulus_server_connected", "Server connection is open",
+            callback=lambda: 1 if self._websocket is not None else 0)
+        metrics.counter(
+            "cumulus_reconnects_total", "Attempts to reconnect to server",
+            callback=lambda: self.reconnect.total_attempts)
+        metrics.counter(
+            "cumulus_server_downtime_seconds_total", "Time without server connection",
+            callback=lambda: self.reconnect.total_downtime)
+
+        if self.liveness is not None:
+            metrics.summary("cumulus_server_rtt_seconds", "Server ping round trip time", self.liveness.rtt)
+            metrics.counter(
+                "cumulus_server_missed_pings_total", "Pings not answered by server",
+                callback=lambda: self.liveness.missed)
+            metrics.counter(
+                "cumulus_server_dead_connections_total", "Connections failed by liveness check",
+                callback=lambda: self.liveness.dead_connections)
+
+    async def _sign_auth(self) -> str:
+        """
+        Get signature of client id for authentication. Signature is computed only once.
+        """
+        if self._auth_signature is None:
+            config = self._cumulus.config
+            # Runs while the websocket connects
+            started = time.perf_counter()
+            self._auth_signature = await self._cumulus.run_in_executor(config.sign_data, config.client_id)
+            self._cumulus.mark_startup("key decode", started)
+        return self._auth_signature
+
+    async def _send_auth_msg(self, signature: str) -> None:
         """
         Send authentication message.
         """
         key = self._cumulus.config.client_id
-        sign = self._cumulus.config.sign_data(key)
         version = self._cumulus.config.version
 
-        await self.send(AuthMessage(key, sign, version))
+        self._auth_sent = True
+        await self.send(AuthMessage(key, signature, version))
 
-    async def _reconnect_later(self) -> None:
+    def _reconnect_later(self, delay: float) -> None:
         """
         Reconnect to server after delay.
         """
-        await asyncio.sleep(_RECONNECT_DELAY)
+        _LOGGER.info("Reconnect in %.1fs (attempt %d)", delay, self.reconnect.attempts)
+        self._cumulus.create_task(self._reconnect(delay), "msg-reconnect")
+
+    async def _reconnect(self, delay: float) -> None:
+        await asyncio.sleep(delay)
         _LOGGER.debug("Reconnect")
-        self._cumulus.create_task(self.run())
\ No newline at end of file
+        self._cumulus.create_task(self.run(), "msg-service")
\ No newline at end of file
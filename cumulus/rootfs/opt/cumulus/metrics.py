@@ -0,0 +1,309 @@
+"""Metrics in Prometheus text format."""
+import asyncio
+import bisect
+from abc import ABC, abstractmethod
+import contextlib
+import logging
+import time
+from typing import Callable, Iterable, Iterator
+
+from cumulus.stats import RollingHistogram
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = tuple[str, ...]
+Sample = tuple[str, dict[str, str], float]
+# Callback returns single value or pairs of label values and value
+MetricCallback = Callable[[], float | Iterable[tuple[LabelValues, float]]]
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items()) + "}"
+
+
+class Metric(ABC):
+    """Base of all metric types."""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _label_values(self, labels: dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} requires labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, values: LabelValues) -> dict[str, str]:
+        return dict(zip(self.labelnames, values))
+
+    @abstractmethod
+    def samples(self) -> Iterator[Sample]:
+        """
+        Get all samples of the metric.
+        """
+        pass
+
+    def expose(self) -> str:
+        return _expose_family([(self, {})])
+
+
+class _ValueMetric(Metric):
+    """Metric holding a single value per label set."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        callback: MetricCallback | None = None,
+    ) -> None:
+        """
+        Init metric.
+
+        :param callback: function which provides values at collection time
+        """
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[LabelValues, float] = {}
+        self._callback = callback
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._label_values(labels), 0.0)
+
+    def samples(self) -> Iterator[Sample]:
+        if self._callback is not None:
+            values = self._callback()
+            if isinstance(values, (int, float)):
+                values = [((), values)]
+            for label_values, value in values:
+                yield self.name, self._labels(label_values), value
+            return
+
+        for label_values, value in self._values.items():
+            yield self.name, self._labels(label_values), value
+
+
+class Counter(_ValueMetric):
+    """Monotonically increasing value."""
+
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_ValueMetric):
+    """Value which can go up and down."""
+
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._label_values(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Distribution of observed values in buckets."""
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        if key not in self._counts:
+            self._counts[key] = [0] * len(self._buckets)
+            self._sums[key] = 0.0
+
+        self._counts[key][bisect.bisect_left(self._buckets, value)] += 1
+        self._sums[key] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Observe duration of the block in seconds.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self) -> Iterator[Sample]:
+        for label_values, counts in self._counts.items():
+            labels = self._labels(label_values)
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, self._sums[label_values]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Summary(Metric):
+    """Quantiles of rolling window of samples."""
+
+    metric_type = "summary"
+
+    def __init__(self, name: str, documentation: str, histogram: RollingHistogram) -> None:
+        super().__init__(name, documentation)
+        self._histogram = histogram
+
+    def samples(self) -> Iterator[Sample]:
+        for quantile in (0.5, 0.95, 0.99):
+            value = self._histogram.percentile(quantile * 100)
+            if value is not None:
+                yield self.name, {"quantile": str(quantile)}, value
+        yield f"{self.name}_sum", {}, self._histogram.sum
+        yield f"{self.name}_count", {}, self._histogram.count
+
+
+def _expose_family(family: list[tuple[Metric, dict[str, str]]]) -> str:
+    """
+    Render metrics of the same name with their extra labels, they are exposed as one metric.
+    """
+    first = family[0][0]
+    lines = [
+        f"# HELP {first.name} {first.documentation}",
+        f"# TYPE {first.name} {first.metric_type}",
+    ]
+    for metric, extra_labels in family:
+        lines.extend(
+            f"{name}{_format_labels({**extra_labels, **labels})} {_format_value(value)}"
+            for name, labels, value in metric.samples()
+        )
+    return "\n".join(lines)
+
+
+class MetricsRegistry:
+    """Collection of all add-on metrics."""
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        # Registries of client instances with labels added to their samples
+        self._children: dict[str, tuple[MetricsRegistry, dict[str, str]]] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Register metric. Metric with the same name replaces the previous one.
+        """
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = (), **kwargs) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, **kwargs))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (), **kwargs) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, **kwargs))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), **kwargs) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, **kwargs))
+
+    def summary(self, name: str, documentation: str, histogram: RollingHistogram) -> Summary:
+        return self.register(Summary(name, documentation, histogram))
+
+    def child(self, key: str, **labels: str) -> 'MetricsRegistry':
+        """
+        Create registry exposed together with this one, its samples get `labels`.
+
+        Registry of the same key is replaced, so metrics of restarted instance start from zero.
+        """
+        registry = MetricsRegistry()
+        self._children[key] = (registry, labels)
+        return registry
+
+    def expose(self) -> str:
+        """
+        Render all metrics in Prometheus text format.
+        """
+        families: dict[str, list[tuple[Metric, dict[str, str]]]] = {}
+        for registry, labels in ((self, {}), *self._children.values()):
+            for metric in registry._metrics.values():
+                families.setdefault(metric.name, []).append((metric, labels))
+        return "\n".join(_expose_family(family) for family in families.values()) + "\n"
+
+
+class MetricsService:
+    """HTTP endpoint serving metrics."""
+
+    def __init__(self, cumulus: 'Fleet', address: str, port: int) -> None:
+        """
+        Init service.
+
+        :param address: listen address, all interfaces when empty
+        """
+        self._cumulus = cumulus
+        self._address = address or None
+        self._port = port
+        self._server: asyncio.AbstractServer | None = None
+        cumulus.register_shutdown_handler(self._shutdown)
+
+    async def run(self) -> None:
+        """
+        Start HTTP server.
+        """
+        self._server = await asyncio.start_server(self._handle, self._address, self._port)
+        _LOGGER.info("Metrics are available on %s port %d", self._address or "all interfaces", self._port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serve single request. Any path returns the metrics.
+        """
+        try:
+            request_line = await reader.readline()
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            if not request_line.startswith(b"GET "):
+                writer.write(b"HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            else:
+                body = self._cumulus.metrics.expose().encode()
+                writer.write(
+                    f"HTTP/1.1 200 OK\r\nContent-Type: {_CONTENT_TYPE}\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (OSError, ValueError) as err:
+            _LOGGER.debug("Metrics request failed: %s", err)
+        finally:
+            writer.close()
+
+    async def _shutdown(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            self._server = None
@@ -0,0 +1,109 @@
+"""End-to-end probing of ssh tunnel."""
+import asyncio
+import logging
+import time
+
+from cumulus.stats import RollingHistogram
+
+_LOGGER = logging.getLogger(__name__)
+# Cheap request answered by Home Assistant without authentication
+_PROBE_REQUEST = b"HEAD / HTTP/1.1\r\nHost: localhost\r\nUser-Agent: cumulus-probe\r\nConnection: close\r\n\r\n"
+# Seconds to wait for the response and for direct connection to Home Assistant
+_PROBE_TIMEOUT = 5
+
+
+class TunnelProbe:
+    """
+    Send HTTP request through the remote forward of the tunnel and record round trip time.
+
+    The request leaves through the ssh connection to the forwarded port on the server,
+    so it returns through the remote forward to Home Assistant. Tunnel which is connected
+    but does not forward is detected long before ssh keepalive gives up.
+    """
+
+    def __init__(self, interval: float, max_failed: int, ha_address: tuple[str, int]) -> None:
+        """
+        Init probe.
+
+        :param interval: seconds between probes
+        :param max_failed: number of failed probes after which the tunnel is dead
+        :param ha_address: Home Assistant address, checked directly when probe fails
+        """
+        self._interval = interval
+        self._max_failed = max_failed
+        self._ha_address = ha_address
+        self.rtt = RollingHistogram()
+        self.failures = 0
+
+    async def run(self, tunnel: 'SSHTunnel') -> bool:
+        """
+        Probe the tunnel until it's finished or its forward is released.
+
+        Probing stops when the first probe fails, the server probably does not allow
+        connections to the forwarded port.
+
+        :returns: `True` when the tunnel is dead
+        """
+        failed = 0
+        verified = False
+        while True:
+            await asyncio.sleep(self._interval)
+            if tunnel.finished.is_set() or tunnel.forward_released:
+                return False
+
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(TunnelProbe._probe(tunnel), _PROBE_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as err:
+                if tunnel.finished.is_set() or tunnel.forward_released:
+                    return False
+                if not await self._ha_available():
+                    _LOGGER.warning("Home Assistant does not respond, tunnel probe skipped")
+                    continue
+                if not verified:
+                    _LOGGER.warning("Tunnel probe failed, server may not allow it, stop probing: %r", err)
+                    return False
+
+                failed += 1
+                self.failures += 1
+                _LOGGER.warning("Tunnel probe failed (%d/%d): %r", failed, self._max_failed, err)
+                if failed >= self._max_failed:
+                    _LOGGER.error("SSH tunnel does not forward requests")
+                    return True
+                continue
+
+            failed = 0
+            verified = True
+            rtt = time.monotonic() - start
+            self.rtt.add(rtt)
+            _LOGGER.debug("Tunnel probe rtt=%.1fms", rtt * 1000)
+
+    async def _ha_available(self) -> bool:
+        """
+        Send the probe directly to Home Assistant, failed probe is not caused by the tunnel when it fails too.
+        """
+        try:
+            await asyncio.wait_for(self._probe_ha(), _PROBE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        return True
+
+    async def _probe_ha(self) -> None:
+        await TunnelProbe._request(*await asyncio.open_connection(*self._ha_address))
+
+    @staticmethod
+    async def _probe(tunnel: 'SSHTunnel') -> None:
+        await TunnelProbe._request(*await tunnel.open_probe_connection())
+
+    @staticmethod
+    async def _request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Send probe request and wait for status line of the response.
+        """
+        try:
+            writer.write(_PROBE_REQUEST)
+            status = await reader.readline()
+        finally:
+            writer.close()
+        if not status.startswith(b"HTTP/"):
+            raise ConnectionError("Connection closed without response")
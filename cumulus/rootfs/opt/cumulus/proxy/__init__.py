@@ -0,0 +1,2 @@
+"""Local forwarding stage between tunnel and Home Assistant."""
+from cumulus.proxy.proxy_service import ProxyService
@@ -0,0 +1,272 @@
+"""Cache of Home Assistant static assets."""
+import asyncio
+import collections
+import dataclasses
+import hashlib
+import json
+import logging
+import shutil
+import time
+from pathlib import Path
+
+from .http_message import HttpRequest, HttpResponse
+
+_LOGGER = logging.getLogger(__name__)
+
+STATIC_PREFIXES = ("/frontend_latest/", "/static/", "/hacsfiles/")
+# Headers which are not stored with cached response
+_SKIP_HEADERS = ("connection", "keep-alive", "transfer-encoding", "set-cookie", "date")
+
+
+@dataclasses.dataclass
+class CacheStats:
+    """Statistics of one cached path prefix."""
+
+    hits: int = 0
+    misses: int = 0
+    revalidations: int = 0
+    bytes_saved: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses + self.revalidations
+        return (self.hits + self.revalidations) / total if total else 0.0
+
+
+@dataclasses.dataclass
+class CacheEntry:
+    """Cached response of static asset."""
+
+    key: str
+    etag: str
+    headers: list[tuple[str, str]]
+    body: bytes
+    expires: float
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() < self.expires
+
+    @property
+    def spill_name(self) -> str:
+        return hashlib.sha256(f"{self.key}\n{self.etag}".encode()).hexdigest()
+
+
+class StaticCache:
+    """
+    Size bounded LRU cache of immutable static assets.
+
+    Entries are kept in memory and, when spill directory is configured, entries
+    evicted from memory are moved to disk. Spilled entries are not persisted
+    across restarts, the directory is cleaned by `start`. Entries evicted before
+    that are dropped.
+    """
+
+    def __init__(self, memory_size: int, max_entry_size: int, spill_dir: Path | None, spill_size: int) -> None:
+        """
+        Init cache.
+
+        :param memory_size: maximal size of bodies kept in memory (bytes)
+        :param max_entry_size: maximal size of single cached body (bytes)
+        :param spill_dir: directory for entries evicted from memory, `None` disables spilling
+        :param spill_size: maximal size of bodies on disk (bytes)
+        """
+        self._memory_size = memory_size
+        self._max_entry_size = min(max_entry_size, memory_size)
+        self._spill_dir = spill_dir
+        self._spill_size = spill_size
+        self._memory: collections.OrderedDict[str, CacheEntry] = collections.OrderedDict()
+        self._memory_used = 0
+        self._spilled: collections.OrderedDict[str, tuple[str, int]] = collections.OrderedDict()
+        self._spill_used = 0
+        self._spill_writes: dict[str, asyncio.Future] = {}
+        # Set when spill directory is cleaned and ready for new entries
+        self._spill_ready = False
+
+        self.stats: dict[str, CacheStats] = {prefix: CacheStats() for prefix in STATIC_PREFIXES}
+
+    async def start(self) -> None:
+        """
+        Clean spill directory left by previous run in executor.
+        """
+        if self._spill_dir is None:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._clean_spill_dir)
+        except OSError as err:
+            _LOGGER.warning("Unable to prepare cache directory %s, disk cache is disabled: %s", self._spill_dir, err)
+            return
+        self._spill_ready = True
+
+    @staticmethod
+    def match(request: HttpRequest) -> str | None:
+        """
+        Get cached prefix of the request path or `None` when request is not cacheable.
+        """
+        if request.method != "GET" or request.header("Range") is not None:
+            return None
+        return next((prefix for prefix in STATIC_PREFIXES if request.path.startswith(prefix)), None)
+
+    @staticmethod
+    def key(request: HttpRequest) -> str:
+        """
+        Get cache key of the request.
+
+        Home Assistant serves pre-compressed variants of assets, so the key contains
+        accepted encodings as well as the target.
+        """
+        return f"{request.target}\n{request.header('Accept-Encoding') or ''}"
+
+    async def get(self, key: str) -> CacheEntry | None:
+        """
+        Find entry in memory or on disk.
+        """
+        if (entry := self._memory.get(key)) is not None:
+            self._memory.move_to_end(key)
+            return entry
+
+        if key not in self._spilled:
+            return None
+
+        file_name, size = self._spilled.pop(key)
+        self._spill_used -= size
+        try:
+            if (write := self._spill_writes.get(file_name)) is not None:
+                await write
+            entry = await asyncio.get_running_loop().run_in_executor(None, self._load_spilled, file_name)
+        except (OSError, ValueError) as err:
+            _LOGGER.warning("Unable to load cached asset %s: %s", key.split("\n")[0], err)
+            return None
+
+        self._put_memory(entry)
+        return entry
+
+    def cacheable(self, response: HttpResponse) -> bool:
+        """
+        Check if response of matched request can be stored.
+        """
+        cache_control = (response.header("Cache-Control") or "").lower()
+        return (
+            response.status == 200
+            and response.header("ETag") is not None
+            and not response.chunked
+            and (length := response.content_length) is not None
+            and length <= self._max_entry_size
+            and "no-store" not in cache_control
+            and "private" not in cache_control
+        )
+
+    def store(self, key: str, response: HttpResponse, body: bytes) -> None:
+        """
+        Store cacheable response.
+        """
+        etag = response.header("ETag")
+        headers = [(key, value) for key, value in response.headers if key.lower() not in _SKIP_HEADERS]
+        self.invalidate(key)
+        self._put_memory(CacheEntry(key, etag, headers, body, StaticCache._expires(response)))
+
+    def refresh(self, entry: CacheEntry, response: HttpResponse) -> None:
+        """
+        Update freshness of entry revalidated by `304 Not Modified` response.
+        """
+        entry.expires = StaticCache._expires(response)
+
+    def invalidate(self, key: str) -> None:
+        if (entry := self._memory.pop(key, None)) is not None:
+            self._memory_used -= len(entry.body)
+        if (spilled := self._spilled.pop(key, None)) is not None:
+            self._spill_used -= spilled[1]
+            self._remove_spilled(spilled[0])
+
+    def _put_memory(self, entry: CacheEntry) -> None:
+        self._memory[entry.key] = entry
+        self._memory_used += len(entry.body)
+
+        while self._memory_used > self._memory_size:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted.body)
+            if self._spill_ready and len(evicted.body) <= self._spill_size:
+                self._spill(evicted)
+            else:
+                self._count_eviction(evicted.key)
+
+    def _spill(self, entry: CacheEntry) -> None:
+        """
+        Move entry evicted from memory to disk.
+        """
+        size = len(entry.body)
+        while self._spilled and self._spill_used + size > self._spill_size:
+            key, (file_name, evicted_size) = self._spilled.popitem(last=False)
+            self._spill_used -= evicted_size
+            self._remove_spilled(file_name)
+            self._count_eviction(key)
+
+        self._spilled[entry.key] = (entry.spill_name, size)
+        self._spill_used += size
+
+        write = asyncio.get_running_loop().run_in_executor(None, self._write_spilled, entry)
+        self._spill_writes[entry.spill_name] = write
+        write.add_done_callback(lambda _: self._spill_writes.pop(entry.spill_name, None))
+
+    def _count_eviction(self, key: str) -> None:
+        for prefix, stats in self.stats.items():
+            if key.startswith(prefix):
+                stats.evictions += 1
+
+    def _write_spilled(self, entry: CacheEntry) -> None:
+        """
+        Write entry as JSON metadata line followed by the body.
+        """
+        metadata = {
+            "key": entry.key,
+            "etag": entry.etag,
+            "headers": entry.headers,
+            "expires": entry.expires,
+        }
+        try:
+            with open(self._spill_dir / entry.spill_name, "wb") as spill_file:
+                spill_file.write(json.dumps(metadata).encode() + b"\n")
+                spill_file.write(entry.body)
+        except OSError as err:
+            _LOGGER.warning("Unable to store cached asset %s: %s", entry.key.split("\n")[0], err)
+
+    def _clean_spill_dir(self) -> None:
+        shutil.rmtree(self._spill_dir, ignore_errors=True)
+        self._spill_dir.mkdir(parents=True, exist_ok=True)
+
+    def _load_spilled(self, file_name: str) -> CacheEntry:
+        path = self._spill_dir / file_name
+        with open(path, "rb") as spill_file:
+            metadata = json.loads(spill_file.readline())
+            body = spill_file.read()
+        path.unlink()
+
+        headers = [(key, value) for key, value in metadata["headers"]]
+        return CacheEntry(metadata["key"], metadata["etag"], headers, body, metadata["expires"])
+
+    def _remove_spilled(self, file_name: str) -> None:
+        path = self._spill_dir / file_name
+        loop = asyncio.get_running_loop()
+
+        def _unlink(*_) -> None:
+            loop.run_in_executor(None, lambda: path.unlink(missing_ok=True))
+
+        if (write := self._spill_writes.get(file_name)) is not None:
+            write.add_done_callback(_unlink)
+        else:
+            _unlink()
+
+    @staticmethod
+    def _expires(response: HttpResponse) -> float:
+        """
+        Get monotonic time until which response is fresh without revalidation.
+        """
+        max_age = 0
+        for directive in (response.header("Cache-Control") or "").split(","):
+            name, _, value = directive.strip().partition("=")
+            if name.lower() == "no-cache":
+                return 0
+            if name.lower() == "max-age" and value.isdigit():
+                max_age = int(value)
+        return time.monotonic() + max_age
@@ -0,0 +1,125 @@
+"""Compression of Home Assistant responses before they are sent through the tunnel."""
+import gzip
+import logging
+import time
+
+from .http_message import HttpRequest, HttpResponse
+
+_LOGGER = logging.getLogger(__name__)
+
+ENCODING_BROTLI = "br"
+ENCODING_GZIP = "gzip"
+# Levels with good ratio at low CPU cost, the highest levels are too slow for dynamic responses
+_GZIP_LEVEL = 5
+_BROTLI_QUALITY = 4
+_COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+
+class ResponseCompressor:
+    """
+    Compress responses which Home Assistant sends without content coding.
+
+    Only complete bodies with known length are compressed, so the compressed response
+    is sent with new `Content-Length`. Brotli is preferred when it's installed.
+    """
+
+    def __init__(self, min_size: int, max_size: int) -> None:
+        """
+        Init compressor.
+
+        :param min_size: smaller bodies are not worth compression (bytes)
+        :param max_size: larger bodies are forwarded as stream without compression (bytes)
+        """
+        self._min_size = min_size
+        self._max_size = max_size
+        self._brotli = None
+        try:
+            import brotli
+        except ImportError:
+            _LOGGER.debug("brotli is not installed, compress responses by gzip only")
+        else:
+            self._brotli = brotli
+        self.encodings = (ENCODING_BROTLI, ENCODING_GZIP) if self._brotli is not None else (ENCODING_GZIP,)
+
+    def select(self, request: HttpRequest, response: HttpResponse) -> str | None:
+        """
+        Get encoding of the response accepted by the client or `None` when it should not be compressed.
+        """
+        if (
+            response.status != 200
+            or not response.has_body(request.method)
+            or response.chunked
+            or response.header("Content-Encoding") is not None
+            or response.header("Content-Range") is not None
+            or response.has_token("Cache-Control", "no-transform")
+            or not self._min_size <= (response.content_length or 0) <= self._max_size
+            or not ResponseCompressor._compressible(response.header("Content-Type"))
+        ):
+            return None
+        return self._negotiate(request.header("Accept-Encoding"))
+
+    def compress(self, encoding: str, body: bytes) -> tuple[bytes, float]:
+        """
+        Compress body, blocks for the time of compression so call it in executor.
+
+        :returns: compressed body and CPU time of compression in seconds
+        """
+        start = time.thread_time()
+        if encoding == ENCODING_BROTLI:
+            data = self._brotli.compress(body, quality=_BROTLI_QUALITY)
+        else:
+            data = gzip.compress(body, _GZIP_LEVEL, mtime=0)
+        return data, time.thread_time() - start
+
+    @staticmethod
+    def encode_head(response: HttpResponse, encoding: str, size: int) -> None:
+        """
+        Update response head for compressed body of `size` bytes.
+        """
+        response.set_header("Content-Encoding", encoding)
+        response.set_header("Content-Length", str(size))
+        if not response.has_token("Vary", "Accept-Encoding"):
+            vary = response.header("Vary")
+            response.set_header("Vary", f"{vary}, Accept-Encoding" if vary else "Accept-Encoding")
+        if (etag := response.header("ETag")) is not None and not etag.startswith("W/"):
+            # Compressed body is a different representation than the one of strong validator
+            response.set_header("ETag", f"W/{etag}")
+
+    def _negotiate(self, accept_encoding: str | None) -> str | None:
+        """
+        Select supported encoding with the highest quality in `Accept-Encoding`.
+        """
+        if not accept_encoding:
+            return None
+
+        qualities: dict[str, float] = {}
+        for item in accept_encoding.split(","):
+            name, *params = (part.strip() for part in item.split(";"))
+            quality = 1.0
+            for param in params:
+                key, _, value = param.partition("=")
+                if key.strip().lower() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            qualities[name.lower()] = quality
+
+        best = None
+        best_quality = 0.0
+        for encoding in self.encodings:
+            quality = qualities.get(encoding, qualities.get("*", 0.0))
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    @staticmethod
+    def _compressible(content_type: str | None) -> bool:
+        if content_type is None:
+            return False
+        media_type = content_type.split(";", 1)[0].strip().lower()
+        return (
+            media_type.startswith("text/")
+            or media_type in _COMPRESSIBLE_TYPES
+            or media_type.endswith(("+json", "+xml"))
+        )
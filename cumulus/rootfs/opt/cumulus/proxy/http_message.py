@@ -0,0 +1,250 @@
+"""Minimal HTTP/1.x message framing used by the forwarding stage."""
+import asyncio
+import dataclasses
+
+_READ_CHUNK_SIZE = 64 * 1024
+_MAX_HEADERS = 128
+_NO_BODY_STATUSES = (204, 304)
+
+
+class HttpError(Exception):
+    """Malformed HTTP message."""
+
+
+@dataclasses.dataclass
+class HttpMessage:
+    """Common part of request and response."""
+
+    version: str
+    headers: list[tuple[str, str]]
+
+    def header(self, name: str) -> str | None:
+        """
+        Get first header value with `name` (case insensitive).
+        """
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    def set_header(self, name: str, value: str | None) -> None:
+        """
+        Replace all headers with `name` by single value. Remove them when value is `None`.
+        """
+        lower_name = name.lower()
+        self.headers = [(key, val) for key, val in self.headers if key.lower() != lower_name]
+        if value is not None:
+            self.headers.append((name, value))
+
+    def has_token(self, name: str, token: str) -> bool:
+        """
+        Check if comma separated header value contains `token`.
+        """
+        value = self.header(name)
+        if value is None:
+            return False
+        return token.lower() in (item.strip().lower() for item in value.split(","))
+
+    @property
+    def chunked(self) -> bool:
+        return self.has_token("Transfer-Encoding", "chunked")
+
+    @property
+    def content_length(self) -> int | None:
+        value = self.header("Content-Length")
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError as err:
+            raise HttpError(f"Invalid Content-Length {value}") from err
+
+    @property
+    def keep_alive(self) -> bool:
+        """
+        Check if connection can be used for next message after this one.
+        """
+        if self.has_token("Connection", "close"):
+            return False
+        if self.version == "HTTP/1.0":
+            return self.has_token("Connection", "keep-alive")
+        return True
+
+    def _head_bytes(self, start_line: str) -> bytes:
+        lines = [start_line] + [f"{key}: {value}" for key, value in self.headers]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+@dataclasses.dataclass
+class HttpRequest(HttpMessage):
+    """HTTP request head."""
+
+    method: str = "GET"
+    target: str = "/"
+
+    @property
+    def path(self) -> str:
+        return self.target.split("?", 1)[0]
+
+    @property
+    def upgrade(self) -> bool:
+        return self.header("Upgrade") is not None
+
+    @property
+    def has_body(self) -> bool:
+        return self.chunked or bool(self.content_length)
+
+    def head_bytes(self) -> bytes:
+        return self._head_bytes(f"{self.method} {self.target} {self.version}")
+
+
+@dataclasses.dataclass
+class HttpResponse(HttpMessage):
+    """HTTP response head."""
+
+    status: int = 200
+    reason: str = "OK"
+
+    def has_body(self, request_method: str) -> bool:
+        """
+        Check if response carries a body as response to request with `request_method`.
+        """
+        return not (
+            request_method == "HEAD"
+            or 100 <= self.status < 200
+            or self.status in _NO_BODY_STATUSES
+        )
+
+    def delimited_by_close(self, request_method: str) -> bool:
+        """
+        Check if body ends by closing the connection.
+        """
+        return self.has_body(request_method) and not self.chunked and self.content_length is None
+
+    def head_bytes(self) -> bytes:
+        return self._head_bytes(f"{self.version} {self.status} {self.reason}")
+
+
+async def _read_head(reader: asyncio.StreamReader) -> tuple[str, list[tuple[str, str]]] | None:
+    """
+    Read start line and headers. Returns `None` on EOF before first byte.
+    """
+    start_line = await reader.readline()
+    while start_line in (b"\r\n", b"\n"):
+        # Tolerate empty lines between keep-alive requests
+        start_line = await reader.readline()
+    if not start_line:
+        return None
+
+    headers = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise HttpError("Unexpected end of headers")
+        if line in (b"\r\n", b"\n"):
+            break
+        if len(headers) >= _MAX_HEADERS:
+            raise HttpError("Too many headers")
+
+        key, sep, value = line.decode("latin-1").partition(":")
+        if not sep:
+            raise HttpError(f"Invalid header line {line!r}")
+        headers.append((key.strip(), value.strip()))
+
+    return start_line.decode("latin-1").rstrip("\r\n"), headers
+
+
+async def read_request(reader: asyncio.StreamReader) -> HttpRequest | None:
+    """
+    Read request head. Returns `None` when peer closed connection before the request.
+    """
+    head = await _read_head(reader)
+    if head is None:
+        return None
+
+    start_line, headers = head
+    parts = start_line.split(" ")
+    if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+        raise HttpError(f"Invalid request line {start_line}")
+
+    return HttpRequest(method=parts[0], target=parts[1], version=parts[2], headers=headers)
+
+
+async def read_response(reader: asyncio.StreamReader) -> HttpResponse:
+    """
+    Read response head.
+    """
+    head = await _read_head(reader)
+    if head is None:
+        raise HttpError("Connection closed before response")
+
+    start_line, headers = head
+    parts = start_line.split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/1.") or not parts[1].isdigit():
+        raise HttpError(f"Invalid status line {start_line}")
+
+    reason = parts[2] if len(parts) == 3 else ""
+    return HttpResponse(version=parts[0], status=int(parts[1]), reason=reason, headers=headers)
+
+
+async def forward_body(
+    message: HttpMessage,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    until_close: bool = False,
+    dechunk: bool = False,
+) -> int:
+    """
+    Copy message body from reader to writer.
+
+    :param message: head of the message with framing headers
+    :param until_close: body is delimited by closing the connection
+    :param dechunk: remove chunked transfer coding (for HTTP/1.0 peers)
+    :returns: number of body bytes
+    """
+    transferred = 0
+
+    if message.chunked:
+        while True:
+            size_line = await reader.readline()
+            try:
+                size = int(size_line.split(b";", 1)[0].strip(), 16)
+            except ValueError as err:
+                raise HttpError(f"Invalid chunk size {size_line!r}") from err
+
+            if not dechunk:
+                writer.write(size_line)
+            if size == 0:
+                break
+
+            data = await reader.readexactly(size + 2)
+            writer.write(data[:-2] if dechunk else data)
+            transferred += size
+            await writer.drain()
+
+        # Trailer section ends with empty line
+        while True:
+            line = await reader.readline()
+            if not dechunk:
+                writer.write(line)
+            if line in (b"\r\n", b"\n", b""):
+                break
+
+    elif (length := message.content_length) is not None:
+        while transferred < length:
+            data = await reader.read(min(_READ_CHUNK_SIZE, length - transferred))
+            if not data:
+                raise HttpError("Connection closed inside body")
+            writer.write(data)
+            transferred += len(data)
+            await writer.drain()
+
+    elif until_close:
+        while data := await reader.read(_READ_CHUNK_SIZE):
+            writer.write(data)
+            transferred += len(data)
+            await writer.drain()
+
+    await writer.drain()
+    return transferred
@@ -0,0 +1,163 @@
+"""Keep-alive connection pool to Home Assistant."""
+import asyncio
+import collections
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    """Single upstream connection owned by the pool."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.requests = 0
+        self.reused = False
+
+    @property
+    def healthy(self) -> bool:
+        """
+        Check that server did not close idle connection.
+        """
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class ConnectionPool:
+    """
+    Bounded pool of HTTP/1.1 keep-alive connections.
+
+    Pool keeps at most `size` idle connections. Connections above the limit are
+    opened on demand and closed after use, up to `max_connections` connections in use.
+    Requests above that wait until a connection is released, so a burst of requests
+    does not open unbounded number of connections to Home Assistant.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        size: int,
+        idle_timeout: float,
+        max_requests: int,
+        max_connections: int,
+    ) -> None:
+        """
+        Init pool.
+
+        :param size: maximal number of idle connections kept in pool
+        :param idle_timeout: seconds after which idle connection is evicted
+        :param max_requests: number of requests after which connection is evicted
+        :param max_connections: maximal number of connections in use
+        """
+        self._host = host
+        self._port = port
+        self._size = size
+        self._slots = asyncio.Semaphore(max_connections)
+        self._active = 0
+        self._idle_timeout = idle_timeout
+        self._max_requests = max_requests
+        self._idle: collections.deque[PooledConnection] = collections.deque()
+        self._evict_handle: asyncio.TimerHandle | None = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    @property
+    def active_count(self) -> int:
+        return self._active
+
+    async def acquire(self, fresh: bool = False) -> PooledConnection:
+        """
+        Get healthy idle connection or open new one.
+
+        Every acquired connection must be returned by `release` exactly once.
+
+        :param fresh: always open new connection
+        """
+        await self._slots.acquire()
+        try:
+            conn = await self._acquire(fresh)
+        except BaseException:
+            self._slots.release()
+            raise
+        self._active += 1
+        return conn
+
+    async def _acquire(self, fresh: bool) -> PooledConnection:
+        now = time.monotonic()
+        while self._idle and not fresh:
+            # Most recently used connection is the least likely to be closed by server
+            conn = self._idle.pop()
+            if conn.healthy and now - conn.last_used < self._idle_timeout:
+                self.hits += 1
+                conn.reused = True
+                return conn
+            self._evict(conn, "unhealthy")
+
+        self.misses += 1
+        reader, writer = await asyncio.open_connection(self._host, self._port)
+        return PooledConnection(reader, writer)
+
+    def release(self, conn: PooledConnection, reusable: bool) -> None:
+        """
+        Return connection after finished request.
+        """
+        self._active -= 1
+        self._slots.release()
+        conn.requests += 1
+        conn.last_used = time.monotonic()
+
+        if not reusable or not conn.healthy:
+            conn.close()
+        elif conn.requests >= self._max_requests:
+            self._evict(conn, "max requests")
+        elif len(self._idle) >= self._size:
+            conn.close()
+        else:
+            self._idle.append(conn)
+            self._schedule_eviction()
+
+    def close(self) -> None:
+        """
+        Close all idle connections.
+        """
+        if self._evict_handle is not None:
+            self._evict_handle.cancel()
+            self._evict_handle = None
+        while self._idle:
+            self._idle.pop().close()
+
+    def _evict(self, conn: PooledConnection, reason: str) -> None:
+        _LOGGER.debug("Evict connection to Home Assistant reason=%s requests=%d", reason, conn.requests)
+        self.evictions += 1
+        conn.close()
+
+    def _schedule_eviction(self) -> None:
+        if self._evict_handle is None:
+            loop = asyncio.get_running_loop()
+            self._evict_handle = loop.call_later(self._idle_timeout, self._evict_idle)
+
+    def _evict_idle(self) -> None:
+        """
+        Close connections idle longer than timeout.
+        """
+        self._evict_handle = None
+        deadline = time.monotonic() - self._idle_timeout
+        # Oldest connections are on the left side
+        while self._idle and (self._idle[0].last_used <= deadline or not self._idle[0].healthy):
+            self._evict(self._idle.popleft(), "idle timeout")
+
+        if self._idle:
+            self._schedule_eviction()
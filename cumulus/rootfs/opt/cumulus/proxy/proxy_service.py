@@ -0,0 +1,416 @@
+"""Forward connections from tunnel to Home Assistant."""
+import asyncio
+import logging
+import time
+from typing import Callable
+
+from .http_message import HttpError, HttpRequest, HttpResponse, forward_body, read_request, read_response
+
+_LOGGER = logging.getLogger(__name__)
+_READ_CHUNK_SIZE = 64 * 1024
+_CONTINUE_RESPONSE = b"HTTP/1.1 100 Continue\r\n\r\n"
+_MEGABYTE = 1024 * 1024
+_MAX_CACHED_ASSET_SIZE = 4 * _MEGABYTE
+# Bodies of compressed responses are read whole, compression of small ones does not pay off
+_MIN_COMPRESSED_SIZE = 1024
+_MAX_COMPRESSED_SIZE = 8 * _MEGABYTE
+_COMPRESSION_RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 1.0)
+_COMPRESSION_CPU_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+
+class ProxyService:
+    """Service forwarding tunnel connections to Home Assistant HTTP port."""
+
+    def __init__(self, cumulus: 'Cumulus') -> None:
+        """
+        Init service.
+        """
+        self._cumulus = cumulus
+        self._server: asyncio.AbstractServer | None = None
+        self.pool: 'ConnectionPool | None' = None
+        self.cache: 'StaticCache | None' = None
+        self.compressor: 'ResponseCompressor | None' = None
+        self.websocket: 'WebsocketFanout | None' = None
+
+        config = cumulus.config
+        if config.http_proxy:
+            from .cache import StaticCache
+            from .pool import ConnectionPool
+
+            self.pool = ConnectionPool(
+                config.ha_ip_address,
+                config.ha_port,
+                config.ha_pool_size,
+                config.ha_pool_idle_timeout,
+                config.ha_pool_max_requests,
+                config.ha_pool_max_connections,
+            )
+            if config.static_cache_size > 0:
+                spill_dir = config.config_dir / "cache" if config.static_cache_disk_size > 0 else None
+                self.cache = StaticCache(
+                    config.static_cache_size * _MEGABYTE,
+                    _MAX_CACHED_ASSET_SIZE,
+                    spill_dir,
+                    config.static_cache_disk_size * _MEGABYTE,
+                )
+                cumulus.create_task(self.cache.start(), "proxy-cache-start")
+            if config.proxy_compression:
+                from .compression import ResponseCompressor
+
+                self.compressor = ResponseCompressor(_MIN_COMPRESSED_SIZE, _MAX_COMPRESSED_SIZE)
+            if config.websocket_fanout:
+                if config.supervisor_token is None:
+                    _LOGGER.warning("Supervisor token is not available, websocket subscriptions are not shared")
+                else:
+                    from .websocket import WebsocketFanout
+
+                    self.websocket = WebsocketFanout(cumulus, config.websocket_coalesce_window)
+        self._setup_metrics(cumulus.metrics)
+        cumulus.register_shutdown_handler(self._shutdown)
+
+    @property
+    def http_enabled(self) -> bool:
+        """
+        Check if HTTP forwarding stage is enabled.
+        """
+        return self.pool is not None
+
+    @property
+    def local_port(self) -> int | None:
+        """
+        Port of local listener or `None` when it's not started.
+        """
+        if self._server is None:
+            return None
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self) -> None:
+        """
+        Start local listener for tunnels forwarding to a TCP port (autossh).
+        """
+        if self._server is None:
+            self._server = await asyncio.start_server(self.handle_connection, "127.0.0.1", 0)
+            _LOGGER.debug("Local forwarding listener started on port %d", self.local_port)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Forward one connection accepted on remote port to Home Assistant.
+
+        Reader and writer can be asyncio streams or asyncssh channel streams.
+        """
+        self._connections.inc()
+        self._active_connections.inc()
+        try:
+            if self.pool is None:
+                await self._forward_raw(reader, writer)
+            else:
+                await self._forward_http(reader, writer)
+        except (HttpError, asyncio.IncompleteReadError, ValueError) as err:
+            _LOGGER.debug("Invalid HTTP communication: %s", err)
+        except OSError as err:
+            _LOGGER.debug("Forwarded connection broken: %s", err)
+        finally:
+            self._active_connections.dec()
+            writer.close()
+
+    async def _forward_raw(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        head: bytes = b"",
+    ) -> None:
+        """
+        Forward the connection as a plain TCP stream.
+
+        :param head: already consumed data to send before the rest of the stream
+        """
+        start = time.monotonic()
+        try:
+            ha_reader, ha_writer = await asyncio.open_connection(
+                self._cumulus.config.ha_ip_address, self._cumulus.config.ha_port)
+        except OSError as err:
+            _LOGGER.warning("Unable to connect to Home Assistant: %s", err)
+            writer.close()
+            return
+
+        connect_time = time.monotonic() - start
+        ha_writer.write(head)
+        sent, received = await asyncio.gather(
+            ProxyService._pipe(reader, ha_writer),
+            ProxyService._pipe(ha_reader, writer),
+        )
+
+        _LOGGER.debug(
+            "Connection finished connect=%.1fms duration=%.1fms sent=%d received=%d",
+            connect_time * 1000, (time.monotonic() - start) * 1000, sent + len(head), received)
+
+    async def _forward_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Forward HTTP requests one by one over pooled keep-alive connections.
+        """
+        while request := await read_request(reader):
+            if request.upgrade:
+                if self.websocket is not None and self.websocket.handles(request):
+                    await self.websocket.handle(request, reader, writer)
+                    return
+                # Websocket and other upgraded protocols keep their own connection
+                await self._forward_raw(reader, writer, request.head_bytes())
+                return
+
+            if not await self._forward_request(request, reader, writer):
+                return
+
+    async def _forward_request(
+        self,
+        request: HttpRequest,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> bool:
+        """
+        Forward single request and its response.
+
+        :returns: `True` when client connection can be used for next request
+        """
+        start = time.monotonic()
+        client_keep_alive = request.keep_alive
+        client_version = request.version
+        client_etag = request.header("If-None-Match")
+
+        cache_prefix = self.cache.match(request) if self.cache is not None else None
+        entry = None
+        if cache_prefix is not None:
+            cache_key = self.cache.key(request)
+            cache_stats = self.cache.stats[cache_prefix]
+            entry = await self.cache.get(cache_key)
+            if entry is not None and entry.fresh:
+                cache_stats.hits += 1
+                cache_stats.bytes_saved += len(entry.body)
+                await ProxyService._send_cached(entry, client_etag, writer, client_keep_alive)
+                _LOGGER.debug("%s %s cache=hit", request.method, request.path)
+                return client_keep_alive
+            if entry is not None:
+                request.set_header("If-None-Match", entry.etag)
+
+        if request.has_token("Expect", "100-continue"):
+            request.set_header("Expect", None)
+            writer.write(_CONTINUE_RESPONSE)
+
+        # Upstream connection is always HTTP/1.1 keep-alive regardless of the client
+        request.version = "HTTP/1.1"
+        request.set_header("Connection", "keep-alive")
+        if request.header("Host") is None:
+            request.set_header("Host", f"{self._cumulus.config.ha_ip_address}:{self._cumulus.config.ha_port}")
+
+        conn = await self.pool.acquire()
+        try:
+            response = await self._send_request(conn, request, reader)
+        except (HttpError, asyncio.IncompleteReadError, ConnectionError):
+            if not conn.reused or request.has_body:
+                raise
+            # Server closed idle connection in the meantime, retry on fresh one
+            _LOGGER.debug("Retry request on new connection")
+            conn = await self.pool.acquire(fresh=True)
+            response = await self._send_request(conn, request, reader)
+
+        try:
+            while 100 <= response.status < 200:
+                writer.write(response.head_bytes())
+                response = await read_response(conn.reader)
+            ttfb = time.monotonic() - start
+            upstream_reusable = response.keep_alive
+            until_close = response.delimited_by_close(request.method)
+
+            if entry is not None and response.status == 304:
+                self.cache.refresh(entry, response)
+                cache_stats.revalidations += 1
+                cache_stats.bytes_saved += len(entry.body)
+                await ProxyService._send_cached(entry, client_etag, writer, client_keep_alive)
+                self.pool.release(conn, upstream_reusable)
+                _LOGGER.debug("%s %s cache=revalidated ttfb=%.1fms", request.method, request.path, ttfb * 1000)
+                return client_keep_alive
+
+            dechunk = client_version == "HTTP/1.0" and response.chunked
+            keep_alive = client_keep_alive and not until_close and not dechunk
+
+            if dechunk:
+                response.set_header("Transfer-Encoding", None)
+            response.set_header("Connection", "keep-alive" if keep_alive else "close")
+
+            size = 0
+            if cache_prefix is not None and self.cache.cacheable(response):
+                cache_stats.misses += 1
+                body = await conn.reader.readexactly(response.content_length)
+                self.cache.store(cache_key, response, body)
+                writer.write(response.head_bytes() + body)
+                size = len(body)
+            elif self.compressor is not None and (encoding := self.compressor.select(request, response)):
+                body = await conn.reader.readexactly(response.content_length)
+                body = await self._compress(response, encoding, body)
+                writer.write(response.head_bytes() + body)
+                size = len(body)
+            else:
+                writer.write(response.head_bytes())
+                if response.has_body(request.method):
+                    size = await forward_body(response, conn.reader, writer, until_close, dechunk)
+            await writer.drain()
+        except BaseException:
+            self.pool.release(conn, False)
+            raise
+
+        self.pool.release(conn, upstream_reusable and not until_close)
+        self._ttfb.observe(ttfb, pool="hit" if conn.reused else "miss")
+        _LOGGER.debug(
+            "%s %s status=%d pool=%s ttfb=%.1fms duration=%.1fms size=%d encoding=%s",
+            request.method, request.path, response.status, "hit" if conn.reused else "miss",
+            ttfb * 1000, (time.monotonic() - start) * 1000, size, response.header("Content-Encoding"))
+
+        return keep_alive
+
+    async def _compress(self, response: HttpResponse, encoding: str, body: bytes) -> bytes:
+        """
+        Compress response body in executor and update response head.
+
+        :returns: body to send, the original one when compression did not make it smaller
+        """
+        data, cpu_time = await self._cumulus.run_in_executor(self.compressor.compress, encoding, body)
+        self._compression_cpu.observe(cpu_time, encoding=encoding)
+        if len(data) >= len(body):
+            return body
+
+        self.compressor.encode_head(response, encoding, len(data))
+        self._compression_ratio.observe(len(data) / len(body), encoding=encoding)
+        self._compression_input.inc(len(body), encoding=encoding)
+        self._compression_output.inc(len(data), encoding=encoding)
+        return data
+
+    @staticmethod
+    async def _send_cached(
+        entry: 'CacheEntry',
+        client_etag: str | None,
+        writer: asyncio.StreamWriter,
+        keep_alive: bool,
+    ) -> None:
+        """
+        Answer request from cache.
+        """
+        connection = "keep-alive" if keep_alive else "close"
+        if client_etag is not None and entry.etag in (etag.strip() for etag in client_etag.split(",")):
+            response = HttpResponse(
+                version="HTTP/1.1", status=304, reason="Not Modified",
+                headers=[("ETag", entry.etag), ("Connection", connection)])
+            writer.write(response.head_bytes())
+        else:
+            response = HttpResponse(version="HTTP/1.1", headers=list(entry.headers))
+            response.set_header("Connection", connection)
+            writer.write(response.head_bytes() + entry.body)
+        await writer.drain()
+
+    def _setup_metrics(self, metrics: 'MetricsRegistry') -> None:
+        """
+        Register metrics of the service.
+        """
+        self._connections = metrics.counter("cumulus_proxy_connections_total", "Forwarded connections")
+        self._active_connections = metrics.gauge("cumulus_proxy_active_connections", "Open forwarded connections")
+
+        if self.pool is not None:
+            self._ttfb = metrics.histogram(
+                "cumulus_proxy_ttfb_seconds", "Time to first byte of Home Assistant response", ["pool"])
+            metrics.counter("cumulus_pool_hits_total", "Requests sent over reused connection",
+                            callback=lambda: self.pool.hits)
+            metrics.counter("cumulus_pool_misses_total", "Requests which opened new connection",
+                            callback=lambda: self.pool.misses)
+            metrics.counter("cumulus_pool_evictions_total", "Connections evicted from pool",
+                            callback=lambda: self.pool.evictions)
+            metrics.gauge("cumulus_pool_idle_connections", "Idle connections in pool",
+                          callback=lambda: self.pool.idle_count)
+            metrics.gauge("cumulus_pool_active_connections", "Connections to Home Assistant in use",
+                          callback=lambda: self.pool.active_count)
+
+        if self.compressor is not None:
+            self._compression_ratio = metrics.histogram(
+                "cumulus_proxy_compression_ratio", "Compressed to original size of response body", ["encoding"],
+                buckets=_COMPRESSION_RATIO_BUCKETS)
+            self._compression_cpu = metrics.histogram(
+                "cumulus_proxy_compression_cpu_seconds", "CPU time of response compression", ["encoding"],
+                buckets=_COMPRESSION_CPU_BUCKETS)
+            self._compression_input = metrics.counter(
+                "cumulus_proxy_compression_input_bytes_total", "Response bytes before compression", ["encoding"])
+            self._compression_output = metrics.counter(
+                "cumulus_proxy_compression_output_bytes_total", "Response bytes after compression", ["encoding"])
+
+        if self.websocket is not None:
+            metrics.gauge("cumulus_ws_clients", "Websocket clients served by shared subscriptions stage",
+                          callback=lambda: self.websocket.clients)
+            metrics.gauge("cumulus_ws_shared_subscriptions", "Subscriptions shared by websocket clients",
+                          callback=lambda: self.websocket.subscriptions)
+            metrics.counter("cumulus_ws_upstream_events_total", "Events received by shared subscriptions",
+                            callback=lambda: self.websocket.upstream_events)
+            metrics.counter("cumulus_ws_delivered_events_total", "Events of shared subscriptions sent to clients",
+                            callback=lambda: self.websocket.delivered_events)
+            metrics.counter("cumulus_ws_coalesced_events_total", "State changes merged with later change",
+                            callback=lambda: self.websocket.coalesced_events)
+
+        if self.cache is not None:
+            def _cache_stat(name: str) -> Callable[[], list[tuple[tuple[str], float]]]:
+                return lambda: [((prefix,), getattr(stats, name)) for prefix, stats in self.cache.stats.items()]
+
+            for stat in ("hits", "misses", "revalidations", "evictions"):
+                metrics.counter(f"cumulus_cache_{stat}_total", f"Static cache {stat}", ["prefix"],
+                                callback=_cache_stat(stat))
+            metrics.counter("cumulus_cache_saved_bytes_total", "Bytes answered from static cache", ["prefix"],
+                            callback=_cache_stat("bytes_saved"))
+            metrics.gauge("cumulus_cache_hit_ratio", "Static cache hit ratio", ["prefix"],
+                          callback=_cache_stat("hit_ratio"))
+
+    async def _send_request(
+        self,
+        conn: 'PooledConnection',
+        request: HttpRequest,
+        reader: asyncio.StreamReader,
+    ) -> HttpResponse:
+        """
+        Send request with body over upstream connection and read response head.
+        """
+        try:
+            conn.writer.write(request.head_bytes())
+            await forward_body(request, reader, conn.writer)
+            return await read_response(conn.reader)
+        except BaseException:
+            self.pool.release(conn, False)
+            raise
+
+    async def _shutdown(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if self.pool is not None:
+            self.pool.close()
+        if self.websocket is not None:
+            await self.websocket.close()
+
+    @staticmethod
+    async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> int:
+        """
+        Copy data from reader to writer until EOF.
+
+        Waits for writer to drain after every chunk, so slow side of the connection
+        throttles the reading from the other side.
+
+        :returns: number of transferred bytes
+        """
+        transferred = 0
+        try:
+            while data := await reader.read(_READ_CHUNK_SIZE):
+                writer.write(data)
+                transferred += len(data)
+                await writer.drain()
+
+            if writer.can_write_eof():
+                writer.write_eof()
+            else:
+                writer.close()
+        except (OSError, EOFError) as err:
+            _LOGGER.debug("Forwarded connection broken: %s", err)
+            writer.close()
+
+        return transferred
@@ -0,0 +1,544 @@
+"""Websocket stage sharing event subscriptions of remote Home Assistant clients."""
+import asyncio
+import hashlib
+import json
+import logging
+
+import websockets
+from websockets import WebSocketClientProtocol
+from websockets.extensions.permessage_deflate import enable_server_permessage_deflate
+from websockets.frames import Opcode
+from websockets.protocol import State
+from websockets.server import ServerProtocol
+
+from .http_message import HttpRequest
+
+_LOGGER = logging.getLogger(__name__)
+
+WEBSOCKET_PATH = "/api/websocket"
+# Home Assistant API proxied by Supervisor, authenticated by add-on token
+_SUPERVISOR_WEBSOCKET_URL = "ws://supervisor/core/websocket"
+_READ_CHUNK_SIZE = 64 * 1024
+# Largest message accepted from remote client, the default limit of Home Assistant
+_MAX_CLIENT_MESSAGE_SIZE = 4 * 1024 * 1024
+# Messages waiting for slow client, the client is disconnected when its queue is full
+_CLIENT_QUEUE_SIZE = 1024
+# Time for Home Assistant to answer authentication and subscription requests
+_REQUEST_TIMEOUT = 10
+# Seconds for which admin check of access token is reused by new connections of the client
+_ADMIN_CHECK_TTL = 300
+_CLOSE_INTERNAL_ERROR = 1011
+_CLOSE_TRY_AGAIN = 1013
+_EVENT_STATE_CHANGED = "state_changed"
+
+
+class _SharedSubscription:
+    """Subscription of the add-on connection and clients receiving its events."""
+
+    def __init__(self, key: str, request: dict) -> None:
+        self.key = key
+        self.request = request
+        self.upstream_id: int | None = None
+        # Result of the subscription request, set once it's answered
+        self.opened: asyncio.Future[dict] = asyncio.get_running_loop().create_future()
+        self.listeners: set[tuple['_ClientSession', int]] = set()
+        # Coalesced state changes waiting for the end of window, by entity
+        self.pending: dict[str, dict] = {}
+        self.sent_at: dict[str, float] = {}
+        self.flush_handle: asyncio.TimerHandle | None = None
+
+    @property
+    def coalesced(self) -> bool:
+        return self.request.get("event_type") == _EVENT_STATE_CHANGED
+
+
+class WebsocketFanout:
+    """
+    Share event subscriptions of remote websocket clients on one Home Assistant connection.
+
+    Every remote client keeps its own upstream session authenticated by its own token.
+    Only `subscribe_events` of admin users is served from subscriptions shared on the
+    add-on connection, events are serialized once for all clients. State changes of
+    the same entity within `coalesce_window` are sent as one change.
+    """
+
+    def __init__(self, cumulus: 'Cumulus', coalesce_window: float) -> None:
+        """
+        Init websocket stage.
+
+        :param coalesce_window: seconds in which state changes are coalesced, `0` disables coalescing
+        """
+        config = cumulus.config
+        self.ha_url = f"ws://{config.ha_ip_address}:{config.ha_port}{WEBSOCKET_PATH}"
+        self._token = config.supervisor_token
+        self._coalesce_window = coalesce_window
+        self._cumulus = cumulus
+        self._upstream: WebSocketClientProtocol | None = None
+        self._connect_lock = asyncio.Lock()
+        self._last_id = 0
+        self._results: dict[int, asyncio.Future[dict]] = {}
+        self._subscriptions: dict[str, _SharedSubscription] = {}
+        self._by_id: dict[int, _SharedSubscription] = {}
+        # Hash of access token to time and result of admin check
+        self._admin_checks: dict[str, tuple[float, asyncio.Future[bool | None]]] = {}
+        self.clients = 0
+        self.upstream_events = 0
+        self.delivered_events = 0
+        self.coalesced_events = 0
+
+    @property
+    def subscriptions(self) -> int:
+        return len(self._subscriptions)
+
+    @staticmethod
+    def handles(request: HttpRequest) -> bool:
+        """
+        Check if the request opens Home Assistant websocket API.
+        """
+        return request.path == WEBSOCKET_PATH and request.has_token("Upgrade", "websocket")
+
+    async def handle(self, request: HttpRequest, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serve websocket client connected through the tunnel.
+        """
+        # Remote clients keep compression they had when the upgrade was passed through
+        protocol = ServerProtocol(
+            extensions=enable_server_permessage_deflate(None), max_size=_MAX_CLIENT_MESSAGE_SIZE)
+        # The head is already read by the proxy, parse it again so the protocol continues with frames
+        protocol.receive_data(request.head_bytes())
+        if not (events := protocol.events_received()):
+            _LOGGER.debug("Invalid websocket handshake: %s", protocol.handshake_exc)
+            return
+        response = protocol.accept(events[0])
+        protocol.send_response(response)
+        writer.write(b"".join(protocol.data_to_send()))
+        await writer.drain()
+        if response.status_code != 101:
+            return
+
+        session = _ClientSession(self, protocol, reader, writer)
+        self.clients += 1
+        try:
+            await session.run()
+        finally:
+            self.clients -= 1
+            for client_id in list(session.subscriptions):
+                await self.unsubscribe(session, client_id)
+
+    def check_admin(self, token: str | None) -> asyncio.Future[bool | None]:
+        """
+        Check that access token belongs to admin user.
+
+        Result is reused for `_ADMIN_CHECK_TTL`, so reconnecting clients do not open
+        a check connection every time. Failed checks are not reused.
+        """
+        key = hashlib.sha256((token or "").encode()).hexdigest()
+        now = asyncio.get_running_loop().time()
+        if (entry := self._admin_checks.get(key)) is not None and now - entry[0] < _ADMIN_CHECK_TTL:
+            return entry[1]
+
+        self._admin_checks = {
+            key: entry for key, entry in self._admin_checks.items() if now - entry[0] < _ADMIN_CHECK_TTL}
+        check = asyncio.ensure_future(self._check_admin(token))
+        check.add_done_callback(lambda _: self._forget_failed_check(key, check))
+        self._admin_checks[key] = (now, check)
+        return check
+
+    async def subscribe(self, session: '_ClientSession', message: dict) -> str | None:
+        """
+        Add client to shared subscription, the subscription is opened by the first client.
+
+        :returns: result message for the client, `None` when the subscription can't be shared
+        """
+        client_id = message["id"]
+        request = {key: value for key, value in message.items() if key != "id"}
+        key = json.dumps(request, sort_keys=True)
+        if (subscription := self._subscriptions.get(key)) is None:
+            subscription = self._subscriptions[key] = _SharedSubscription(key, request)
+            self._cumulus.create_task(self._open(subscription), "ws-subscribe")
+
+        try:
+            result = await asyncio.shield(subscription.opened)
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as err:
+            _LOGGER.debug("Shared subscription %s failed, forward it to client session: %s", key, err)
+            return None
+
+        if result.get("success"):
+            if self._subscriptions.get(key) is not subscription:
+                # Closed together with the add-on connection in the meantime
+                return None
+            subscription.listeners.add((session, client_id))
+            session.subscriptions[client_id] = subscription
+        return json.dumps({**result, "id": client_id})
+
+    async def unsubscribe(self, session: '_ClientSession', client_id: int) -> None:
+        """
+        Remove client from shared subscription, the last client closes it.
+        """
+        subscription = session.subscriptions.pop(client_id)
+        subscription.listeners.discard((session, client_id))
+        if subscription.listeners or self._subscriptions.get(subscription.key) is not subscription:
+            return
+
+        self._close(subscription)
+        if self._upstream is not None and subscription.upstream_id is not None:
+            try:
+                await self._request({"type": "unsubscribe_events", "subscription": subscription.upstream_id})
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as err:
+                _LOGGER.debug("Unable to unsubscribe shared subscription: %s", err)
+
+    async def close(self) -> None:
+        """
+        Close the add-on connection.
+        """
+        if self._upstream is not None:
+            await self._upstream.close()
+
+    async def _open(self, subscription: _SharedSubscription) -> None:
+        """
+        Send subscription request and publish its result to waiting clients.
+        """
+        try:
+            _, result = await self._request(subscription.request, subscription)
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as err:
+            self._close(subscription)
+            subscription.opened.set_exception(err)
+            return
+
+        if result.get("success"):
+            _LOGGER.debug("Shared subscription %s opened", subscription.key)
+        else:
+            self._close(subscription)
+        subscription.opened.set_result(result)
+
+    async def _check_admin(self, token: str | None) -> bool | None:
+        """
+        Check admin by separate connection authenticated by the token, so ids of client sessions are kept.
+
+        :returns: `None` when the check failed
+        """
+        try:
+            websocket = await asyncio.wait_for(_authenticate(self.ha_url, token), _REQUEST_TIMEOUT)
+            try:
+                await websocket.send(json.dumps({"id": 1, "type": "auth/current_user"}))
+                result = json.loads(await asyncio.wait_for(websocket.recv(), _REQUEST_TIMEOUT))
+            finally:
+                await websocket.close()
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException, ValueError) as err:
+            _LOGGER.debug("Unable to check websocket user, do not share subscriptions: %s", err)
+            return None
+        return bool(result.get("success") and result.get("result", {}).get("is_admin"))
+
+    def _forget_failed_check(self, key: str, check: asyncio.Future[bool | None]) -> None:
+        if (check.cancelled() or check.result() is None) and self._admin_checks.get(key, (0, None))[1] is check:
+            del self._admin_checks[key]
+
+    def _close(self, subscription: _SharedSubscription) -> None:
+        if self._subscriptions.get(subscription.key) is subscription:
+            del self._subscriptions[subscription.key]
+        if self._by_id.get(subscription.upstream_id) is subscription:
+            del self._by_id[subscription.upstream_id]
+        if subscription.flush_handle is not None:
+            subscription.flush_handle.cancel()
+
+    async def _request(self, message: dict, subscription: _SharedSubscription | None = None) -> tuple[int, dict]:
+        """
+        Send request over the add-on connection and wait for its result.
+
+        :param subscription: subscription receiving events of the request, registered before they arrive
+        :returns: id of the request and its result
+        """
+        websocket = await self._connection()
+        self._last_id += 1
+        message_id = self._last_id
+        if subscription is not None:
+            subscription.upstream_id = message_id
+            self._by_id[message_id] = subscription
+        future = self._results[message_id] = asyncio.get_running_loop().create_future()
+        try:
+            await websocket.send(json.dumps({**message, "id": message_id}))
+            return message_id, await asyncio.wait_for(future, _REQUEST_TIMEOUT)
+        finally:
+            self._results.pop(message_id, None)
+
+    async def _connection(self) -> WebSocketClientProtocol:
+        """
+        Get the add-on connection to Home Assistant, open it when needed.
+        """
+        async with self._connect_lock:
+            if self._upstream is None:
+                websocket = await asyncio.wait_for(
+                    _authenticate(_SUPERVISOR_WEBSOCKET_URL, self._token), _REQUEST_TIMEOUT)
+                _LOGGER.debug("Shared websocket connection to Home Assistant opened")
+                self._upstream = websocket
+                self._last_id = 0
+                self._cumulus.create_task(self._read_upstream(websocket), "ws-upstream")
+            return self._upstream
+
+    async def _read_upstream(self, websocket: WebSocketClientProtocol) -> None:
+        """
+        Dispatch results and events of the add-on connection until it's closed.
+        """
+        try:
+            async for data in websocket:
+                message = json.loads(data)
+                for item in message if isinstance(message, list) else (message,):
+                    self._handle_upstream(item)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            _LOGGER.debug("Shared websocket connection to Home Assistant closed")
+            self._upstream = None
+            for future in self._results.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Home Assistant connection closed"))
+            # Clients subscribe again after reconnect
+            for subscription in list(self._subscriptions.values()):
+                self._close(subscription)
+                for session, _ in subscription.listeners:
+                    session.close(_CLOSE_TRY_AGAIN, "Home Assistant connection closed")
+
+    def _handle_upstream(self, message: dict) -> None:
+        match message.get("type"):
+            case "result":
+                if (future := self._results.get(message.get("id"))) is not None and not future.done():
+                    future.set_result(message)
+            case "event":
+                if (subscription := self._by_id.get(message.get("id"))) is not None:
+                    self.upstream_events += 1
+                    if subscription.coalesced and self._coalesce_window > 0:
+                        self._coalesce(subscription, message["event"])
+                    else:
+                        self._fan_out(subscription, message["event"])
+
+    def _coalesce(self, subscription: _SharedSubscription, event: dict) -> None:
+        """
+        Send state change of entity right away, changes within the window after it are sent as one.
+        """
+        entity_id = event.get("data", {}).get("entity_id")
+        if (pending := subscription.pending.get(entity_id)) is not None:
+            event["data"]["old_state"] = pending["data"].get("old_state")
+            subscription.pending[entity_id] = event
+            self.coalesced_events += 1
+            return
+
+        now = asyncio.get_running_loop().time()
+        if now - subscription.sent_at.get(entity_id, -self._coalesce_window) >= self._coalesce_window:
+            subscription.sent_at[entity_id] = now
+            self._fan_out(subscription, event)
+            return
+
+        subscription.pending[entity_id] = event
+        if subscription.flush_handle is None:
+            subscription.flush_handle = asyncio.get_running_loop().call_later(
+                self._coalesce_window, self._flush, subscription)
+
+    def _flush(self, subscription: _SharedSubscription) -> None:
+        subscription.flush_handle = None
+        now = asyncio.get_running_loop().time()
+        pending, subscription.pending = subscription.pending, {}
+        for entity_id, event in pending.items():
+            subscription.sent_at[entity_id] = now
+            self._fan_out(subscription, event)
+
+    def _fan_out(self, subscription: _SharedSubscription, event: dict) -> None:
+        """
+        Serialize event once and send it to all clients of the subscription.
+        """
+        payload = json.dumps(event)
+        for session, client_id in list(subscription.listeners):
+            session.send(f'{{"id": {client_id}, "type": "event", "event": {payload}}}')
+            self.delivered_events += 1
+
+
+class _ClientSession:
+    """Websocket client connected through the tunnel and its own Home Assistant session."""
+
+    def __init__(
+        self,
+        fanout: WebsocketFanout,
+        protocol: ServerProtocol,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        self._fanout = fanout
+        self._protocol = protocol
+        self._reader = reader
+        self._writer = writer
+        self._queue: asyncio.Queue[str] = asyncio.Queue(_CLIENT_QUEUE_SIZE)
+        self._upstream: WebSocketClientProtocol | None = None
+        # Admin check of the client token, shared subscriptions are used only by admins
+        self._admin: asyncio.Future[bool | None] | None = None
+        self._closed = asyncio.Event()
+        self._close_code = _CLOSE_INTERNAL_ERROR
+        self._close_reason = ""
+        self.subscriptions: dict[int, _SharedSubscription] = {}
+        # Subscribe requests waiting for admin check or shared subscription, by client id
+        self._subscribing: dict[int, asyncio.Task] = {}
+        self._tasks: set[asyncio.Future] = set()
+
+    async def run(self) -> None:
+        """
+        Forward messages between the client and its Home Assistant session until one side closes.
+        """
+        try:
+            self._upstream = await websockets.connect(self._fanout.ha_url, max_size=None)
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as err:
+            _LOGGER.warning("Unable to open websocket to Home Assistant: %s", err)
+            self._send_close(_CLOSE_INTERNAL_ERROR, "Home Assistant is not available")
+            return
+
+        tasks = [
+            asyncio.ensure_future(self._client_loop()),
+            asyncio.ensure_future(self._upstream_loop()),
+            asyncio.ensure_future(self._send_loop()),
+            asyncio.ensure_future(self._closed.wait()),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if (err := task.exception()) is not None:
+                    _LOGGER.debug("Websocket connection broken: %r", err)
+        finally:
+            for task in [*tasks, *self._subscribing.values(), *self._tasks]:
+                task.cancel()
+            await self._upstream.close()
+
+        if self._upstream.close_code is not None and not self._closed.is_set():
+            self._close_code, self._close_reason = self._upstream.close_code, self._upstream.close_reason
+        self._send_close(self._close_code, self._close_reason)
+
+    def send(self, message: str) -> None:
+        """
+        Queue message for the client, slow client which does not read its messages is disconnected.
+        """
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            _LOGGER.warning("Websocket client does not read its messages, disconnect it")
+            self.close(_CLOSE_TRY_AGAIN, "Client is too slow")
+
+    def close(self, code: int, reason: str) -> None:
+        """
+        Disconnect the client.
+        """
+        self._close_code = code
+        self._close_reason = reason
+        self._closed.set()
+
+    async def _client_loop(self) -> None:
+        """
+        Read messages of the client and forward them to its session or shared subscriptions.
+        """
+        fragments: list[bytes] = []
+        while data := await self._reader.read(_READ_CHUNK_SIZE):
+            self._protocol.receive_data(data)
+            for frame in self._protocol.events_received():
+                if frame.opcode in (Opcode.TEXT, Opcode.BINARY, Opcode.CONT):
+                    fragments.append(frame.data)
+                    if frame.fin:
+                        await self._from_client(b"".join(fragments).decode())
+                        fragments = []
+            # Answers to pings and close frames
+            self._flush()
+            if self._protocol.state is not State.OPEN:
+                return
+        self._protocol.receive_eof()
+
+    async def _from_client(self, data: str) -> None:
+        try:
+            message = json.loads(data)
+        except ValueError:
+            message = None
+
+        if isinstance(message, dict):
+            match message.get("type"):
+                case "auth":
+                    self._admin = self._fanout.check_admin(message.get("access_token"))
+                case "subscribe_events" if self._admin is not None:
+                    # Shared subscription may wait for Home Assistant, other messages are read meanwhile
+                    client_id = message.get("id")
+                    task = self._subscribing[client_id] = asyncio.ensure_future(self._subscribe(message, data))
+                    task.add_done_callback(lambda _: self._subscribing.pop(client_id, None))
+                    return
+                case "unsubscribe_events" if (subscribing := self._pending_subscribe(message.get("subscription"))):
+                    task = asyncio.ensure_future(self._unsubscribe_after(subscribing, data))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    return
+                case "unsubscribe_events" if message.get("subscription") in self.subscriptions:
+                    await self._fanout.unsubscribe(self, message["subscription"])
+                    self.send(json.dumps({"id": message.get("id"), "type": "result", "success": True, "result": None}))
+                    return
+
+        await self._upstream.send(data)
+
+    def _pending_subscribe(self, client_id: int) -> asyncio.Task | None:
+        if (task := self._subscribing.get(client_id)) is not None and not task.done():
+            return task
+        return None
+
+    async def _subscribe(self, message: dict, data: str) -> None:
+        """
+        Add admin client to shared subscription, other subscriptions are forwarded to its session.
+        """
+        try:
+            if await asyncio.shield(self._admin):
+                if (result := await self._fanout.subscribe(self, message)) is not None:
+                    self.send(result)
+                    return
+            await self._upstream.send(data)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _unsubscribe_after(self, subscribing: asyncio.Future, data: str) -> None:
+        """
+        Unsubscribe subscription which was not opened yet when the client cancelled it.
+        """
+        await asyncio.wait((subscribing,))
+        try:
+            await self._from_client(data)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _upstream_loop(self) -> None:
+        """
+        Queue messages of Home Assistant session for the client, waits while the queue is full.
+        """
+        async for message in self._upstream:
+            await self._queue.put(message if isinstance(message, str) else message.decode())
+
+    async def _send_loop(self) -> None:
+        while True:
+            message = await self._queue.get()
+            self._protocol.send_text(message.encode())
+            self._flush()
+            await self._writer.drain()
+
+    def _send_close(self, code: int, reason: str) -> None:
+        if self._protocol.state is State.OPEN:
+            self._protocol.send_close(code, reason)
+            self._flush()
+
+    def _flush(self) -> None:
+        if data := self._protocol.data_to_send():
+            self._writer.write(b"".join(data))
+
+
+async def _authenticate(url: str, token: str | None) -> WebSocketClientProtocol:
+    """
+    Open websocket to Home Assistant and authenticate it by access token.
+
+    :raises websockets.WebSocketException: when authentication failed
+    """
+    websocket = await websockets.connect(url, max_size=None)
+    try:
+        await websocket.recv()
+        await websocket.send(json.dumps({"type": "auth", "access_token": token}))
+        result = json.loads(await websocket.recv())
+        if result.get("type") != "auth_ok":
+            raise websockets.InvalidHandshake(f"Authentication failed: {result.get('message')}")
+    except BaseException:
+        await websocket.close()
+        raise
+    return websocket
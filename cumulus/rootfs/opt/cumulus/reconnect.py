@@ -0,0 +1,123 @@
+"""Schedule reconnects of server connection."""
+import logging
+import random
+import re
+import time
+from abc import ABC, abstractmethod
+
+from cumulus.const import RECONNECT_STRATEGY
+
+_LOGGER = logging.getLogger(__name__)
+
+LONG_RECONNECT_DELAY = 30*60  # 30 min
+# Connection which stayed open longer than this is considered healthy
+_STABLE_CONNECTION_TIME = 60
+_FIRST_RETRY_DELAY = 1
+_BACKOFF_BASE_DELAY = 2
+# Policy Violation - server refused the client
+_CLOSE_POLICY_VIOLATION = 1008
+# Try Again Later - server is overloaded
+_CLOSE_TRY_AGAIN_LATER = 1013
+_RETRY_AFTER_PATTERN = re.compile(r"retry[-_ ]after\s*[=:]\s*(\d+)", re.IGNORECASE)
+
+
+class ReconnectScheduler(ABC):
+    """Decide how long to wait before next connection attempt."""
+
+    def __init__(self) -> None:
+        self.attempts = 0
+        self.total_attempts = 0
+        self.total_downtime = 0.0
+        self._connected_at: float | None = None
+        self._disconnected_at: float | None = None
+
+    def connected(self) -> None:
+        """
+        Record successful connection.
+        """
+        now = time.monotonic()
+        if self._disconnected_at is not None:
+            downtime = now - self._disconnected_at
+            self.total_downtime += downtime
+            _LOGGER.info("Reconnected after %.1fs and %d attempts", downtime, self.attempts)
+            self._disconnected_at = None
+        self._connected_at = now
+
+    def disconnected(self, code: int | None, reason: str = "") -> float:
+        """
+        Record lost or failed connection.
+
+        :param code: websocket close code, `None` when connection was not established
+        :param reason: websocket close reason
+        :returns: delay in seconds before next attempt
+        """
+        now = time.monotonic()
+        if self._connected_at is not None and now - self._connected_at >= _STABLE_CONNECTION_TIME:
+            self.attempts = 0
+        if self._disconnected_at is None:
+            self._disconnected_at = now
+        self._connected_at = None
+
+        delay = self.next_delay(code, reason)
+        self.attempts += 1
+        self.total_attempts += 1
+        return delay
+
+    @abstractmethod
+    def next_delay(self, code: int | None, reason: str) -> float:
+        """
+        Get delay before next attempt. `self.attempts` holds number of previous failed attempts.
+        """
+        pass
+
+
+class FixedDelayScheduler(ReconnectScheduler):
+    """Always wait the same time."""
+
+    def __init__(self, delay: float = LONG_RECONNECT_DELAY) -> None:
+        super().__init__()
+        self._delay = delay
+
+    def next_delay(self, code: int | None, reason: str) -> float:
+        return self._delay
+
+
+class BackoffReconnectScheduler(ReconnectScheduler):
+    """
+    Capped exponential backoff with full jitter.
+
+    * First retry is almost immediate.
+    * Server hint `retry-after=<seconds>` in close reason is honored.
+    * Server refusing the client keeps the long delay.
+    """
+
+    def __init__(self, max_delay: float) -> None:
+        super().__init__()
+        self._max_delay = max_delay
+
+    def next_delay(self, code: int | None, reason: str) -> float:
+        if match := _RETRY_AFTER_PATTERN.search(reason or ""):
+            # Small jitter, so clients sent away together don't come back together
+            retry_after = int(match.group(1))
+            return retry_after + random.uniform(0, min(retry_after * 0.1, 30))
+
+        if code in (_CLOSE_POLICY_VIOLATION, _CLOSE_TRY_AGAIN_LATER):
+            return LONG_RECONNECT_DELAY
+
+        if self.attempts == 0:
+            return random.uniform(0, _FIRST_RETRY_DELAY)
+
+        cap = min(self._max_delay, _BACKOFF_BASE_DELAY * 2 ** self.attempts)
+        return random.uniform(0, cap)
+
+
+def create_reconnect_scheduler(config: 'CumulusConfig') -> ReconnectScheduler:
+    """
+    Create scheduler selected by `reconnect_strategy` configuration.
+    """
+    match config.reconnect_strategy:
+        case RECONNECT_STRATEGY.FIXED:
+            return FixedDelayScheduler()
+
+        case _:
+            return BackoffReconnectScheduler(config.reconnect_max_delay)
@@ -0,0 +1,81 @@
+"""Persist tunnel parameters between add-on runs."""
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+from cumulus.ssh import TunnelParameters
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def key_fingerprint(public_key_file: Path) -> str | None:
+    """
+    Get SHA256 fingerprint of public key file or `None` when the key does not exist.
+    """
+    try:
+        return hashlib.sha256(public_key_file.read_bytes().strip()).hexdigest()
+    except OSError:
+        return None
+
+
+class SessionCache:
+    """
+    Last tunnel parameters confirmed by server.
+
+    Parameters are stored with fingerprint of the ssh key, they are valid only
+    as long as the same key is used. Methods do file I/O, run them in executor.
+    """
+
+    def __init__(self, path: Path, public_key_file: Path) -> None:
+        """
+        Init cache.
+
+        :param path: state file
+        :param public_key_file: public key used by the tunnel
+        """
+        self._path = path
+        self._public_key_file = public_key_file
+
+    def load(self) -> TunnelParameters | None:
+        """
+        Get stored parameters or `None` when there are none or the key was changed.
+        """
+        try:
+            with open(self._path, "r", encoding="utf-8") as state_file:
+                state = json.load(state_file)
+            params = TunnelParameters(**state["tunnel"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            _LOGGER.warning("Ignore invalid session file %s: %s", self._path, err)
+            return None
+
+        if state.get("key_fingerprint") != key_fingerprint(self._public_key_file):
+            _LOGGER.debug("SSH key was changed since the session was stored")
+            return None
+        return params
+
+    def save(self, params: TunnelParameters) -> None:
+        """
+        Store parameters with fingerprint of current key.
+        """
+        state = {
+            "tunnel": dataclasses.asdict(params),
+            "key_fingerprint": key_fingerprint(self._public_key_file),
+        }
+        tmp_path = self._path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as state_file:
+                json.dump(state, state_file)
+            os.replace(tmp_path, self._path)
+        except OSError as err:
+            _LOGGER.warning("Unable to store session file %s: %s", self._path, err)
+
+    def clear(self) -> None:
+        """
+        Remove stored parameters.
+        """
+        self._path.unlink(missing_ok=True)
@@ -0,0 +1,33 @@
+"""SSH tunnel implementations."""
+from pathlib import Path
+
+from cumulus.const import TUNNEL_MODE
+from cumulus.ssh.tunnel import SSHTunnel, TunnelParameters
+from cumulus.ssh.tunnel_autossh import AutosshTunnel
+
+
+def tunnel_class(tunnel_mode: str) -> type[SSHTunnel]:
+    """
+    Get tunnel implementation for `tunnel_mode` configuration.
+
+    Implementations with heavy dependencies are imported on first use.
+    """
+    match tunnel_mode:
+        case TUNNEL_MODE.INPROCESS:
+            from cumulus.ssh.tunnel_inprocess import InProcessTunnel
+            return InProcessTunnel
+
+        case _:
+            return AutosshTunnel
+
+
+def create_tunnel(
+    cumulus: 'Cumulus',
+    params: TunnelParameters,
+    identity_file: Path | None = None,
+    standby: bool = False,
+) -> SSHTunnel:
+    """
+    Create tunnel implementation selected by `tunnel_mode` configuration.
+    """
+    return tunnel_class(cumulus.config.tunnel_mode)(cumulus, params, identity_file, standby)
@@ -0,0 +1,229 @@
+"""Select ssh cipher, MAC and compression by benchmark on the host."""
+import dataclasses
+import hashlib
+import hmac
+import json
+import logging
+import os
+import platform
+import time
+import zlib
+from pathlib import Path
+from typing import Callable
+
+from cumulus.const import SSH_CIPHER_AUTO, SSH_COMPRESSION
+
+_LOGGER = logging.getLogger(__name__)
+
+# Bump when candidates or measurement change, cached results are measured again
+_CALIBRATION_VERSION = 1
+# Payload of one ssh packet
+_PACKET_SIZE = 16384
+# Time spent on each candidate in seconds
+_MEASURE_TIME = 0.03
+# Compression level used by OpenSSH
+_COMPRESSION_LEVEL = 6
+
+# Ciphers supported by OpenSSH client and asyncssh, AEAD ciphers do not use separate MAC
+_AEAD_CIPHERS = ("chacha20-poly1305@openssh.com", "aes128-gcm@openssh.com", "aes256-gcm@openssh.com")
+_CTR_CIPHERS = ("aes128-ctr", "aes256-ctr")
+_MACS = {
+    "hmac-sha2-256-etm@openssh.com": hashlib.sha256,
+    "hmac-sha2-512-etm@openssh.com": hashlib.sha512,
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class SSHCrypto:
+    """Algorithms of ssh connection in order of preference."""
+
+    ciphers: tuple[str, ...]
+    macs: tuple[str, ...]
+    compression: bool
+    # Measured bytes per second of ciphers including MAC, empty when not measured
+    throughput: dict[str, float] = dataclasses.field(default_factory=dict)
+
+    def ssh_args(self) -> list[str]:
+        """
+        Get OpenSSH client arguments.
+        """
+        return [
+            "-c", ",".join(self.ciphers),
+            "-m", ",".join(self.macs),
+            "-o", f"Compression={'yes' if self.compression else 'no'}",
+        ]
+
+    def asyncssh_options(self) -> dict[str, list[str]]:
+        """
+        Get keyword arguments of `asyncssh.connect`.
+        """
+        return {
+            "encryption_algs": list(self.ciphers),
+            "mac_algs": list(self.macs),
+            "compression_algs": ["zlib@openssh.com", "none"] if self.compression else ["none"],
+        }
+
+
+def select_crypto(cache_file: Path, cipher: str, compression: str) -> SSHCrypto:
+    """
+    Get algorithms for ssh connection.
+
+    Benchmark runs once, its result is stored in `cache_file` and measured again only
+    when the host or the crypto library changes. Configured values take precedence.
+    Blocks for a fraction of second on the first run, call it in executor.
+
+    :param cipher: configured cipher or `SSH_CIPHER_AUTO`
+    :param compression: one of `SSH_COMPRESSION`
+    """
+    if cipher == SSH_CIPHER_AUTO or compression == SSH_COMPRESSION.AUTO:
+        crypto = _load(cache_file)
+        if crypto is None:
+            crypto = _calibrate()
+            _store(cache_file, crypto)
+    else:
+        crypto = SSHCrypto(_AEAD_CIPHERS + _CTR_CIPHERS, tuple(_MACS), False)
+
+    if cipher != SSH_CIPHER_AUTO:
+        crypto = dataclasses.replace(crypto, ciphers=(cipher,))
+    if compression != SSH_COMPRESSION.AUTO:
+        crypto = dataclasses.replace(crypto, compression=compression == SSH_COMPRESSION.YES)
+    return crypto
+
+
+def _fingerprint() -> dict[str, str | int]:
+    """
+    Identify conditions of the benchmark.
+    """
+    import cryptography
+
+    return {
+        "version": _CALIBRATION_VERSION,
+        "machine": platform.machine(),
+        "cryptography": cryptography.__version__,
+    }
+
+
+def _load(cache_file: Path) -> SSHCrypto | None:
+    """
+    Load stored benchmark result, `None` when it is missing or outdated.
+    """
+    try:
+        with open(cache_file, "r", encoding="utf-8") as file:
+            state = json.load(file)
+        if state.get("fingerprint") != _fingerprint():
+            _LOGGER.info("Host or crypto library changed since ssh calibration")
+            return None
+        return SSHCrypto(
+            tuple(state["ciphers"]), tuple(state["macs"]), bool(state["compression"]), state["throughput"])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        _LOGGER.warning("Ignore invalid ssh calibration file %s: %s", cache_file, err)
+        return None
+
+
+def _store(cache_file: Path, crypto: SSHCrypto) -> None:
+    state = {"fingerprint": _fingerprint(), **dataclasses.asdict(crypto)}
+    tmp_path = cache_file.with_suffix(".tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, cache_file)
+    except OSError as err:
+        _LOGGER.warning("Unable to store ssh calibration file %s: %s", cache_file, err)
+
+
+def _calibrate() -> SSHCrypto:
+    """
+    Measure ciphers, MACs and compression on single ssh packets.
+
+    Compression is enabled only when it lowers CPU time per forwarded byte, i.e. when
+    compressed data are encrypted so much faster that it pays for the compression.
+    """
+    _LOGGER.info("Benchmark ssh ciphers and compression on this host")
+    payload = _sample_payload()
+
+    mac_speed = {name: _measure(_mac(digest), payload) for name, digest in _MACS.items()}
+    macs = tuple(sorted(mac_speed, key=mac_speed.get, reverse=True))
+
+    throughput = {}
+    for name, encrypt in _ciphers().items():
+        speed = _measure(encrypt, payload)
+        if name in _CTR_CIPHERS:
+            speed = 1 / (1 / speed + 1 / mac_speed[macs[0]])
+        throughput[name] = speed
+    ciphers = tuple(sorted(throughput, key=throughput.get, reverse=True))
+
+    # New stream for every packet, repeated packet would be compressed unrealistically well
+    ratio = len(zlib.compress(payload, _COMPRESSION_LEVEL)) / len(payload)
+    compress_speed = _measure(lambda data: zlib.compress(data, _COMPRESSION_LEVEL), payload)
+    best = throughput[ciphers[0]]
+    compression = 1 / compress_speed + ratio / best < 1 / best
+
+    return SSHCrypto(ciphers, macs, compression, throughput)
+
+
+def _ciphers() -> dict[str, Callable[[bytes], bytes]]:
+    """
+    Get encrypt functions of candidate ciphers available in the crypto library.
+    """
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+    nonce = bytes(12)
+    factories = {
+        "chacha20-poly1305@openssh.com": lambda: ChaCha20Poly1305(os.urandom(32)),
+        "aes128-gcm@openssh.com": lambda: AESGCM(os.urandom(16)),
+        "aes256-gcm@openssh.com": lambda: AESGCM(os.urandom(32)),
+        "aes128-ctr": lambda: Cipher(algorithms.AES(os.urandom(16)), modes.CTR(bytes(16))).encryptor(),
+        "aes256-ctr": lambda: Cipher(algorithms.AES(os.urandom(32)), modes.CTR(bytes(16))).encryptor(),
+    }
+
+    ciphers = {}
+    for name, factory in factories.items():
+        try:
+            cipher = factory()
+        except UnsupportedAlgorithm:
+            _LOGGER.debug("Cipher %s is not supported by crypto library", name)
+            continue
+        if name in _AEAD_CIPHERS:
+            ciphers[name] = lambda data, aead=cipher: aead.encrypt(nonce, data, None)
+        else:
+            ciphers[name] = cipher.update
+    return ciphers
+
+
+def _mac(digest) -> Callable[[bytes], bytes]:
+    key = os.urandom(64)
+    return lambda data: hmac.digest(key, data, digest)
+
+
+def _measure(function: Callable[[bytes], bytes], payload: bytes) -> float:
+    """
+    Measure throughput of function processing packets.
+
+    :returns: bytes per second
+    """
+    packets = 0
+    start = time.perf_counter()
+    while (now := time.perf_counter()) - start < _MEASURE_TIME or packets == 0:
+        function(payload)
+        packets += 1
+    return packets * len(payload) / (now - start)
+
+
+def _sample_payload() -> bytes:
+    """
+    Get packet similar to Home Assistant API responses.
+    """
+    states = [
+        {
+            "entity_id": f"sensor.temperature_{index}",
+            "state": f"{20 + index % 7}.{index % 10}",
+            "attributes": {"unit_of_measurement": "°C", "friendly_name": f"Temperature {index}"},
+            "last_changed": f"2023-04-01T12:{index % 60:02d}:00+00:00",
+        }
+        for index in range(200)
+    ]
+    return json.dumps(states).encode()[:_PACKET_SIZE]
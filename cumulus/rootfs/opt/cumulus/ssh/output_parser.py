@@ -0,0 +1,108 @@
+"""Parser of ssh client `-v` output."""
+import dataclasses
+import re
+
+from cumulus.const import SSH_EVENT, TUNNEL_EXIT
+
+_DEBUG_PREFIX = b"debug1: "
+_CHANNEL_RE = re.compile(rb"channel (\d+): (new|free)\b")
+
+# Debug messages of ssh client reporting tunnel events
+_DEBUG_MESSAGES = (
+    (b"remote forward success", SSH_EVENT.FORWARD_ESTABLISHED),
+    # Forward requested through control socket
+    (b"mux_confirm_remote_forward: success", SSH_EVENT.FORWARD_ESTABLISHED),
+    # OpenSSH before 8.8
+    (b"Authentication succeeded", SSH_EVENT.AUTH_SUCCESS),
+)
+
+# Messages of ssh client without debug prefix, failures have the reason of tunnel exit
+_MESSAGES = (
+    (b"Authenticated to", SSH_EVENT.AUTH_SUCCESS, None),
+    (b"Permission denied", SSH_EVENT.AUTH_FAILURE, TUNNEL_EXIT.AUTH),
+    (b"Too many authentication failures", SSH_EVENT.AUTH_FAILURE, TUNNEL_EXIT.AUTH),
+    (b"Host key verification failed", SSH_EVENT.AUTH_FAILURE, TUNNEL_EXIT.AUTH),
+    (b"remote port forwarding failed", SSH_EVENT.FORWARD_FAILED, TUNNEL_EXIT.FORWARD_CONFLICT),
+    (b"Timeout, server", SSH_EVENT.KEEPALIVE_TIMEOUT, TUNNEL_EXIT.NETWORK),
+    (b"Connection refused", SSH_EVENT.CONNECTION_ERROR, TUNNEL_EXIT.NETWORK),
+    (b"Connection timed out", SSH_EVENT.CONNECTION_ERROR, TUNNEL_EXIT.NETWORK),
+    (b"Connection reset", SSH_EVENT.CONNECTION_ERROR, TUNNEL_EXIT.NETWORK),
+    (b"Connection closed by", SSH_EVENT.CONNECTION_ERROR, TUNNEL_EXIT.NETWORK),
+    (b"No route to host", SSH_EVENT.CONNECTION_ERROR, TUNNEL_EXIT.NETWORK),
+    (b"Network is unreachable", SSH_EVENT.CONNECTION_ERROR, TUNNEL_EXIT.NETWORK),
+    (b"Could not resolve hostname", SSH_EVENT.CONNECTION_ERROR, TUNNEL_EXIT.NETWORK),
+    (b"Broken pipe", SSH_EVENT.CONNECTION_ERROR, TUNNEL_EXIT.NETWORK),
+    (b"kex_exchange_identification", SSH_EVENT.CONNECTION_ERROR, TUNNEL_EXIT.NETWORK),
+)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class SSHEvent:
+    """Event of ssh connection."""
+
+    # One of `SSH_EVENT`
+    kind: str
+    # Channel number for channel events
+    channel: int | None = None
+    # Reason of tunnel exit (`TUNNEL_EXIT`) for failures
+    reason: str | None = None
+
+
+class SSHOutputParser:
+    """
+    Streaming parser turning lines of ssh client output into events.
+
+    Only channels of forwarded connections are tracked, their number is
+    available in `active_channels`.
+    """
+
+    def __init__(self) -> None:
+        self._channels: set[int] = set()
+        self._forward_requested = False
+
+    @property
+    def active_channels(self) -> int:
+        """
+        Number of open channels of forwarded connections.
+        """
+        return len(self._channels)
+
+    def feed(self, line: bytes) -> SSHEvent | None:
+        """
+        Parse single line of output.
+
+        :returns: `None` when the line doesn't report a known event
+        """
+        if line.startswith(_DEBUG_PREFIX):
+            return self._parse_debug(line)
+
+        for message, kind, reason in _MESSAGES:
+            if message in line:
+                return SSHEvent(kind, reason=reason)
+        return None
+
+    def _parse_debug(self, line: bytes) -> SSHEvent | None:
+        # Channel lines are the most frequent ones on busy tunnels
+        if (match := _CHANNEL_RE.search(line, len(_DEBUG_PREFIX))) is not None:
+            channel = int(match[1])
+            if match[2] == b"new":
+                if not self._forward_requested:
+                    return None
+                self._forward_requested = False
+                self._channels.add(channel)
+                return SSHEvent(SSH_EVENT.CHANNEL_OPEN, channel=channel)
+
+            if channel not in self._channels:
+                return None
+            self._channels.discard(channel)
+            return SSHEvent(SSH_EVENT.CHANNEL_CLOSE, channel=channel)
+
+        if b"client_request_forwarded_tcpip" in line:
+            # Channel for the connection is created next
+            self._forward_requested = True
+            return None
+
+        for message, kind in _DEBUG_MESSAGES:
+            if message in line:
+                return SSHEvent(kind)
+        return None
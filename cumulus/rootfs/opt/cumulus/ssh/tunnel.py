@@ -0,0 +1,213 @@
+"""Common tunnel implementations."""
+import asyncio
+import dataclasses
+import logging
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from cumulus.const import SSH_EVENT, TUNNEL_EXIT
+from .output_parser import SSHEvent
+
+_LOGGER = logging.getLogger(__name__)
+# Exit code of ssh client for connection errors
+_FAILED_EXIT_CODE = 255
+
+
+@dataclasses.dataclass(frozen=True)
+class TunnelParameters:
+    """Parameters of the ssh connection received from server."""
+
+    host: str
+    user: str
+    port: int
+    forwarding_port: int
+
+
+class SSHTunnel(ABC):
+    """Single ssh connection with remote port forwarding to Home Assistant."""
+
+    def __init__(
+        self,
+        cumulus: 'Cumulus',
+        params: TunnelParameters,
+        identity_file: Path | None = None,
+        standby: bool = False,
+    ) -> None:
+        """
+        Init tunnel.
+
+        :param cumulus: root object of the add-on
+        :param params: ssh connection parameters
+        :param identity_file: private key used for authentication, current add-on key by default
+        :param standby: authenticate, but request remote forward only after `activate`
+        """
+        self._cumulus = cumulus
+        self.params = params
+        self.identity_file = identity_file or cumulus.config.config_dir / ".ssh" / "id_key"
+        self.established_at: float | None = None
+        self.exit_reason: str | None = None
+        self.active_channels = 0
+        # Server does not forward new connections to released tunnel
+        self.forward_released = False
+        self.authenticated = asyncio.Event()
+        self.established = asyncio.Event()
+        self.finished = asyncio.Event()
+        # Exit reason of tunnel closed by `fail`
+        self._failure: str | None = None
+        # Cleared while standby tunnel waits for activation
+        self._forward_allowed = asyncio.Event()
+        if not standby:
+            self._forward_allowed.set()
+        # Set while there are no active channels
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def _handle_event(self, event: SSHEvent) -> None:
+        """
+        Update tunnel state by ssh connection event and count it.
+        """
+        match event.kind:
+            case SSH_EVENT.AUTH_SUCCESS:
+                self.authenticated.set()
+            case SSH_EVENT.FORWARD_ESTABLISHED:
+                _LOGGER.info("Remote forward established on port %d", self.params.forwarding_port)
+                self.established_at = time.monotonic()
+                self.established.set()
+            case SSH_EVENT.CHANNEL_OPEN:
+                self.active_channels += 1
+                self._idle.clear()
+            case SSH_EVENT.CHANNEL_CLOSE:
+                self.active_channels -= 1
+                if self.active_channels <= 0:
+                    self._idle.set()
+            case SSH_EVENT.KEEPALIVE_TIMEOUT:
+                _LOGGER.warning("SSH server does not respond to keepalive")
+
+        if event.reason is not None:
+            self.exit_reason = event.reason
+        self._cumulus.tunnel.ssh_events.inc(event=event.kind)
+
+    async def run(self) -> int:
+        """
+        Connect and keep tunnel running until it is closed or fails.
+
+        Reason of the exit is available in `exit_reason` afterwards.
+
+        :returns: exit code, zero when tunnel was closed on request
+        """
+        try:
+            exit_code = await self._run()
+        finally:
+            self.finished.set()
+
+        if self._failure is not None:
+            self.exit_reason = self._failure
+            return _FAILED_EXIT_CODE
+        if exit_code == 0:
+            self.exit_reason = TUNNEL_EXIT.CLOSED
+        elif self.exit_reason is None:
+            self.exit_reason = TUNNEL_EXIT.UNKNOWN
+        return exit_code
+
+    async def wait_established(self, timeout: float) -> bool:
+        """
+        Wait until remote forward is established.
+
+        :returns: `False` when tunnel failed or timeout expired before
+        """
+        return await self._wait_for(self.established, timeout)
+
+    async def wait_authenticated(self, timeout: float) -> bool:
+        """
+        Wait until ssh connection is authenticated.
+
+        :returns: `False` when tunnel failed or timeout expired before
+        """
+        return await self._wait_for(self.authenticated, timeout)
+
+    def activate(self) -> None:
+        """
+        Request remote forward of standby tunnel.
+        """
+        self._forward_allowed.set()
+
+    async def release_forward(self) -> None:
+        """
+        Cancel remote forward if the implementation supports it.
+
+        Server stops forwarding new connections and another connection can request
+        the port, open channels continue.
+        """
+        self.forward_released = True
+        await self._release_forward()
+
+    async def fail(self, reason: str) -> None:
+        """
+        Close tunnel which does not work, `run` exits with error so the tunnel is restarted.
+
+        :param reason: exit reason, one of `TUNNEL_EXIT`
+        """
+        self._failure = reason
+        await self.close()
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Wait until forwarded connections are closed, at most `timeout` seconds.
+        """
+        if self._idle.is_set() or self.finished.is_set() or timeout <= 0:
+            return
+
+        _LOGGER.info("Drain %d active channels, wait up to %ds", self.active_channels, timeout)
+        await self.release_forward()
+        idle = asyncio.ensure_future(self._idle.wait())
+        finished = asyncio.ensure_future(self.finished.wait())
+        try:
+            await asyncio.wait((idle, finished), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            idle.cancel()
+            finished.cancel()
+        if self.active_channels > 0:
+            _LOGGER.warning("Close tunnel with %d active channels", self.active_channels)
+
+    async def _wait_for(self, event: asyncio.Event, timeout: float) -> bool:
+        """
+        Wait until event is set or tunnel is finished.
+        """
+        waiter = asyncio.ensure_future(event.wait())
+        finished = asyncio.ensure_future(self.finished.wait())
+        try:
+            await asyncio.wait((waiter, finished), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            finished.cancel()
+        return event.is_set() and not self.finished.is_set()
+
+    async def _release_forward(self) -> None:
+        """
+        Implementation of `release_forward`.
+        """
+        pass
+
+    @abstractmethod
+    async def _run(self) -> int:
+        """
+        Implementation of `run`.
+        """
+        pass
+
+    @abstractmethod
+    async def open_probe_connection(self) -> tuple['asyncio.StreamReader', 'asyncio.StreamWriter']:
+        """
+        Open connection to the forwarded port on the server through the ssh connection.
+
+        :raises OSError: when the connection can't be opened
+        """
+        pass
+
+    @abstractmethod
+    async def close(self) -> None:
+        """
+        Close running tunnel.
+        """
+        pass
@@ -0,0 +1,205 @@
+"""Tunnel running in autossh subprocess."""
+import asyncio
+import logging
+import os
+import secrets
+import socket
+import tempfile
+from pathlib import Path
+
+from cumulus.const import TUNNEL_EXIT
+from cumulus.log import rate_limit
+from .output_parser import SSHOutputParser
+from .tunnel import SSHTunnel, TunnelParameters
+
+_LOGGER = logging.getLogger(__name__)
+# Output of ssh client, verbose output has several lines for every forwarded connection
+_SSH_LOGGER = logging.getLogger(f"{__name__}.ssh")
+# Lines of ssh output logged per second and in burst
+_LOG_RATE = 10
+_LOG_BURST = 100
+rate_limit(_SSH_LOGGER.name, _LOG_RATE, _LOG_BURST)
+# Seconds to wait for terminated process before it is killed
+_TERMINATE_TIMEOUT = 2
+# Starts of ssh by autossh limited to one address family, the tunnel is then restarted and the family selected again
+_FAMILY_MAX_STARTS = 3
+
+
+class AutosshTunnel(SSHTunnel):
+    """Tunnel handled by external autossh process."""
+
+    def __init__(
+        self,
+        cumulus: 'Cumulus',
+        params: TunnelParameters,
+        identity_file: Path | None = None,
+        standby: bool = False,
+    ) -> None:
+        """
+        Init autossh tunnel.
+        """
+        super().__init__(cumulus, params, identity_file, standby)
+        self._process: asyncio.subprocess.Process | None = None
+        self._process_terminated = False
+        self._forward: list[str] = []
+        # Control socket of ssh client, remote forward is requested and cancelled through it
+        socket_prefix = Path(tempfile.gettempdir()) / f"cumulus-ssh-{secrets.token_hex(4)}"
+        self._control_path = socket_prefix.with_suffix(".sock")
+        # Local socket forwarded to the remote forwarded port, added on the first probe
+        self._probe_path = socket_prefix.with_suffix(".probe")
+        self._probe_forwarded = False
+        self._parser = SSHOutputParser()
+
+    @property
+    def _destination(self) -> str:
+        return f"{self.params.user}@{self.params.host}"
+
+    async def _run(self) -> int:
+        try:
+            # IPv4 and IPv6 addresses of server race, ssh resolves the host and uses the faster family
+            family = await self._cumulus.endpoints.select_family(self.params.host, self.params.port)
+        except OSError as err:
+            _LOGGER.debug("Unable to select address family of server: %s", err)
+            family = None
+
+        local_ip = self._cumulus.config.ha_ip_address
+        local_port = self._cumulus.config.ha_port
+
+        proxy = self._cumulus.proxy
+        if proxy.http_enabled:
+            # Forward to local HTTP stage which keeps connections to Home Assistant
+            await proxy.start()
+            local_ip = "127.0.0.1"
+            local_port = proxy.local_port
+
+        self._forward = ["-R", f"{self.params.forwarding_port}:{local_ip}:{local_port}"]
+        args = [
+            "-M", "0", "-vTN",
+            "-p", str(self.params.port),
+            "-i", str(self.identity_file),
+            # Only the key of this tunnel, standby tunnel must not fall back to the current key
+            "-o", "IdentitiesOnly=yes",
+            "-o", "ControlMaster=yes",
+            "-o", f"ControlPath={self._control_path}",
+            "-o", "StreamLocalBindUnlink=yes",
+        ]
+        if (crypto := self._cumulus.tunnel.ssh_crypto) is not None:
+            args.extend(crypto.ssh_args())
+        env = None
+        if family is not None:
+            args.extend(["-o", f"AddressFamily={'inet6' if family == socket.AF_INET6 else 'inet'}"])
+            # The family may stop working when the network changes, autossh must not restart
+            # ssh with it forever
+            env = {**os.environ, "AUTOSSH_MAXSTART": str(_FAMILY_MAX_STARTS)}
+        if self._forward_allowed.is_set():
+            args.extend(self._forward)
+        else:
+            # Standby connection gets the forward through control socket, autossh must not
+            # restart it without the forward
+            env = {**os.environ, "AUTOSSH_MAXSTART": "1"}
+        args.append(self._destination)
+
+        # Socket left by killed ssh client disables multiplexing of the new one
+        self._control_path.unlink(missing_ok=True)
+        self._process = await asyncio.create_subprocess_exec(
+            "autossh", *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=env,
+            # process_group=0
+        )
+        if self._process_terminated:
+            # Closed while starting
+            self._process.terminate()
+
+        activation = None
+        if not self._forward_allowed.is_set():
+            activation = asyncio.ensure_future(self._forward_on_activation())
+        try:
+            # Read until the end, the last lines explain exit of the process
+            while log := await self._process.stdout.readline():
+                self._ssh_log(log)
+
+            await self._process.wait()
+        finally:
+            if activation is not None:
+                activation.cancel()
+
+        if self._process_terminated:
+            return 0
+        return self._process.returncode
+
+    async def close(self) -> None:
+        self._process_terminated = True
+        if self._process is not None and self._process.returncode is None:
+            _LOGGER.debug("Terminate ssh process")
+            self._process.terminate()
+            try:
+                await asyncio.wait_for(self._process.wait(), _TERMINATE_TIMEOUT)
+            except asyncio.TimeoutError:
+                _LOGGER.warning("Kill ssh process not terminated in %ds", _TERMINATE_TIMEOUT)
+                self._process.kill()
+                await self._process.wait()
+        self._control_path.unlink(missing_ok=True)
+        self._probe_path.unlink(missing_ok=True)
+
+    async def _release_forward(self) -> None:
+        if self._process is not None and self._process.returncode is None:
+            await self._control("cancel", self._forward)
+
+    async def open_probe_connection(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if self._process is None or self._process.returncode is not None:
+            raise ConnectionError("SSH process is not running")
+        if not self._probe_forwarded:
+            probe_forward = ["-L", f"{self._probe_path}:localhost:{self.params.forwarding_port}"]
+            if not await self._control("forward", probe_forward):
+                raise ConnectionError("SSH client did not forward probe socket")
+            self._probe_forwarded = True
+        try:
+            return await asyncio.open_unix_connection(str(self._probe_path))
+        except OSError:
+            # Forward is lost when autossh restarts ssh, request it again next time
+            self._probe_forwarded = False
+            raise
+
+    async def _forward_on_activation(self) -> None:
+        """
+        Request remote forward of standby connection when the tunnel is activated.
+        """
+        await self._forward_allowed.wait()
+        if not await self._control("forward", self._forward):
+            _LOGGER.warning("Remote forward of standby connection failed")
+            self.exit_reason = TUNNEL_EXIT.FORWARD_CONFLICT
+            self._process.terminate()
+
+    async def _control(self, command: str, args: list[str]) -> bool:
+        """
+        Send command to the running ssh client through its control socket.
+
+        :returns: `True` when the command succeeded
+        """
+        process = await asyncio.create_subprocess_exec(
+            "ssh", "-S", str(self._control_path), "-O", command, *args, self._destination,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            _LOGGER.debug("SSH control command %s failed: %s", command, stderr.strip().decode(errors="replace"))
+        return process.returncode == 0
+
+    def _ssh_log(self, line: bytes) -> None:
+        """
+        Handle line produced by ssh client.
+
+        Events are recognized in every line. Debug lines are logged only at debug level,
+        all lines are rate limited by the logger.
+        """
+        if (event := self._parser.feed(line)) is not None:
+            self._handle_event(event)
+
+        if line.startswith(b"debug1: "):
+            if _SSH_LOGGER.isEnabledFor(logging.DEBUG):
+                _SSH_LOGGER.debug("%s", line.removeprefix(b"debug1: ").strip().decode(errors="replace"))
+        else:
+            _SSH_LOGGER.info("%s", line.strip().decode(errors="replace"))
@@ -0,0 +1,150 @@
+"""Tunnel running inside the add-on event loop."""
+import asyncio
+import logging
+from pathlib import Path
+
+import asyncssh
+
+from cumulus.const import SSH_EVENT, TUNNEL_EXIT
+from .output_parser import SSHEvent
+from .tunnel import SSHTunnel, TunnelParameters
+
+_LOGGER = logging.getLogger(__name__)
+
+# Same values as in /root/.ssh/config used by autossh
+_KEEPALIVE_INTERVAL = 30
+_KEEPALIVE_COUNT_MAX = 3
+# Exit code of ssh client for connection errors
+_SSH_ERROR_CODE = 255
+
+
+class InProcessTunnel(SSHTunnel):
+    """Tunnel with remote forwarding handled by asyncssh on the event loop."""
+
+    def __init__(
+        self,
+        cumulus: 'Cumulus',
+        params: TunnelParameters,
+        identity_file: Path | None = None,
+        standby: bool = False,
+    ) -> None:
+        """
+        Init in-process tunnel.
+        """
+        super().__init__(cumulus, params, identity_file, standby)
+        self._connection: asyncssh.SSHClientConnection | None = None
+        self._listener: asyncssh.SSHListener | None = None
+        self._closing = False
+
+    async def _run(self) -> int:
+        crypto = self._cumulus.tunnel.ssh_crypto
+        try:
+            # IPv4 and IPv6 addresses of server race, the fastest one is used
+            sock = await self._cumulus.endpoints.connect_socket(self.params.host, self.params.port)
+            async with asyncssh.connect(
+                self.params.host,
+                self.params.port,
+                sock=sock,
+                username=self.params.user,
+                client_keys=[str(self.identity_file)],
+                known_hosts=None,
+                keepalive_interval=_KEEPALIVE_INTERVAL,
+                keepalive_count_max=_KEEPALIVE_COUNT_MAX,
+                **(crypto.asyncssh_options() if crypto is not None else {}),
+            ) as connection:
+                self._connection = connection
+                self._handle_event(SSHEvent(SSH_EVENT.AUTH_SUCCESS))
+                if self._closing:
+                    # Closed while connecting
+                    return 0
+                if await self._wait_for_activation(connection):
+                    self._listener = await connection.start_server(
+                        self._handler_factory, "localhost", self.params.forwarding_port)
+                    self._handle_event(SSHEvent(SSH_EVENT.FORWARD_ESTABLISHED))
+
+                    await connection.wait_closed()
+
+        except (OSError, asyncssh.Error, asyncssh.ChannelListenError) as err:
+            self._handle_event(InProcessTunnel._error_event(err))
+            if not self._closing:
+                _LOGGER.warning("SSH connection failed: %s", err)
+                return _SSH_ERROR_CODE
+        finally:
+            self._connection = None
+            self._listener = None
+
+        if self._closing:
+            return 0
+
+        _LOGGER.warning("SSH connection closed by server")
+        self.exit_reason = TUNNEL_EXIT.NETWORK
+        return _SSH_ERROR_CODE
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._connection is not None:
+            _LOGGER.debug("Close ssh connection")
+            self._connection.close()
+            await self._connection.wait_closed()
+
+    async def _release_forward(self) -> None:
+        if self._listener is not None:
+            self._listener.close()
+            await self._listener.wait_closed()
+
+    async def open_probe_connection(self) -> tuple[asyncssh.SSHReader, asyncssh.SSHWriter]:
+        if self._connection is None:
+            raise ConnectionError("SSH connection is not open")
+        try:
+            return await self._connection.open_connection("localhost", self.params.forwarding_port)
+        except asyncssh.ChannelOpenError as err:
+            raise ConnectionError(err.reason) from err
+
+    async def _wait_for_activation(self, connection: asyncssh.SSHClientConnection) -> bool:
+        """
+        Keep standby connection authenticated until the tunnel is activated.
+
+        :returns: `False` when the connection was closed before
+        """
+        if self._forward_allowed.is_set():
+            return True
+
+        _LOGGER.debug("Standby ssh connection authenticated, wait for activation")
+        activated = asyncio.ensure_future(self._forward_allowed.wait())
+        closed = asyncio.ensure_future(connection.wait_closed())
+        try:
+            done, _ = await asyncio.wait((activated, closed), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            activated.cancel()
+            closed.cancel()
+        return closed not in done
+
+    def _handler_factory(self, orig_host: str, orig_port: int):
+        """
+        Return handler for connection accepted on remote forwarded port.
+        """
+        _LOGGER.debug("Accept forwarded connection from %s:%d", orig_host, orig_port)
+        self._handle_event(SSHEvent(SSH_EVENT.CHANNEL_OPEN))
+        return self._handle_channel
+
+    async def _handle_channel(self, reader: asyncssh.SSHReader, writer: asyncssh.SSHWriter) -> None:
+        """
+        Forward connection of the channel and record its close.
+        """
+        try:
+            await self._cumulus.proxy.handle_connection(reader, writer)
+        finally:
+            self._handle_event(SSHEvent(SSH_EVENT.CHANNEL_CLOSE))
+
+    @staticmethod
+    def _error_event(err: Exception) -> SSHEvent:
+        """
+        Get event with exit reason (`TUNNEL_EXIT`) of connection error.
+        """
+        if isinstance(err, (asyncssh.PermissionDenied, asyncssh.HostKeyNotVerifiable)):
+            return SSHEvent(SSH_EVENT.AUTH_FAILURE, reason=TUNNEL_EXIT.AUTH)
+        if isinstance(err, asyncssh.ChannelListenError):
+            return SSHEvent(SSH_EVENT.FORWARD_FAILED, reason=TUNNEL_EXIT.FORWARD_CONFLICT)
+        if isinstance(err, (OSError, asyncssh.DisconnectError)):
+            return SSHEvent(SSH_EVENT.CONNECTION_ERROR, reason=TUNNEL_EXIT.NETWORK)
+        return SSHEvent(SSH_EVENT.CONNECTION_ERROR, reason=TUNNEL_EXIT.UNKNOWN)
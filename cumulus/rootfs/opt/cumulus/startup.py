@@ -0,0 +1,40 @@
+"""Timeline of add-on start."""
+import time
+
+# Last phase of the start, profiling ends with it
+STARTUP_FINISHED = "tunnel up"
+
+
+class StartupProfile:
+    """Time of start phases, enabled by `--profile-startup` argument."""
+
+    def __init__(self) -> None:
+        self._start = time.perf_counter()
+        # Phase to its end and start of concurrent phase since the add-on start
+        self._phases: dict[str, tuple[float, float | None]] = {}
+
+    def mark(self, phase: str, started: float | None = None) -> None:
+        """
+        Record end of phase. Only the first occurrence of each phase is recorded.
+
+        :param started: `time.perf_counter()` at start of phase running concurrently with
+            the others, its duration is then reported separately from the sequential phases
+        """
+        now = time.perf_counter()
+        self._phases.setdefault(
+            phase, (now - self._start, started - self._start if started is not None else None))
+
+    def report(self) -> str:
+        """
+        Format timeline of recorded phases.
+        """
+        lines = ["Startup profile:", f"  {'phase':<20} {'delta':>10} {'total':>10}"]
+        previous = 0.0
+        for phase, (elapsed, started) in sorted(self._phases.items(), key=lambda item: item[1][0]):
+            if started is not None:
+                lines.append(
+                    f"  {phase:<20} {(elapsed - started) * 1000:>8.1f}ms {elapsed * 1000:>8.1f}ms (concurrent)")
+                continue
+            lines.append(f"  {phase:<20} {(elapsed - previous) * 1000:>8.1f}ms {elapsed * 1000:>8.1f}ms")
+            previous = elapsed
+        return "\n".join(lines)
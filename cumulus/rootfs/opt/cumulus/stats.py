@@ -0,0 +1,36 @@
+"""Statistics helpers."""
+import collections
+
+
+class RollingHistogram:
+    """Keep last `size` samples and compute their percentiles."""
+
+    def __init__(self, size: int = 512) -> None:
+        self._samples: collections.deque[float] = collections.deque(maxlen=size)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value: float) -> None:
+        self._samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent: float) -> float | None:
+        """
+        Get percentile of kept samples using the nearest-rank method.
+
+        :param percent: value from range 0-100
+        :returns: percentile or `None` when there are no samples
+        """
+        if not self._samples:
+            return None
+
+        ordered = sorted(self._samples)
+        rank = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered) + 0.5)) - 1))
+        return ordered[rank]
+
+    def summary(self) -> dict[str, float | None]:
+        """
+        Get p50, p95 and p99 percentiles.
+        """
+        return {f"p{percent}": self.percentile(percent) for percent in (50, 95, 99)}
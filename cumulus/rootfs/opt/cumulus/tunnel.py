@@ -4,14 +4,33 @@ import os
 import sys
 import asyncio
 import time
+from pathlib import Path
 
-from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+import websockets
 
-from cumulus.messages.message_client import RefreshStatus
-from cumulus.const import REFRESH_KEYS_AFTER_DAYS
+from cumulus.messages.message_client import RefreshStatus, SetSSHKey
+from cumulus.const import REFRESH_KEYS_AFTER_DAYS, ROTATE_KEYS_BEFORE_DAYS, TUNNEL_EXIT, TUNNEL_STATE
+from cumulus.probe import TunnelProbe
+from cumulus.reconnect import BackoffReconnectScheduler
+from cumulus.session import SessionCache
+from cumulus.ssh import SSHTunnel, TunnelParameters, create_tunnel, tunnel_class
+from cumulus.ssh.crypto import SSHCrypto, select_crypto
+from cumulus.startup import STARTUP_FINISHED
 
 _LOGGER = logging.getLogger(__name__)
+# Time to wait for the new tunnel before the old one is closed
+_ESTABLISH_TIMEOUT = 30
+_MAX_RESTART_DELAY = 60
+# Server keeps the old remote listener until its keepalive detects the lost connection
+_FORWARD_CONFLICT_DELAY = 15
+# Interval of key age checks and time for server to confirm the next key
+_KEY_ROTATION_INTERVAL = 3600
+# Authentication attempts by the next key and seconds between them, server may store the key later
+_KEY_VERIFY_ATTEMPTS = 3
+_KEY_VERIFY_DELAY = 10
+# Failed probes in row after which the tunnel is restarted
+_PROBE_MAX_FAILED = 2
+_CONNECTION_AGE_BUCKETS = (60, 300, 900, 3600, 4 * 3600, 12 * 3600, 24 * 3600, 7 * 24 * 3600)
 
 
 class TunnelService:
@@ -21,13 +40,29 @@ class TunnelService:
         Init tunnel service.
         """
         self._cumulus = cumulus
-        self._process: asyncio.subprocess.Process | None = None
+        self._tunnel: SSHTunnel | None = None
         self._ssh_dir = cumulus.config.config_dir / ".ssh"
-        self._ssh_host: str | None = None
-        self._ssh_port: int | None = None
-        self._ssh_user: str | None = None
-        self._forwarding_port: int | None = None
-        self._process_terminated = False
+        self._next_key_file = self._ssh_dir / "id_key.next"
+        self._next_public_key_file = self._ssh_dir / "id_key.next.pub"
+        # Set by the first ready state after the next public key was sent to server
+        self._next_key_sent: asyncio.Event | None = None
+        self._candidate: SSHTunnel | None = None
+        # Tunnel opened with stored parameters, which were not confirmed by server yet
+        self._speculative: SSHTunnel | None = None
+        self._session = SessionCache(cumulus.config.config_dir / "session.json", self._ssh_dir / "id_key.pub")
+        self._restarts = BackoffReconnectScheduler(_MAX_RESTART_DELAY)
+        self._failure_budget = cumulus.config.tunnel_failure_budget
+        self.probe: TunnelProbe | None = None
+        if cumulus.config.tunnel_probe_interval > 0:
+            self.probe = TunnelProbe(
+                cumulus.config.tunnel_probe_interval, _PROBE_MAX_FAILED,
+                (cumulus.config.ha_ip_address, int(cumulus.config.ha_port)))
+        # Algorithms of ssh connections, ssh defaults are used when selection failed
+        self.ssh_crypto: SSHCrypto | None = None
+        # Set when ssh algorithms are selected, tunnels do not connect before
+        self._crypto_selected = asyncio.Event()
+        self.state = TUNNEL_STATE.STOPPED
+        self._setup_metrics(cumulus.metrics)
         cumulus.register_shutdown_handler(self._shutdown)
 
     def init_ssh_keys(self) -> str:
@@ -43,78 +78,412 @@ class TunnelService:
         """
         Open ssh tunnel.
 
+        When the tunnel is already opened with different parameters, new tunnel is opened
+        and the old one is closed after the new remote forward is established.
+
         :param host: host for ssh connection
         :param user: ssh user
         :param port: ssh port
         :param forwarding_port: port for remote forwarding
         """
+        params = TunnelParameters(host, user, port, forwarding_port)
+
+        if self._speculative is not None:
+            if self._speculative.params == params:
+                _LOGGER.info("Speculative tunnel confirmed by server")
+                # Tunnel was started before the server connection, let the server check it now
+                self._cumulus.create_task(self._cumulus.msg.send(RefreshStatus()), "tunnel-refresh")
+            self._speculative = None
+
+        if self._next_key_sent is not None:
+            # Any state may answer an earlier request, the next key is verified by authentication
+            self._next_key_sent.set()
+
+        if self._candidate is not None and self._candidate.params == params:
+            _LOGGER.debug("Skip open tunnel because is already opening.")
+            return
+
+        if self._tunnel is not None:
+            if self._tunnel.params == params:
+                _LOGGER.debug("Skip open tunnel because is already opened.")
+                return
+
+            _LOGGER.info("Tunnel parameters changed, replace the tunnel")
+            self._cumulus.create_task(self._replace_tunnel(params), "tunnel-replace")
+            return
+
+        self._start_tunnel(params)
+
+    async def prepare(self) -> None:
+        """
+        Prepare the tunnel while the server connection is being opened.
+
+        Tunnel implementation is imported and ssh algorithms are selected in executor,
+        so they do not block the event loop. With `warm_start` the tunnel is opened with
+        parameters stored by previous run, before the server sends them.
+        """
+        config = self._cumulus.config
+        await self._cumulus.run_in_executor(tunnel_class, config.tunnel_mode)
+        try:
+            self.ssh_crypto = await self._cumulus.run_in_executor(
+                select_crypto, config.config_dir / "ssh_crypto.json", config.ssh_cipher, config.ssh_compression)
+        finally:
+            self._crypto_selected.set()
+        _LOGGER.info(
+            "SSH ciphers=%s macs=%s compression=%s", ",".join(self.ssh_crypto.ciphers),
+            ",".join(self.ssh_crypto.macs), self.ssh_crypto.compression)
+
+        if not self._cumulus.config.warm_start:
+            return
+
+        params = await self._cumulus.run_in_executor(self._session.load)
+        if params is None or self._tunnel is not None:
+            return
+
+        _LOGGER.info("Open tunnel speculatively with stored parameters")
+        self._speculative = self._start_tunnel(params)
+
+    async def rotate_keys(self) -> None:
+        """
+        Rotate ssh key of running tunnel before it expires.
+
+        The next key is registered on server while the current key is still valid. When
+        the server answers, a tunnel authenticated by the next key replaces the running
+        one and only then the next key becomes the current one. Failed authentication
+        is retried, server may answer an earlier request before it stores the key.
+        """
+        while True:
+            created = await self._cumulus.run_in_executor(self._key_created)
+            if created is None or self.state != TUNNEL_STATE.ESTABLISHED:
+                # Key is created on registration, tunnel which is not running uses new key on start
+                delay = _KEY_ROTATION_INTERVAL
+            else:
+                delay = created + (REFRESH_KEYS_AFTER_DAYS - ROTATE_KEYS_BEFORE_DAYS) * 86400 - time.time()
+            if delay > 0:
+                await asyncio.sleep(min(delay, _KEY_ROTATION_INTERVAL))
+                continue
 
-        if self._process is not None:
-            _LOGGER.debug("Skip open tunnel because is already opened.")
+            _LOGGER.info("SSH key expires in %d days, register the next key", ROTATE_KEYS_BEFORE_DAYS)
+            next_key_sent = self._next_key_sent = asyncio.Event()
+            try:
+                next_public_key = await self._cumulus.run_in_executor(self._create_next_key)
+                await self._cumulus.msg.send(SetSSHKey(next_public_key))
+                await asyncio.wait_for(next_key_sent.wait(), _KEY_ROTATION_INTERVAL)
+            except (OSError, websockets.ConnectionClosed, asyncio.TimeoutError) as err:
+                _LOGGER.warning("Unable to register the next SSH key: %s", str(err) or "no response")
+                await self._abort_key_rotation()
+                await asyncio.sleep(_KEY_ROTATION_INTERVAL)
+                continue
+            finally:
+                self._next_key_sent = None
+
+            # Ready state does not tell which key server has, only the next key authenticated
+            # by server confirms it
+            for attempt in range(1, _KEY_VERIFY_ATTEMPTS + 1):
+                if self._tunnel is not None and await self._rotate_key(self._tunnel.params):
+                    break
+                if attempt < _KEY_VERIFY_ATTEMPTS:
+                    await asyncio.sleep(_KEY_VERIFY_DELAY)
+            else:
+                _LOGGER.warning("Server did not accept the next SSH key, keep the current key")
+                await self._abort_key_rotation()
+                await asyncio.sleep(_KEY_ROTATION_INTERVAL)
+
+    async def close_speculative(self) -> None:
+        """
+        Close speculative tunnel, server does not allow the tunnel now.
+        """
+        if (tunnel := self._speculative) is None:
             return
 
-        # TODO: Check if parameters changed then reconnect with new values
-        self._ssh_host = host
-        self._ssh_user = user
-        self._ssh_port = port
-        self._forwarding_port = forwarding_port
-        self._cumulus.create_task(self._open_tunnel(), "tunnel-service")
+        _LOGGER.info("Server did not confirm stored parameters, close speculative tunnel")
+        self._speculative = None
+        if tunnel is self._tunnel:
+            self._tunnel = None
+            self.state = TUNNEL_STATE.STOPPED
+        await tunnel.close()
+        await self._cumulus.run_in_executor(self._session.clear)
 
-    async def _open_tunnel(self):
+    def _start_tunnel(
+        self,
+        params: TunnelParameters,
+        identity_file: Path | None = None,
+        standby: bool = False,
+    ) -> SSHTunnel:
+        """
+        Create tunnel and run it in a new task.
+        """
         _LOGGER.debug(
             "Setup and open ssh tunnel to host=%s with user=%s, port=%d and forwarding_port=%d",
-            self._ssh_host, self._ssh_user, self._ssh_port, self._forwarding_port)
-
-        local_ip = self._cumulus.config.ha_ip_address
-        local_port = self._cumulus.config.ha_port
-        args = [
-            "-M", "0", "-vTN", "-4",
-            "-p", str(self._ssh_port),
-            "-R", f"{self._forwarding_port}:{local_ip}:{local_port}",
-            f"{self._ssh_user}@{self._ssh_host}",
-        ]
-
-        await self._cumulus.msg.send(RefreshStatus())
-
-        self._process = await asyncio.create_subprocess_exec(
-            "autossh", *args,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            # process_group=0
-        )
+            params.host, params.user, params.port, params.forwarding_port)
 
-        while self._process.returncode is None:
-            log = await self._process.stdout.readline()
-            if not log:
-                break
-            TunnelService._ssh_log(log)
+        tunnel = create_tunnel(self._cumulus, params, identity_file, standby)
+        if self._tunnel is None:
+            self._tunnel = tunnel
+        self._cumulus.create_task(self._open_tunnel(tunnel), "tunnel-service")
+        return tunnel
 
-        await self._process.wait()
+    async def _open_tunnel(self, tunnel: SSHTunnel):
+        """
+        Supervise the tunnel.
 
-        if self._process.returncode == 0 or self._process_terminated:
-            _LOGGER.info("SSH tunnel successfully exited")
-        else:
-            _LOGGER.warning("SSH tunnel exited with code=%d", self._process.returncode)
-            self._process = None
-            await self._cumulus.stop(1)
+        Failed tunnel is restarted with backoff, the add-on is stopped only when
+        the tunnel fails `tunnel_failure_budget` times in row.
+        """
+        await self._crypto_selected.wait()
+        while True:
+            if tunnel is not self._speculative:
+                await self._cumulus.msg.send(RefreshStatus())
 
-    async def _shutdown(self) -> None:
-        if self._process is not None:
-            _LOGGER.debug("Terminate ssh process")
-            self._process_terminated = True
-            self._process.terminate()
-            await self._process.wait()
+            self._tunnel_starts.inc()
+            if tunnel is self._tunnel:
+                self.state = TUNNEL_STATE.STARTING
+            self._cumulus.create_task(self._watch_established(tunnel), "tunnel-established")
+            exit_code = await tunnel.run()
+            if tunnel.established_at is not None:
+                self._connection_age.observe(time.monotonic() - tunnel.established_at)
 
-    @staticmethod
-    def _ssh_log(line: bytes) -> None:
+            if exit_code == 0:
+                _LOGGER.info("SSH tunnel successfully exited")
+                return
+
+            reason = tunnel.exit_reason
+            self._tunnel_failures.inc(reason=reason)
+            if tunnel is not self._tunnel:
+                _LOGGER.warning("Standby SSH tunnel exited with code=%d reason=%s", exit_code, reason)
+                return
+
+            if tunnel is self._speculative:
+                _LOGGER.warning(
+                    "Speculative SSH tunnel exited with code=%d reason=%s, wait for server", exit_code, reason)
+                self._speculative = None
+                self._tunnel = None
+                self.state = TUNNEL_STATE.STOPPED
+                await self._cumulus.run_in_executor(self._session.clear)
+                return
+
+            delay = self._restarts.disconnected(None)
+            if self._restarts.attempts >= self._failure_budget:
+                _LOGGER.error(
+                    "SSH tunnel exited with code=%d reason=%s, failed %d times in row, stop add-on",
+                    exit_code, reason, self._restarts.attempts)
+                self.state = TUNNEL_STATE.FAILED
+                self._tunnel = None
+                await self._cumulus.stop(1)
+                return
+
+            if reason == TUNNEL_EXIT.FORWARD_CONFLICT:
+                delay = max(delay, _FORWARD_CONFLICT_DELAY)
+            elif reason == TUNNEL_EXIT.AUTH:
+                # Server may have lost our key, register it again
+                public_key = await self._cumulus.run_in_executor(self.init_ssh_keys)
+                await self._cumulus.msg.send(SetSSHKey(public_key))
+
+            _LOGGER.warning(
+                "SSH tunnel exited with code=%d reason=%s, restart in %.1fs (failure %d of %d)",
+                exit_code, reason, delay, self._restarts.attempts, self._failure_budget)
+            self.state = TUNNEL_STATE.BACKOFF
+            await asyncio.sleep(delay)
+
+            if self._tunnel is not tunnel:
+                # Replaced by new parameters or closed in the meantime
+                return
+            tunnel = self._tunnel = create_tunnel(self._cumulus, tunnel.params)
+
+    async def _watch_established(self, tunnel: SSHTunnel) -> None:
+        """
+        Record established remote forward of supervised tunnel.
+        """
+        if await tunnel.wait_established(None) and tunnel is self._tunnel:
+            self._cumulus.mark_startup(STARTUP_FINISHED)
+            self.state = TUNNEL_STATE.ESTABLISHED
+            self._restarts.connected()
+            if tunnel is not self._speculative:
+                await self._cumulus.run_in_executor(self._session.save, tunnel.params)
+            if self.probe is not None:
+                self._cumulus.create_task(self._probe_tunnel(tunnel), "tunnel-probe")
+
+    async def _probe_tunnel(self, tunnel: SSHTunnel) -> None:
         """
-        Log line produces by ssh client.
+        Restart supervised tunnel which does not forward requests.
         """
-        log = line.strip().decode()
-        if log.startswith("debug1: "):
-            _LOGGER.debug(log.removeprefix("debug1: "))
-        else:
-            _LOGGER.info(log)
+        if await self.probe.run(tunnel) and tunnel is self._tunnel:
+            await tunnel.fail(TUNNEL_EXIT.PROBE)
+
+    async def _replace_tunnel(self, params: TunnelParameters) -> None:
+        """
+        Make-before-break replace of running tunnel.
+        """
+        old_tunnel = self._tunnel
+        if self._candidate is not None:
+            await self._candidate.close()
+
+        candidate = self._candidate = self._start_tunnel(params)
+        established = await candidate.wait_established(_ESTABLISH_TIMEOUT)
+        if self._candidate is not candidate:
+            # Replaced by newer parameters in the meantime
+            return
+        self._candidate = None
+
+        if not established:
+            # Old tunnel can block the new one (e.g. same forwarding port on the same server)
+            _LOGGER.warning("New tunnel was not established, close the old one before retry")
+            await candidate.close()
+            self._tunnel = None
+            if old_tunnel is not None:
+                await old_tunnel.close()
+            self._start_tunnel(params)
+            return
+
+        _LOGGER.info("New tunnel established, close the old one")
+        self._tunnel = candidate
+        self.state = TUNNEL_STATE.ESTABLISHED
+        if old_tunnel is not None:
+            await old_tunnel.drain(self._cumulus.config.tunnel_drain_timeout)
+            await old_tunnel.close()
+        await self._cumulus.run_in_executor(self._session.save, candidate.params)
+
+    async def _rotate_key(self, params: TunnelParameters) -> bool:
+        """
+        Move running tunnel to the next ssh key.
+
+        Server does not allow the same forwarded port twice, so the new tunnel only
+        authenticates by the next key first. The remote forward is moved to it after
+        the key is verified and the old tunnel finishes its open connections.
+
+        :returns: `False` when server did not accept the next key
+        """
+        old_tunnel = self._tunnel
+        if self._candidate is not None:
+            await self._candidate.close()
+
+        candidate = self._candidate = self._start_tunnel(params, self._next_key_file, standby=True)
+        authenticated = await candidate.wait_authenticated(_ESTABLISH_TIMEOUT)
+        if self._candidate is not candidate:
+            # Replaced by new parameters in the meantime, the next key is verified again
+            return False
+        self._candidate = None
+
+        if not authenticated:
+            # Running tunnel still works with the current key
+            _LOGGER.warning("Authentication by the next SSH key failed")
+            await candidate.close()
+            return False
+
+        await self._cumulus.run_in_executor(self._promote_next_key)
+        candidate.identity_file = self._ssh_dir / "id_key"
+        self._tunnel = candidate
+        if old_tunnel is not None:
+            await old_tunnel.release_forward()
+        candidate.activate()
+        if old_tunnel is not None:
+            await old_tunnel.drain(self._cumulus.config.tunnel_drain_timeout)
+            await old_tunnel.close()
+        return True
+
+    async def _abort_key_rotation(self) -> None:
+        """
+        Drop the next key and register the current one again.
+        """
+        public_key = await self._cumulus.run_in_executor(self._discard_next_key)
+        await self._cumulus.msg.send(SetSSHKey(public_key))
+
+    def _key_created(self) -> float | None:
+        """
+        Get creation time of the current key or `None` when there is no key.
+        """
+        try:
+            return os.stat(self._ssh_dir / "id_key").st_ctime
+        except FileNotFoundError:
+            return None
+
+    def _create_next_key(self) -> str:
+        """
+        Create the next key pair next to the current one.
+
+        :returns: next public key
+        """
+        return TunnelService._create_ssh_keys(self._next_key_file, self._next_public_key_file)
+
+    def _promote_next_key(self) -> None:
+        """
+        Replace the current key pair by the next one.
+        """
+        _LOGGER.info("Switched to the next SSH key")
+        os.replace(self._next_key_file, self._ssh_dir / "id_key")
+        os.replace(self._next_public_key_file, self._ssh_dir / "id_key.pub")
+
+    def _discard_next_key(self) -> str:
+        """
+        Remove the next key pair.
+
+        :returns: current public key
+        """
+        self._next_key_file.unlink(missing_ok=True)
+        self._next_public_key_file.unlink(missing_ok=True)
+        return (self._ssh_dir / "id_key.pub").read_text(encoding="ascii")
+
+    def _setup_metrics(self, metrics: 'MetricsRegistry') -> None:
+        """
+        Register metrics of the service.
+        """
+        self._tunnel_starts = metrics.counter("cumulus_tunnel_starts_total", "Started ssh tunnels")
+        self._tunnel_failures = metrics.counter(
+            "cumulus_tunnel_failures_total", "SSH tunnels exited with error", ["reason"])
+        metrics.counter("cumulus_tunnel_restarts_total", "Restarts of failed ssh tunnel",
+                        callback=lambda: self._restarts.total_attempts)
+        metrics.gauge("cumulus_tunnel_state", "Current state of ssh tunnel supervisor", ["state"],
+                      callback=lambda: [((state,), float(state == self.state))
+                                        for state in vars(TUNNEL_STATE).values()])
+        self.ssh_events = metrics.counter("cumulus_ssh_events_total", "Events of ssh connections", ["event"])
+        metrics.gauge("cumulus_ssh_active_channels", "Open channels of forwarded connections",
+                      callback=self._active_channels)
+        self._connection_age = metrics.histogram(
+            "cumulus_ssh_connection_age_seconds", "Time from established remote forward to tunnel exit",
+            buckets=_CONNECTION_AGE_BUCKETS)
+        metrics.gauge("cumulus_ssh_crypto_info", "Preferred algorithms of ssh connections",
+                      ["cipher", "mac", "compression"], callback=self._crypto_info)
+        metrics.gauge("cumulus_ssh_cipher_throughput_bytes_per_second", "Measured throughput of ssh ciphers",
+                      ["cipher"], callback=self._cipher_throughput)
+        if self.probe is not None:
+            metrics.summary(
+                "cumulus_tunnel_probe_rtt_seconds", "End-to-end round trip time of tunnel probe", self.probe.rtt)
+            metrics.counter(
+                "cumulus_tunnel_probe_failures_total", "Tunnel probes without response",
+                callback=lambda: self.probe.failures)
+        metrics.gauge("cumulus_tunnel_uptime_seconds", "Time since remote forward was established",
+                      callback=self._uptime)
+
+    def _active_channels(self) -> float:
+        tunnels = (self._tunnel, self._candidate)
+        return sum(
+            tunnel.active_channels for tunnel in tunnels if tunnel is not None and not tunnel.finished.is_set())
+
+    def _crypto_info(self) -> list[tuple[tuple[str, ...], float]]:
+        if (crypto := self.ssh_crypto) is None:
+            return []
+        return [((crypto.ciphers[0], crypto.macs[0], str(crypto.compression).lower()), 1.0)]
+
+    def _cipher_throughput(self) -> list[tuple[tuple[str, ...], float]]:
+        if self.ssh_crypto is None:
+            return []
+        return [((cipher,), speed) for cipher, speed in self.ssh_crypto.throughput.items()]
+
+    def _uptime(self) -> float:
+        if self._tunnel is None or self._tunnel.established_at is None:
+            return 0
+        return time.monotonic() - self._tunnel.established_at
+
+    async def _shutdown(self) -> None:
+        tunnel, self._tunnel = self._tunnel, None
+        candidate, self._candidate = self._candidate, None
+        self._speculative = None
+        self.state = TUNNEL_STATE.STOPPED
+        if candidate is not None:
+            await candidate.close()
+        if tunnel is not None:
+            await tunnel.drain(self._cumulus.config.tunnel_drain_timeout)
+            await tunnel.close()
 
     @staticmethod
     def _check_ssh_directory(ssh_dir: str) -> None:
@@ -159,6 +528,9 @@ class TunnelService:
         """
         Create Ed25519 key pair and return public key.
         """
+        from cryptography.hazmat.primitives import serialization as crypto_serialization
+        from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
         _LOGGER.info("Refresh SSH ID keys.")
         key = Ed25519PrivateKey.generate()
         private_key = key.private_bytes(
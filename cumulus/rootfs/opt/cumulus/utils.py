@@ -1,6 +1,5 @@
 """Utility helpers."""
 import contextlib
-import ctypes
 import inspect
 import logging
 import sys
@@ -9,10 +8,13 @@ import traceback
 import subprocess
 import asyncio
 import os
+import weakref
 
 from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
-from typing import Any
+from typing import Any, Callable
+
+from cumulus.const import EVENT_LOOP
 
 EXECUTOR_SHUTDOWN_TIMEOUT = 10
 MAX_LOG_ATTEMPTS = 2
@@ -21,19 +23,30 @@ ALPINE_RELEASE_FILE = "/etc/alpine-release"
 MAX_EXECUTOR_WORKERS = 16
 
 _LOGGER = logging.getLogger(__name__)
+# Default executors of loops created by the policy, uvloop does not expose it
+_LOOP_EXECUTORS: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, ThreadPoolExecutor]' = \
+    weakref.WeakKeyDictionary()
 
 
-def _log_thread_running_at_shutdown(name: str, ident: int) -> None:
+def format_thread_stack(ident: int) -> str:
     """
-    Log the stack of a thread that was still running at shutdown.
+    Format current stack of the thread.
     """
     frames = sys._current_frames()  # pylint: disable=protected-access
     stack = frames.get(ident)
-    formatted_stack = traceback.format_stack(stack)
+    if stack is None:
+        return ""
+    return "".join(traceback.format_stack(stack)).strip()
+
+
+def _log_thread_running_at_shutdown(name: str, ident: int) -> None:
+    """
+    Log the stack of a thread that was still running at shutdown.
+    """
     _LOGGER.warning(
         "Thread[%s] is still running at shutdown: %s",
         name,
-        "".join(formatted_stack).strip(),
+        format_thread_stack(ident),
     )
 
 
@@ -44,6 +57,9 @@ def async_raise(tid: int, exctype: Any) -> None:
     if not inspect.isclass(exctype):
         raise TypeError("Only types can be raised (not instances)")
 
+    # Needed only for threads hanging at shutdown
+    import ctypes
+
     c_tid = ctypes.c_ulong(tid)  # changed in python 3.7+
     res = ctypes.pythonapi.PyThreadState_SetAsyncExc(c_tid, ctypes.py_object(exctype))
 
@@ -119,21 +135,62 @@ class InterruptibleThreadPoolExecutor(ThreadPoolExecutor):
                 return
 
 
+class RateLimiter:
+    """Token bucket allowing `rate` events per second with bursts of `burst` events."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        """
+        Init rate limiter with full bucket.
+        """
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self.suppressed = 0
+
+    def allow(self) -> bool:
+        """
+        Take token for one event.
+
+        :returns: `False` when the event exceeds the rate, it is counted in `suppressed`
+        """
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        if self._tokens < 1:
+            self.suppressed += 1
+            return False
+        self._tokens -= 1
+        return True
+
+    def take_suppressed(self) -> int:
+        """
+        Get number of suppressed events since the last call.
+        """
+        suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+
 class CumulusEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
     """Event loop policy for Cumulus Add-on."""
 
-    def __init__(self, log_level: str) -> None:
+    def __init__(self, log_level: str, event_loop: str = EVENT_LOOP.ASYNCIO) -> None:
         """
         Init the event loop policy.
+
+        :param log_level: loop runs in debug mode for `debug` level
+        :param event_loop: loop implementation (`EVENT_LOOP`), standard loop is used
+            when the selected one is not installed
         """
         super().__init__()
         self.debug = log_level == "debug"
+        self._create_loop = self._select_implementation(event_loop)
 
     def new_event_loop(self) -> asyncio.AbstractEventLoop:
         """
         Get the event loop.
         """
-        loop: asyncio.AbstractEventLoop = super().new_event_loop()
+        loop: asyncio.AbstractEventLoop = self._create_loop()
         loop.set_exception_handler(_async_loop_exception_handler)
         loop.set_debug(self.debug)
 
@@ -142,8 +199,24 @@ class CumulusEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
             max_workers=MAX_EXECUTOR_WORKERS
         )
         loop.set_default_executor(executor)
+        _LOOP_EXECUTORS[loop] = executor
         return loop
 
+    def _select_implementation(self, event_loop: str) -> Callable[[], asyncio.AbstractEventLoop]:
+        """
+        Get factory of the event loop implementation.
+        """
+        if event_loop == EVENT_LOOP.UVLOOP:
+            try:
+                import uvloop
+            except ImportError:
+                _LOGGER.warning("uvloop is not installed, use standard event loop")
+            else:
+                _LOGGER.debug("Use uvloop %s event loop", uvloop.__version__)
+                return uvloop.new_event_loop
+
+        return super().new_event_loop
+
 
 def _async_loop_exception_handler(loop: asyncio.AbstractEventLoop, context: dict[str, Any]) -> None:
     """
@@ -164,6 +237,17 @@ def _async_loop_exception_handler(loop: asyncio.AbstractEventLoop, context: dict
     _LOGGER.error("Error doing job: %s", context["message"], **kwargs)
 
 
+def executor_queue_depth(loop: asyncio.AbstractEventLoop) -> int:
+    """
+    Get number of jobs waiting in the default executor of the loop.
+    """
+    # pylint: disable=protected-access
+    executor = _LOOP_EXECUTORS.get(loop)
+    if executor is None:
+        return 0
+    return executor._work_queue.qsize()
+
+
 def enable_posix_spawn() -> None:
     """
     Enable posix_spawn on Alpine Linux.
@@ -0,0 +1,157 @@
+"""Watch responsiveness of the event loop and profile it on demand."""
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+from cumulus.utils import format_thread_stack
+
+_LOGGER = logging.getLogger(__name__)
+
+# Interval of loop heartbeats in seconds
+_HEARTBEAT_INTERVAL = 0.25
+_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_PROFILE_DURATION = 10
+_PROFILE_INTERVAL = 0.01
+# Executor threads are named by `CumulusEventLoopPolicy`
+_EXECUTOR_THREAD_PREFIX = "Worker"
+
+
+class LoopWatchdog:
+    """
+    Measure scheduling lag of the event loop.
+
+    Heartbeat task on the loop records the lag, a thread checks the heartbeats and
+    logs stack of the loop thread while the loop is blocked longer than threshold.
+    """
+
+    def __init__(self, cumulus: 'Fleet', threshold: float) -> None:
+        """
+        Init watchdog.
+
+        :param threshold: lag in seconds reported with the stack of the loop
+        """
+        self._threshold = threshold
+        self._loop_thread: int | None = None
+        self._last_beat = time.monotonic()
+        self._stopped = threading.Event()
+        self.stalls = 0
+        self._lag = cumulus.metrics.histogram(
+            "cumulus_loop_lag_seconds", "Scheduling lag of the event loop", buckets=_LAG_BUCKETS)
+        cumulus.metrics.counter(
+            "cumulus_loop_stalls_total", "Event loop blocked longer than threshold", callback=lambda: self.stalls)
+        cumulus.register_shutdown_handler(self._shutdown)
+
+    async def run(self) -> None:
+        """
+        Run heartbeats until shutdown.
+        """
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        threading.Thread(target=self._watch, name="LoopWatchdog", daemon=True).start()
+
+        while not self._stopped.is_set():
+            await asyncio.sleep(_HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            self._lag.observe(max(0.0, now - self._last_beat - _HEARTBEAT_INTERVAL))
+            self._last_beat = now
+
+    def _watch(self) -> None:
+        """
+        Check heartbeats in the watchdog thread.
+        """
+        reported_beat = None
+        while not self._stopped.wait(_HEARTBEAT_INTERVAL):
+            last_beat = self._last_beat
+            lag = time.monotonic() - last_beat - _HEARTBEAT_INTERVAL
+            if lag < self._threshold or last_beat == reported_beat:
+                continue
+
+            # Report every stall only once
+            reported_beat = last_beat
+            self.stalls += 1
+            _LOGGER.warning(
+                "Event loop is blocked for %.3fs: %s", lag, format_thread_stack(self._loop_thread))
+
+    async def _shutdown(self) -> None:
+        self._stopped.set()
+
+
+class SamplingProfiler:
+    """
+    Sample stacks of the event loop and executor threads.
+
+    Profile is written in folded format (`thread;frame;...;frame count`) readable
+    by flame graph tools.
+    """
+
+    def __init__(self, output_dir: Path) -> None:
+        """
+        Init profiler.
+
+        :param output_dir: directory of profile files
+        """
+        self._output_dir = output_dir
+        self._loop_thread = threading.get_ident()
+        self._thread: threading.Thread | None = None
+
+    def start(self, duration: float = _PROFILE_DURATION) -> None:
+        """
+        Start profiling in background thread, it can be called from signal handler.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            _LOGGER.warning("Profiler is already running")
+            return
+
+        _LOGGER.info("Profile event loop and executor threads for %ds", duration)
+        self._thread = threading.Thread(target=self._profile, args=(duration,), name="Profiler", daemon=True)
+        self._thread.start()
+
+    def _profile(self, duration: float) -> None:
+        stacks: collections.Counter[str] = collections.Counter()
+        samples = 0
+        own_thread = threading.get_ident()
+        end = time.monotonic() + duration
+
+        while time.monotonic() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                name = "loop" if ident == self._loop_thread else names.get(ident, str(ident))
+                if ident == own_thread or (name != "loop" and not name.startswith(_EXECUTOR_THREAD_PREFIX)):
+                    continue
+                if (stack := SamplingProfiler._fold(frame)) is not None:
+                    stacks[f"{name};{stack}"] += 1
+            samples += 1
+            time.sleep(_PROFILE_INTERVAL)
+
+        path = self._output_dir / f"profile-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+        try:
+            with open(path, "w", encoding="utf-8") as profile_file:
+                for stack, count in stacks.most_common():
+                    profile_file.write(f"{stack} {count}\n")
+        except OSError as err:
+            _LOGGER.error("Unable to write profile %s: %s", path, err)
+            return
+
+        _LOGGER.info("Profile with %d samples written to %s", samples, path)
+
+    @staticmethod
+    def _fold(frame) -> str | None:
+        """
+        Format stack of frame from the outermost call, `None` for idle executor thread.
+        """
+        code = frame.f_code
+        if code.co_name == "_worker" and code.co_filename.endswith(os.path.join("futures", "thread.py")):
+            # Waiting for a job
+            return None
+
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+            frame = frame.f_back
+        return ";".join(reversed(names))